@@ -0,0 +1,146 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+import nibabel
+
+'''
+
+Atlas geometry cache
+Centroids, voxel counts, bounding boxes and the flat ( fortran order, like
+the --maskedcompute indices ) voxel indices of every label of an atlas, computed in a single pass over the volume ( one stable
+sort of the labelled voxels and np.bincount sums of their coordinates )
+instead of one full-volume comparison per label.  The result is stored as an
+.npz next to the atlas, named after the sha1 of the atlas file so an edited
+atlas never reuses stale geometry, or in the temporary directory ( $TMPDIR )
+when the atlas directory is not writable.
+
+'''
+
+def file_hash(fname):
+    #sha1 of the file contents
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_names(atlasfile, digest):
+    #the cache next to the atlas first, then in the temporary directory
+    #( .fgeom: fortran order indices, caches of c order ones are not read )
+    name = '.' + os.path.basename(atlasfile) + '.' + digest + '.fgeom.npz'
+    return [os.path.join(os.path.dirname(os.path.abspath(atlasfile)), name),
+            os.path.join(tempfile.gettempdir(), name)]
+
+
+class AtlasGeometry(object):
+    """
+    labels : sorted non-zero label values
+    counts : number of voxels of every label
+    centroids : ( label x 3 ) mean voxel coordinates
+    bbox_min, bbox_max : ( label x 3 ) first and last voxel coordinates
+    indices : flat ( fortran order ) voxel indices grouped by label, ascending
+              within a label, label i owns indices[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self, shape, labels, counts, centroids, bbox_min, bbox_max, offsets, indices):
+        self.shape = tuple(int(dim) for dim in shape)
+        self.labels = labels
+        self.counts = counts
+        self.centroids = centroids
+        self.bbox_min = bbox_min
+        self.bbox_max = bbox_max
+        self.offsets = offsets
+        self.indices = indices
+        self.position = dict((int(lab), idx) for idx, lab in enumerate(labels))
+
+    @classmethod
+    def from_data(cls, labeldata):
+        shape = labeldata.shape
+        flat = np.rint(np.asarray(labeldata).reshape(-1, order='F')).astype(np.int64)
+        voxels = np.flatnonzero(flat)
+        labels, inverse = np.unique(flat[voxels], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(labels))
+        #stable, so every label's voxels stay in ascending flat order
+        order = np.argsort(inverse, kind='mergesort')
+        indices = voxels[order]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        coords = np.array(np.unravel_index(indices, shape, order='F'))
+        grouped = inverse[order]
+        centroids = np.zeros((len(labels), len(shape)))
+        bbox_min = np.zeros((len(labels), len(shape)), dtype=np.int64)
+        bbox_max = np.zeros((len(labels), len(shape)), dtype=np.int64)
+        for axis in range(len(shape)):
+            centroids[:,axis] = np.bincount(grouped, coords[axis], minlength=len(labels)) / counts
+            if len(labels) > 0:
+                bbox_min[:,axis] = np.minimum.reduceat(coords[axis], offsets[:-1])
+                bbox_max[:,axis] = np.maximum.reduceat(coords[axis], offsets[:-1])
+        return cls(shape, labels, counts, centroids, bbox_min, bbox_max, offsets, indices)
+
+    @classmethod
+    def load(cls, fname):
+        cache = np.load(fname)
+        return cls(cache['shape'], cache['labels'], cache['counts'], cache['centroids'],
+                   cache['bbox_min'], cache['bbox_max'], cache['offsets'], cache['indices'])
+
+    def save(self, fname):
+        #write then rename, so readers never see a partial cache
+        tmpname = fname + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.savez(f, shape=np.array(self.shape), labels=self.labels, counts=self.counts,
+                     centroids=self.centroids, bbox_min=self.bbox_min, bbox_max=self.bbox_max,
+                     offsets=self.offsets, indices=self.indices)
+        os.rename(tmpname, fname)
+
+    def voxels(self, label):
+        #flat ( fortran order ) indices of the voxels of label, empty if it is not in the atlas
+        idx = self.position.get(int(label))
+        if idx is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.indices[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def centroid(self, label):
+        #integer voxel centroid, each coordinate mean truncated like int( x.mean() )
+        return self.centroids[self.position[int(label)]].astype(int)
+
+    def mm_centroid(self, label, center, zooms):
+        #centroid in mm relative to the AC point, as written to the graphml files
+        return (self.centroid(label) - np.asarray(center))*np.asarray(zooms).astype('int')
+
+
+_loaded = {}
+
+def atlas_geometry(atlasfile):
+    '''
+    geometry of the labels of atlasfile, read from its cache or computed and
+    cached on first use
+    '''
+    digest = file_hash(atlasfile)
+    if digest in _loaded:
+        return _loaded[digest]
+
+    names = cache_names(atlasfile, digest)
+    geometry = None
+    for fname in names:
+        if os.path.isfile(fname):
+            try:
+                geometry = AtlasGeometry.load(fname)
+                break
+            except (IOError, OSError, ValueError, KeyError):
+                geometry = None
+
+    if geometry is None:
+        geometry = AtlasGeometry.from_data(np.asarray(nibabel.load(atlasfile).dataobj))
+        for fname in names:
+            try:
+                geometry.save(fname)
+                break
+            except (IOError, OSError):
+                continue
+
+    _loaded[digest] = geometry
+    return geometry
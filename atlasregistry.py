@@ -0,0 +1,120 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import nibabel
+
+'''
+
+Registry of the atlases and reference volumes shared by every subject
+Names ( aal116, raichle36, the MNI pve masks, the FSL brain and brain mask )
+or plain paths are resolved to a decompressed .nii copy in a local cache
+directory, written once with an atomic rename so concurrent subject workers
+never see a partial file.  Volumes are then opened as read-only memory maps
+of that copy, so every worker shares the same pages instead of decompressing
+its own.
+
+The cache directory is $RSPIPE_REFCACHE, or rspipe_refcache in the temporary
+directory ( $TMPDIR ).
+
+'''
+
+DATADIR = os.path.join(re.sub(r'\/bin','',os.path.dirname(os.path.realpath(__file__))), 'data')
+
+def fsl_standard(fname):
+    return os.path.join(os.environ.get('FSLDIR', ''), 'data', 'standard', fname)
+
+
+#name : ( volume, label text )
+REFERENCES = {
+    'aal116': (os.path.join(DATADIR, 'aal_MNI_V4.nii'), os.path.join(DATADIR, 'aal_MNI_V4.txt')),
+    'aal_no_cerebelum': (os.path.join(DATADIR, 'aal_no_cerebelum.nii.gz'), os.path.join(DATADIR, 'aal_no_cerebelum.txt')),
+    'raichle36': (os.path.join(DATADIR, 'raichle_network_mask.nii'), os.path.join(DATADIR, 'raichle_network_mask.txt')),
+    'mni_csf': (os.path.join(DATADIR, 'MNI152_T1_2mm_brain_pve_0.nii.gz'), None),
+    'mni_gm': (os.path.join(DATADIR, 'MNI152_T1_2mm_brain_pve_1.nii.gz'), None),
+    'mni_wm': (os.path.join(DATADIR, 'MNI152_T1_2mm_brain_pve_2.nii.gz'), None),
+    'mni_brain': (fsl_standard('MNI152_T1_2mm_brain.nii.gz'), None),
+    'mni_brain_mask': (fsl_standard('MNI152_T1_2mm_brain_mask.nii.gz'), None),
+}
+
+
+def resolve(name):
+    #source path of a registry name, other names are taken as paths
+    if name in REFERENCES:
+        return REFERENCES[name][0]
+    return name
+
+
+def label_text(name):
+    #label text file of a registry atlas, other names are taken as paths
+    if name in REFERENCES and REFERENCES[name][1] is not None:
+        return REFERENCES[name][1]
+    return name
+
+
+def cache_dir():
+    return os.environ.get('RSPIPE_REFCACHE', os.path.join(tempfile.gettempdir(), 'rspipe_refcache'))
+
+
+def cached(name):
+    '''
+    path of the decompressed local copy of a registry name or path, made on
+    first use.  The copy is named after the source path, size and
+    modification time, so a changed source gets a new copy.
+    '''
+    source = os.path.abspath(resolve(name))
+    if not os.path.isfile(source):
+        raise IOError("File does not exist: " + source)
+    stat = os.stat(source)
+    key = hashlib.sha1(('%s:%d:%d' % (source, stat.st_size, int(stat.st_mtime))).encode('utf-8')).hexdigest()[:16]
+    base = re.split(r'(\.nii$|\.nii\.gz$)', os.path.basename(source))[0]
+    dest = os.path.join(cache_dir(), key + '_' + base + '.nii')
+    if os.path.isfile(dest):
+        return dest
+
+    if not os.path.isdir(cache_dir()):
+        try:
+            os.makedirs(cache_dir())
+        except OSError:
+            #made by a concurrent worker
+            if not os.path.isdir(cache_dir()):
+                raise
+    tmpname = dest + '.' + str(os.getpid()) + '.tmp'
+    if source.endswith('.gz'):
+        src = gzip.open(source, 'rb')
+    else:
+        src = open(source, 'rb')
+    try:
+        with open(tmpname, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    finally:
+        src.close()
+    os.rename(tmpname, dest)
+    return dest
+
+
+_images = {}
+
+def load(name):
+    #nibabel image of the cached copy, its data is a read-only memory map
+    fname = cached(name)
+    if fname not in _images:
+        _images[fname] = nibabel.load(fname, mmap='r')
+    return _images[fname]
+
+
+def data(name):
+    '''
+    read-only array of a registry volume, a memory map of the cached copy
+    unless the image is scaled ( scl_slope/scl_inter )
+    '''
+    values = np.asanyarray(load(name).dataobj)
+    if values.flags.writeable:
+        values.flags.writeable = False
+    return values
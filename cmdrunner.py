@@ -0,0 +1,153 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import json
+import time
+import shlex
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+
+External command runner of resting_pipeline.py
+Commands are argv lists executed directly ( no shell ), with their exit
+status, duration and captured stdout/stderr recorded, an optional timeout,
+and independent commands run concurrently up to a job limit.  The history of
+a run is written as json, and with stand-in executors ( fslstandin.execute )
+it is the command plan of a run without running any of the real tools.
+
+'''
+
+class CommandResult(object):
+    """
+    argv : the command
+    returncode : exit status, 127 when the command was not found and -9 when
+                 it was killed at its timeout
+    started, duration : wall clock start and seconds taken
+    stdout, stderr : captured output as text
+    group : commands of the same group were independent and run together,
+            groups ran one after the other
+    """
+    def __init__(self, argv, returncode=0, started=None, duration=0., stdout='', stderr='',
+                 timed_out=False, tag=None, group=0):
+        self.argv = list(argv)
+        self.returncode = returncode
+        self.started = started if started is not None else time.time()
+        self.duration = duration
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.tag = tag
+        self.group = group
+
+    def ok(self):
+        return self.returncode == 0
+
+    def as_dict(self):
+        return {'argv': self.argv, 'command': ' '.join(shlex.quote(arg) for arg in self.argv),
+                'returncode': self.returncode, 'started': self.started, 'duration': self.duration,
+                'stdout': self.stdout, 'stderr': self.stderr, 'timed_out': self.timed_out,
+                'tag': self.tag, 'group': self.group}
+
+
+def execute(argv, timeout=None):
+    '''
+    run argv without a shell
+
+    returns the exit status, stdout, stderr and whether it timed out
+    '''
+    try:
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        #like the shell, a missing command is 127
+        return 127, b'', str(err).encode('utf-8'), False
+    try:
+        stdoutdata, stderrdata = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stdoutdata, stderrdata = proc.communicate()
+        return -9, stdoutdata, stderrdata, True
+    return proc.returncode, stdoutdata, stderrdata, False
+
+
+class CommandRunner(object):
+    """
+    jobs : commands run at once by run_all
+    timeout : seconds before a command is killed, None waits forever
+    executor : function( argv, timeout ) returning ( exit status, stdout,
+               stderr, timed out ), default runs argv as a child process
+    """
+    def __init__(self, jobs=1, timeout=None, executor=None):
+        self.jobs = max(1, int(jobs))
+        self.timeout = timeout
+        self.executor = executor if executor is not None else execute
+        self.history = []
+        self.groups = 0
+        self.__lock = threading.Lock()
+
+    def __next_group(self):
+        with self.__lock:
+            self.groups += 1
+            return self.groups
+
+    def run(self, argv, tag=None, group=None):
+        #argv list, or a command line split like the shell would
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        if group is None:
+            group = self.__next_group()
+        started = time.time()
+        returncode, stdoutdata, stderrdata, timed_out = self.executor(argv, self.timeout)
+        result = CommandResult(argv, returncode, started, time.time() - started,
+                               decode(stdoutdata), decode(stderrdata), timed_out, tag, group)
+        with self.__lock:
+            self.history.append(result)
+        return result
+
+    def run_all(self, commands, tag=None):
+        '''
+        run independent commands, jobs at a time
+
+        returns their results in the order of commands
+        '''
+        group = self.__next_group()
+        if self.jobs == 1 or len(commands) < 2:
+            return [self.run(argv, tag, group) for argv in commands]
+        with ThreadPoolExecutor(max_workers=min(self.jobs, len(commands))) as pool:
+            return list(pool.map(lambda argv: self.run(argv, tag, group), commands))
+
+    def failed(self):
+        return [result for result in self.history if not result.ok()]
+
+    def write(self, fname, **info):
+        #the history of every command run as json
+        plan = {'jobs': self.jobs, 'timeout': self.timeout,
+                'commands': [result.as_dict() for result in self.history]}
+        plan.update(info)
+        with open(fname, 'w') as f:
+            json.dump(plan, f, indent=1)
+        return fname
+
+
+def decode(output):
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+
+def log_result(result, logger=logging):
+    #output of a command to the log, failures as errors
+    for line in result.stdout.splitlines():
+        logger.info('  ' + line)
+    if result.ok():
+        for line in result.stderr.splitlines():
+            logger.info('  ' + line)
+        return
+    for line in result.stderr.splitlines():
+        logger.error('  ' + line)
+    if result.timed_out:
+        logger.error('command timed out after %.0fs: %s' % (result.duration, ' '.join(result.argv)))
+    else:
+        logger.error('command failed with exit status %d: %s' % (result.returncode, ' '.join(result.argv)))
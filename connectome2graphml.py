@@ -6,6 +6,8 @@ import nibabel
 import re
 import numpy as np
 import networkx as nx
+import atlasgeom
+import atlasregistry
 from optparse import OptionParser, OptionGroup
 
 usage ="""
@@ -13,7 +15,7 @@ connectome2graphml.py -s stats.nii.gz -p prefix
 
 Program to convert the 2D correlation matrix to a graphml file which can be used with graph-theory packages.
     --type is the statistics type ( ie: pvalue, rvalue, zrvalue )
-    --labels and --text default to aal116 if no input is provided ( ie: aal116, raichle36 or full paths )
+    --labels and --text default to aal116 if no input is provided ( ie: aal116, raichle36, aal_no_cerebelum or full paths )
     --AC point defaults to 45,63,36 if undefined ( assuming MNI152_T1_2mm_brain )
     --thresh is the threshold to use for extracting edges. default is 0. ( ie: .99 for p > .01 )
 """
@@ -36,23 +38,15 @@ if not (options.stats and options.prefix and options.stattype) or '-help' in sys
 	print "The statistics file, statistics type and output prefix are required. Try --help "
 	raise SystemExit()
 if options.label is not None:
-    if re.search('^aal116$',options.label):
-        options.label = os.path.join('/usr','local','packages','biacpython','data','aal_MNI_V4.nii')
-    elif re.search('^raichle36$',options.label):
-        options.label = os.path.join('/usr','local','packages','biacpython','data','raichle_network_mask.nii')
-    else:
-        if not (os.path.isfile(options.label)):
-            print "File does not exist: " + options.label
-            raise SystemExit()
+    options.label = atlasregistry.resolve(options.label)
+    if not (os.path.isfile(options.label)):
+        print "File does not exist: " + options.label
+        raise SystemExit()
 if options.labeltext is not None:
-    if re.search('^aal116$',options.labeltext):
-        options.labeltext = os.path.join('/usr','local','packages','biacpython','data','aal_MNI_V4.txt')
-    elif re.search('^raichle36$',options.label):
-        options.labeltext = os.path.join('/usr','local','packages','biacpython','data','raichle_network_mask.txt')
-    else:
-        if not (os.path.isfile(options.labeltext)):
-            print "File does not exist: " + options.labeltext
-            raise SystemExit()
+    options.labeltext = atlasregistry.label_text(options.labeltext)
+    if not (os.path.isfile(options.labeltext)):
+        print "File does not exist: " + options.labeltext
+        raise SystemExit()
 for fname in [ options.stats, options.label, options.labeltext ]:
     if not ( os.path.isfile(fname)):
         print "File does not exist: " + fname
@@ -86,16 +80,15 @@ for x in range(len(aalcenter)):
 if __name__ == "__main__":
     labels = grab_labels(options.labeltext)
 
-    thisnii = nibabel.load(options.label)
-    niidata = thisnii.get_data()
+    thisnii = atlasregistry.load(options.label)
     niihdr = thisnii.get_header()
     zooms = np.array(niihdr.get_zooms())
+    geometry = atlasgeom.atlas_geometry(atlasregistry.cached(options.label))
 
     G=nx.Graph(atlas=str(options.label))
     for lab in labels:
-        #grab indices equal to label value
-        x,y,z = (niidata == lab[0]).nonzero()
-        centroid = np.array([int(x.mean()),int(y.mean()),int(z.mean())])
+        #cached centroid of the label value
+        centroid = geometry.centroid(lab[0])
         c_cent_str = str((centroid - aalcenter)*(zooms.astype('int')))[1:-1].strip()
         lab.append( (centroid - aalcenter)*zooms.astype('int') )
         lab.append( 0 )
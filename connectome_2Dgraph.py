@@ -18,6 +18,10 @@ connectome_2Dgraph.py --graphml /path/to/connectome.graphml --edgeval pvalue --t
 
 Generates a graphy-theroy 2D graph with nodes/edges above a certain threshold.
     Communities are colored by a Louvian algorythm.
+    With --weight, communities are found on that edge attribute ( ie: zrvalue ), with --signed
+        on the full signed matrix before thresholding, negative edges pushing nodes apart.
+    With --consensus N, communities are the consensus of N randomized Louvain runs and the
+        assignment stability of each node is printed.
     Clicking a specific node with produce another graph containing only nodes that are directly connected to the area selected.
 
 """
@@ -26,6 +30,10 @@ parser = OptionParser(usage=usage)
 parser.add_option("-g", "--graphml",  action="store", type="string", dest="graphml",help="graphml file containing connectome information", metavar="/path/to/graphml")
 parser.add_option("-t", "--thresh",  action="store", type="string", dest="thresh",help="threshold to use for displaying significant connection", metavar="0.9998")
 parser.add_option("-e", "--edgeval",  action="store", type="string", dest="edgeval",help="the statistic that is represented by the connections in the graphml", metavar="pvalue", default='pvalue')
+parser.add_option("--consensus",  action="store", type="int", dest="consensus",help="number of randomized Louvain runs to build consensus communities from. default is a single run", metavar="100")
+parser.add_option("-w", "--weight",  action="store", type="string", dest="weight",help="edge attribute to weight the communities by ( ie: zrvalue ). default is unweighted", metavar="zrvalue")
+parser.add_option("--signed",  action="store_true", dest="signed",help="find the communities on all edges before thresholding, with signed modularity of the --weight values", default=False)
+parser.add_option("--jobs",  action="store", type="int", dest="jobs",help="number of processes to run the consensus runs in. default is 1", metavar="1", default=1)
 
 options, args = parser.parse_args()
 
@@ -179,6 +187,17 @@ if ( haslabel or hascentroid ) is None:
 #read the graphml
 G = nx.read_graphml(thisgraphml)
 
+if options.signed and options.weight is None:
+    print "Signed communities ( --signed ) need an edge attribute to weight by ( --weight )"
+    raise SystemExit()
+
+weight = 'weight'
+if options.weight is not None:
+    weight = str(options.weight)
+
+#the unthresholded graph, communities are found on it with --signed
+fullG = G.copy()
+
 #convert unicode to floats
 for here in [e for e in G.edges_iter(data=True)]:
     here[-1][edgeval] = float(here[-1][edgeval])
@@ -192,7 +211,22 @@ for here in [e for e in G.edges_iter(data=True)]:
 G.remove_nodes_from(nx.isolates(G))
 
 #calculate the communities
-partition = community.best_partition( G )
+commG = G
+if options.signed:
+    commG = fullG
+if options.consensus is not None and options.consensus > 0:
+    partition, stability = community.consensus_partition( commG, runs=options.consensus, jobs=options.jobs, weight=weight, signed=options.signed )
+    print "consensus of", options.consensus, "runs,", len(set(partition.values())), "communities"
+    for node in sorted(stability, key=stability.get):
+        print "\t", node, commG.node[node].get(haslabel, ''), "community", partition[node], "stability %.3f" % stability[node]
+else:
+    partition = community.best_partition( commG, engine='csr', weight=weight, signed=options.signed )
+
+#keep the displayed nodes, communities renumbered from 0
+renumber = {}
+for node in G.nodes():
+    renumber.setdefault(partition[node], len(renumber))
+partition = dict([ (node, renumber[partition[node]]) for node in G.nodes() ])
 
 #get the positions of each node
 pos = {}
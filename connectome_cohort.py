@@ -0,0 +1,197 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import numpy as np
+import nibabel
+import scipy.stats
+import functools
+from numpy.lib.format import open_memmap
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from optparse import OptionParser
+from permtest import edge_tstats, tail_stat, permutation_test
+
+usage ="""
+connectome_cohort.py --group1 subjects.txt [--group2 controls.txt] -p prefix
+
+Program to run edgewise statistics on the zr_matrix.nii.gz outputs of resting_pipeline.py for a cohort.
+    --group1/--group2 are text files listing one subject per line, either the subject's
+        pipeline output directory or the full path to its zr_matrix.nii.gz
+    with only --group1 a one-sample t-test is run, with both a two-sample ( group1 - group2 ) t-test
+    --mask defaults to the mask_matrix.nii.gz of the first subject ( edges below the diagonal )
+    --nperm permutations ( sign flips or group relabelling ) are used for the max-statistic
+        FWE correction and the network-based statistic, spread over --jobs processes
+    --nbsthresh is the primary t threshold used to form NBS components. default is 3.0
+    --tail is the direction of the test ( pos, neg or both ). default is both
+
+Outputs ( 2D matrices with results below the diagonal, ready for connectome2graphml.py ):
+    prefix_tstat.nii.gz    edgewise t statistic       ( --type tvalue )
+    prefix_pvalue.nii.gz   1 - uncorrected p value    ( --type pvalue --thresh .95 for p < .05 )
+    prefix_fdr.nii.gz      1 - FDR corrected q value  ( --type pvalue --thresh .95 for q < .05 )
+    prefix_fwe.nii.gz      1 - max-statistic FWE corrected p value
+    prefix_nbs.nii.gz      1 - NBS component p value for edges in a component
+    prefix_nbs.txt         NBS component table
+    prefix_edges.npy       memory-mapped subject x edge array of the zr values
+"""
+
+parser = OptionParser(usage=usage)
+parser.add_option("--group1",  action="store", type="string", dest="group1",help="text file listing the subjects of the first ( or only ) group", metavar="FILE")
+parser.add_option("--group2",  action="store", type="string", dest="group2",help="text file listing the subjects of the second group", metavar="FILE")
+parser.add_option("-m", "--mask",  action="store", type="string", dest="mask",help="matrix mask of edges to test, defaults to mask_matrix.nii.gz of the first subject", metavar="FILE")
+parser.add_option("-p", "--prefix",  action="store", type="string", dest="prefix",help="prefix to name your outputs", metavar="STRING")
+parser.add_option("--nperm",  action="store", type="int", dest="nperm",help="number of permutations for FWE correction and the network-based statistic, 0 to skip. default is 5000", metavar="5000", default=5000)
+parser.add_option("--nbsthresh",  action="store", type="float", dest="nbsthresh",help="primary t threshold for NBS components. default is 3.0", metavar="3.0", default=3.0)
+parser.add_option("--tail",  action="store", choices=('pos', 'neg', 'both'), dest="tail",help="test direction: pos, neg or both. default is both", default='both')
+parser.add_option("--seed",  action="store", type="int", dest="seed",help="random seed for the permutations. default is 0", metavar="0", default=0)
+parser.add_option("--jobs",  action="store", type="int", dest="jobs",help="number of processes to run permutations in. default is 1", metavar="1", default=1)
+parser.add_option("--batch",  action="store", type="int", dest="batch",help="number of permutations computed per matrix product. default is 500", metavar="500", default=500)
+
+
+def read_subjects(listfile):
+    #one subject directory or zr_matrix per line, blank lines and # comments skipped
+    subjects = []
+    for line in open(listfile, 'r').readlines():
+        line = line.split('#')[0].strip()
+        if len(line) == 0:
+            continue
+        if os.path.isdir(line):
+            line = os.path.join(line, 'zr_matrix.nii.gz')
+        if not os.path.isfile(line):
+            raise IOError("File does not exist: " + line)
+        subjects.append(line)
+    return subjects
+
+
+def mask_edges(maskfile):
+    #lower triangle edges selected by the matrix mask
+    mask = np.asarray(nibabel.load(maskfile).dataobj)
+    rows, cols = np.nonzero(np.tril(mask != 0, -1))
+    return mask.shape[0], rows, cols
+
+
+def load_edges(subjects, rows, cols, outfile=None):
+    '''
+    stack every subject's matrix values at ( rows, cols ) into a single
+    ( subject x edge ) array, memory-mapped to outfile if given
+    '''
+    if outfile is not None:
+        edges = open_memmap(outfile, mode='w+', dtype=np.float64, shape=(len(subjects), len(rows)))
+    else:
+        edges = np.zeros((len(subjects), len(rows)))
+    for idx, fname in enumerate(subjects):
+        mat = np.asarray(nibabel.load(fname).dataobj)
+        edges[idx] = mat[rows, cols]
+    if outfile is not None:
+        edges.flush()
+    return edges
+
+
+def tstat_pvalues(t, df, tail):
+    if tail == 'both':
+        return 2*scipy.stats.t.sf(np.abs(t), df)
+    return scipy.stats.t.sf(tail_stat(t, tail), df)
+
+
+def fdr(pvals):
+    #Benjamini-Hochberg adjusted p ( q ) values
+    pvals = np.asarray(pvals, dtype=np.float64)
+    order = np.argsort(pvals)
+    ranked = pvals[order] * len(pvals) / np.arange(1, len(pvals) + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    qvals = np.empty_like(pvals)
+    qvals[order] = np.minimum(ranked, 1)
+    return qvals
+
+
+def components(stat, thresh, rows, cols, nnodes):
+    '''
+    connected components formed by the edges with stat > thresh
+
+    returns the component of every supra-threshold edge ( -1 otherwise ) and
+    the number of edges in each component
+    '''
+    supra = np.flatnonzero(stat > thresh)
+    edgecomp = np.full(len(stat), -1)
+    if len(supra) == 0:
+        return edgecomp, np.zeros(0, dtype=int)
+    adj = coo_matrix((np.ones(len(supra)), (rows[supra], cols[supra])), shape=(nnodes, nnodes))
+    ncomp, nodecomp = connected_components(adj, directed=False)
+    edgecomp[supra] = nodecomp[rows[supra]]
+    return edgecomp, np.bincount(nodecomp[rows[supra]], minlength=ncomp)
+
+
+def max_component(stat, thresh, rows, cols, nnodes):
+    #number of edges in the largest component, the NBS null statistic
+    return components(stat, thresh, rows, cols, nnodes)[1].max(initial=0)
+
+
+def write_matrix(values, rows, cols, nnodes, fname):
+    mat = np.zeros((nnodes, nnodes))
+    mat[rows, cols] = values
+    nibabel.save(nibabel.Nifti1Image(mat, None), fname)
+
+
+if __name__ == "__main__":
+    options, args = parser.parse_args()
+
+    if not (options.group1 and options.prefix):
+        print("The subject list ( --group1 ) and output prefix are required. Try --help ")
+        raise SystemExit()
+    for fname in [ options.group1, options.group2, options.mask ]:
+        if fname is not None and not os.path.isfile(fname):
+            print("File does not exist: " + fname)
+            raise SystemExit()
+
+    subjects = read_subjects(options.group1)
+    groups = None
+    if options.group2 is not None:
+        subjects2 = read_subjects(options.group2)
+        groups = np.array([True]*len(subjects) + [False]*len(subjects2))
+        subjects = subjects + subjects2
+        if min(groups.sum(), (~groups).sum()) < 2:
+            print("Each group needs at least 2 subjects")
+            raise SystemExit()
+    elif len(subjects) < 2:
+        print("At least 2 subjects are needed")
+        raise SystemExit()
+
+    maskfile = options.mask
+    if maskfile is None:
+        maskfile = os.path.join(os.path.dirname(subjects[0]), 'mask_matrix.nii.gz')
+        if not os.path.isfile(maskfile):
+            print("File does not exist: " + maskfile + ", use --mask")
+            raise SystemExit()
+
+    nnodes, rows, cols = mask_edges(maskfile)
+    print("loading %d subjects, %d edges" % (len(subjects), len(rows)))
+    edges = load_edges(subjects, rows, cols, options.prefix + '_edges.npy')
+
+    t, df = edge_tstats(edges, groups)
+    pvals = tstat_pvalues(t, df, options.tail)
+    qvals = fdr(pvals)
+
+    write_matrix(t, rows, cols, nnodes, options.prefix + '_tstat.nii.gz')
+    write_matrix(1 - pvals, rows, cols, nnodes, options.prefix + '_pvalue.nii.gz')
+    write_matrix(1 - qvals, rows, cols, nnodes, options.prefix + '_fdr.nii.gz')
+
+    if options.nperm > 0:
+        print("running %d permutations for FWE and NBS at t > %g" % (options.nperm, options.nbsthresh))
+        reducer = functools.partial(max_component, thresh=options.nbsthresh, rows=rows, cols=cols, nnodes=nnodes)
+        t, punc, pfwe, nullmax, nullcomp = permutation_test(options.prefix + '_edges.npy', groups, options.nperm, options.tail,
+                                                            options.seed, options.batch, options.jobs, reducer)
+        write_matrix(1 - pfwe, rows, cols, nnodes, options.prefix + '_fwe.nii.gz')
+
+        #network-based statistic ( Zalesky et al, NeuroImage 2010 ): size of the supra-threshold
+        #components compared to the null distribution of the largest component
+        edgecomp, sizes = components(tail_stat(t, options.tail), options.nbsthresh, rows, cols, nnodes)
+        comppvals = np.array([(np.sum(nullcomp >= size) + 1.0) / (options.nperm + 1.0) for size in sizes])
+        nbsvals = np.zeros(len(rows))
+        nbsvals[edgecomp >= 0] = 1 - comppvals[edgecomp[edgecomp >= 0]]
+        write_matrix(nbsvals, rows, cols, nnodes, options.prefix + '_nbs.nii.gz')
+        with open(options.prefix + '_nbs.txt', 'w') as f:
+            f.write("# component\tedges\tpvalue\n")
+            for comp in np.argsort(-sizes):
+                if sizes[comp] == 0:
+                    continue
+                f.write("%d\t%d\t%g\n" % (comp, sizes[comp], comppvals[comp]))
@@ -0,0 +1,193 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import numpy as np
+import nibabel
+import multiprocessing
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+from optparse import OptionParser
+import community
+from connectome_cohort import read_subjects
+
+usage ="""
+connectome_metrics.py --subjects subjects.txt -o cohort_metrics.csv
+
+Program to compute graph-theory metrics from the zr_matrix.nii.gz outputs of resting_pipeline.py for a cohort.
+    --subjects is a text file listing one subject per line, either the subject's pipeline
+        output directory or the full path to its zr_matrix.nii.gz
+    every subject is thresholded at each of --thresholds ( zr values ) and/or --densities
+        ( fraction of strongest edges kept ), default is densities of 0.1,0.15,0.2,0.25,0.3
+    only positive edges are kept, weighted metrics use the zr values as weights
+
+Nodal metrics ( node is the ROI index ):
+    degree, strength, clustering ( binary ), wclustering ( weighted, Onnela et al. 2005 ),
+    efficiency ( nodal ), participation ( weighted participation coefficient ), module
+Global metrics ( node is 'global' ):
+    density, degree, strength, clustering, wclustering, efficiency, pathlength,
+    modularity, modules, smallworld ( sigma against analytic random graph C and L )
+
+Output is one tidy csv with columns subject,mode,level,node,metric,value
+"""
+
+parser = OptionParser(usage=usage)
+parser.add_option("-s", "--subjects",  action="store", type="string", dest="subjects",help="text file listing the subjects", metavar="FILE")
+parser.add_option("-o", "--output",  action="store", type="string", dest="output",help="csv file to write the metrics to", metavar="FILE")
+parser.add_option("--thresholds",  action="store", type="string", dest="thresholds",help="comma seperated zr thresholds", metavar="0.2,0.3")
+parser.add_option("--densities",  action="store", type="string", dest="densities",help="comma seperated edge densities", metavar="0.1,0.2")
+parser.add_option("--jobs",  action="store", type="int", dest="jobs",help="number of processes to run subjects in. default is 1", metavar="1", default=1)
+
+
+def threshold_matrix(zmat, thresh):
+    #keep positive edges above thresh, zero diagonal
+    W = np.where(zmat > max(thresh, 0), zmat, 0)
+    np.fill_diagonal(W, 0)
+    return W
+
+
+def density_matrix(zmat, density):
+    #keep the strongest positive edges, density is a fraction of all possible edges
+    n = zmat.shape[0]
+    rows, cols = np.tril_indices(n, -1)
+    vals = zmat[rows, cols]
+    keep = int(round(density * len(vals)))
+    W = np.zeros_like(zmat, dtype=np.float64)
+    if keep > 0:
+        top = np.argsort(-vals, kind='stable')[:keep]
+        top = top[vals[top] > 0]
+        W[rows[top], cols[top]] = vals[top]
+        W[cols[top], rows[top]] = vals[top]
+    return W
+
+
+def modules(W):
+    #louvain communities of the weighted graph as an int array
+    n = W.shape[0]
+    rows, cols = np.nonzero(W)
+    if len(rows) == 0:
+        return np.arange(n)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+    partition = community.best_partition(community.CSRGraph(range(n), indptr, cols, W[rows, cols]))
+    return np.array([partition[node] for node in range(n)])
+
+
+def graph_metrics(W):
+    '''
+    W : symmetric weighted adjacency matrix with zero diagonal
+
+    returns dictionaries of nodal ( arrays ) and global ( floats ) metrics
+    '''
+    n = W.shape[0]
+    A = (W > 0).astype(np.float64)
+    k = A.sum(axis=1)
+    s = W.sum(axis=1)
+
+    #clustering from the closed walks of length 3
+    pairs = k*(k - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clust = np.where(pairs > 0, np.einsum('ij,ij->i', np.dot(A, A), A) / pairs, 0)
+        Wc = np.cbrt(W / W.max()) if W.max() > 0 else W
+        wclust = np.where(pairs > 0, np.einsum('ij,ij->i', np.dot(Wc, Wc), Wc) / pairs, 0)
+
+    #binary shortest paths
+    dist = shortest_path(csr_matrix(A), unweighted=True, directed=False)
+    offdiag = ~np.eye(n, dtype=bool)
+    with np.errstate(divide='ignore'):
+        inv = np.where(offdiag, 1.0/dist, 0)
+    eff = inv.sum(axis=1) / (n - 1)
+    finite = np.isfinite(dist) & offdiag
+    pathlength = dist[finite].mean() if finite.any() else 0.
+
+    #modules, modularity and participation from the module-wise strengths
+    mods = modules(W)
+    M = np.zeros((n, mods.max() + 1))
+    M[np.arange(n), mods] = 1
+    ks = np.dot(W, M)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        part = np.where(s > 0, 1 - ((ks / s[:,np.newaxis])**2).sum(axis=1), 0)
+    total = W.sum()
+    Q = 0.
+    if total > 0:
+        B = np.dot(M.T, ks)
+        Q = np.trace(B)/total - ((B.sum(axis=1)/total)**2).sum()
+
+    meank = k.mean()
+    sigma = 0.
+    if meank > 1 and pathlength > 0 and clust.mean() > 0:
+        #erdos-renyi approximations: C = k/n, L = ln(n)/ln(k)
+        sigma = (clust.mean() / (meank/n)) / (pathlength / (np.log(n)/np.log(meank)))
+
+    nodal = {'degree': k, 'strength': s, 'clustering': clust, 'wclustering': wclust,
+             'efficiency': eff, 'participation': part, 'module': mods}
+    globl = {'density': A.sum() / (n*(n - 1)), 'degree': meank, 'strength': s.mean(),
+             'clustering': clust.mean(), 'wclustering': wclust.mean(), 'efficiency': eff.mean(),
+             'pathlength': pathlength, 'modularity': Q, 'modules': len(np.unique(mods)), 'smallworld': sigma}
+    return nodal, globl
+
+
+def subject_name(fname):
+    #subject output directory name, or the file name for loose matrices
+    if os.path.basename(fname) == 'zr_matrix.nii.gz':
+        return os.path.basename(os.path.dirname(os.path.abspath(fname)))
+    return os.path.basename(fname)
+
+
+def subject_rows(job):
+    #all metrics of one subject at every level as csv rows
+    fname, levels = job
+    name = subject_name(fname)
+    zmat = np.nan_to_num(np.asarray(nibabel.load(fname).dataobj, dtype=np.float64))
+    #symmetric, also when only one triangle was filled in
+    zmat = np.maximum(zmat, zmat.T)
+    rows = []
+    for mode, level in levels:
+        if mode == 'threshold':
+            W = threshold_matrix(zmat, level)
+        else:
+            W = density_matrix(zmat, level)
+        nodal, globl = graph_metrics(W)
+        for metric in sorted(globl):
+            rows.append("%s,%s,%g,global,%s,%g" % (name, mode, level, metric, globl[metric]))
+        for metric in sorted(nodal):
+            for node, value in enumerate(nodal[metric]):
+                rows.append("%s,%s,%g,%d,%s,%g" % (name, mode, level, node + 1, metric, value))
+    return rows
+
+
+if __name__ == "__main__":
+    options, args = parser.parse_args()
+
+    if not (options.subjects and options.output):
+        print("The subject list ( --subjects ) and output file ( --output ) are required. Try --help ")
+        raise SystemExit()
+    if not os.path.isfile(options.subjects):
+        print("File does not exist: " + options.subjects)
+        raise SystemExit()
+
+    levels = []
+    if options.thresholds is not None:
+        levels += [('threshold', float(x)) for x in options.thresholds.split(',')]
+    if options.densities is not None:
+        levels += [('density', float(x)) for x in options.densities.split(',')]
+    if len(levels) == 0:
+        levels = [('density', x) for x in [0.1, 0.15, 0.2, 0.25, 0.3]]
+
+    subjects = read_subjects(options.subjects)
+    jobs = [(fname, levels) for fname in subjects]
+
+    if options.jobs == 1:
+        results = map(subject_rows, jobs)
+    else:
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.imap(subject_rows, jobs)
+
+    with open(options.output, 'w') as f:
+        f.write("subject,mode,level,node,metric,value\n")
+        for idx, rows in enumerate(results):
+            f.write("\n".join(rows) + "\n")
+            print("finished %s ( %d of %d )" % (subject_name(subjects[idx]), idx + 1, len(subjects)))
+
+    if options.jobs != 1:
+        pool.close()
+        pool.join()
@@ -0,0 +1,111 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+'''
+
+Sliding-window (dynamic) functional connectivity
+Each window's correlation matrix is built from running sums of the ROI time
+series and of their outer products.  Sliding the window by one stride only
+adds the volumes entering it and subtracts the ones leaving it, so a window
+costs O(stride * n_roi^2) instead of a full np.corrcoef over window volumes.
+
+'''
+
+def window_starts(tdim, window, step=1):
+    #first volume of every complete window
+    return np.arange(0, tdim - window + 1, step)
+
+
+def r_to_z(rmat):
+    #fisher transform, infs ( r == 1, ie: diagonal ) become 0 like step7b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zr = 0.5*np.log((1+rmat)/(1-rmat))
+    zr[np.isinf(zr)] = 0
+    return np.nan_to_num(zr)
+
+
+def sliding_corr(timeseries, window, step=1, keep=None, outprefix=None):
+    '''
+    timeseries : ( n_roi x T ) array, as read from corrlabel_ts.txt
+    window, step : window length and stride in volumes
+    keep : optional boolean ( T ) scrub mask, volumes marked False are left out of every window
+    outprefix : if given, the ( window x roi x roi ) stacks are memory-mapped to
+                outprefix_r_matrix.npy and outprefix_zr_matrix.npy
+
+    returns starts, nvols, r stack, zr stack
+    '''
+    ts = np.array(timeseries, dtype=np.float64)
+    nroi, tdim = ts.shape
+    if window < 3 or window > tdim:
+        raise ValueError("window must be between 3 and %d volumes" % tdim)
+    if step < 1:
+        raise ValueError("window step must be at least 1 volume")
+
+    if keep is None:
+        keep = np.ones(tdim, dtype=bool)
+    keep = np.asarray(keep, dtype=bool)
+
+    #demean once so the running sums do not lose precision, then zero the
+    #scrubbed volumes so they add nothing to the sums
+    if keep.any():
+        ts -= ts[:,keep].mean(axis=1)[:,np.newaxis]
+    ts[:,~keep] = 0
+
+    starts = window_starts(tdim, window, step)
+    nwin = len(starts)
+    if outprefix is not None:
+        rstack = open_memmap(outprefix + '_r_matrix.npy', mode='w+', dtype=np.float64, shape=(nwin, nroi, nroi))
+        zstack = open_memmap(outprefix + '_zr_matrix.npy', mode='w+', dtype=np.float64, shape=(nwin, nroi, nroi))
+    else:
+        rstack = np.zeros((nwin, nroi, nroi))
+        zstack = np.zeros((nwin, nroi, nroi))
+    nvols = np.zeros(nwin, dtype=int)
+
+    #running sums over the current window [lo, hi)
+    lo = hi = 0
+    cnt = 0
+    s = np.zeros(nroi)
+    ss = np.zeros((nroi, nroi))
+
+    for idx, start in enumerate(starts):
+        stop = start + window
+        if start >= hi:
+            #no overlap with the previous window, start over
+            lo = hi = start
+            cnt = 0
+            s[:] = 0
+            ss[:] = 0
+        if start > lo:
+            leaving = ts[:,lo:start]
+            s -= leaving.sum(axis=1)
+            ss -= np.dot(leaving, leaving.T)
+            cnt -= int(keep[lo:start].sum())
+        entering = ts[:,hi:stop]
+        s += entering.sum(axis=1)
+        ss += np.dot(entering, entering.T)
+        cnt += int(keep[hi:stop].sum())
+        lo, hi = start, stop
+
+        nvols[idx] = cnt
+        if cnt < 3:
+            #not enough surviving volumes, leave this window empty
+            continue
+
+        cov = ss - np.outer(s, s)/cnt
+        sd = np.sqrt(np.clip(np.diag(cov), 0, None))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rmat = cov / np.outer(sd, sd)
+        rmat = np.clip(np.nan_to_num(rmat), -1, 1)
+        rmat[np.diag_indices(nroi)] = (sd > 0)
+
+        rstack[idx] = rmat
+        zstack[idx] = r_to_z(rmat)
+
+    if outprefix is not None:
+        rstack.flush()
+        zstack.flush()
+
+    return starts, nvols, rstack, zstack
@@ -0,0 +1,179 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import numpy as np
+import nibabel
+import scipy.sparse
+import rsstages
+import outofcore
+
+'''
+
+Connectome fast path of resting_pipeline.py ( --fastpath )
+Steps 5 ( WM/CSF regression ), 6 ( lowpass ) and 7a ( label mean time
+series ) fused: the normalized run is read once, a volume at a time, taking
+the WM and CSF mean time series and keeping the voxel time series ( of the
+--maskedcompute voxels, or all of them ) in memory, or in a scratch memory map
+with --max-memory.  Every block of voxels is then regressed, filtered and
+summed into the label time series in one go, keeping its min and max.
+Blocks are sized like rsstages.map_blocks ( 64MB, or --max-memory, for all
+the workers ), so the step peaks at the voxel time series ( the full run
+in float64 without --maskedcompute ) plus the blocks, about what step 6
+alone needs.
+
+Steps 5 and 6 each rescale to 0..30000.  The first rescale is linear and the
+lowpass filter commutes with it, so only the last one is applied, to the
+label means: ( mean - min ) * 30000 / ( max - min ).  The label time series
+agree with steps 5, 6 and 7a to the rounding of the float32 files those
+write in between.
+
+'''
+
+def mask_means(fname, masks, inmask=None, scratch=None):
+    '''
+    one pass over the volumes of fname
+    masks : 3D masks, the mean time series of the voxels > 0 of each
+    inmask : flat ( fortran order ) indices of the voxels to keep, default all
+    scratch : file for a ( n_keep x T ) memory map of the kept voxels,
+              default keeps them in memory
+
+    returns the ( T ) mean time series of every mask and the ( n_keep x T )
+    float64 voxel time series
+    '''
+    img = nibabel.load(fname)
+    nvox = int(np.prod(img.shape[:3]))
+    tdim = img.shape[3]
+    if inmask is None:
+        inmask = np.arange(nvox)
+    members = [np.flatnonzero(np.asarray(mask).reshape(nvox, order='F') > 0) for mask in masks]
+    means = [np.zeros(tdim) for mask in masks]
+    if scratch is None:
+        data2d = np.empty((len(inmask), tdim), dtype=np.float64, order='F')
+    else:
+        data2d = np.memmap(scratch, dtype='<f8', mode='w+', shape=(len(inmask), tdim), order='F')
+    for idx, vol in enumerate(outofcore.volumes(fname)):
+        for these, mean in zip(members, means):
+            mean[idx] = vol[these].mean() if len(these) else 0.
+        data2d[:,idx] = vol[inmask]
+    return means, data2d
+
+
+def label_matrix(labels, inmask=None):
+    '''
+    labels : 3D label image, values 1..max
+    inmask : flat ( fortran order ) indices of the kept voxels, default all
+
+    returns the ( label x kept voxel ) averaging matrix, a row per label
+    1..max like fslmeants --label.  Label voxels that were not kept are
+    counted as 0
+    '''
+    labels = np.rint(np.asarray(labels)).astype(np.int64).reshape(-1, order='F')
+    nlabels = int(labels.max())
+    counts = np.bincount(labels[labels > 0], minlength=nlabels + 1)[1:].astype(np.float64)
+    counts[counts == 0] = 1
+    if inmask is None:
+        inmask = np.arange(len(labels))
+    kept = labels[inmask]
+    cols = np.flatnonzero(kept > 0)
+    return scipy.sparse.csr_matrix((1.0/counts[kept[cols] - 1], (kept[cols] - 1, cols)), shape=(nlabels, len(inmask)))
+
+
+def fused_blocks(data2d, designs, window, avg, step, workers=1):
+    '''
+    regress designs out of every block of step rows of data2d, lowpass filter
+    it, write it back and average it into the labels, workers blocks at once
+
+    returns the ( label x T ) means and the min and max of the filtered data
+    '''
+    starts = list(range(0, data2d.shape[0], step))
+    sums = [None]*len(starts)
+    mins = [None]*len(starts)
+    maxs = [None]*len(starts)
+    def fused_block(idx):
+        block = np.array(data2d[starts[idx]:starts[idx] + step])
+        rsstages.regress_voxels(block, designs)
+        rsstages.lowpass_voxels(block, window)
+        mins[idx] = np.min(block)
+        maxs[idx] = np.max(block)
+        sums[idx] = avg[:,starts[idx]:starts[idx] + step].dot(block)
+        data2d[starts[idx]:starts[idx] + step] = block
+    rsstages.map_slices(fused_block, len(starts), workers)
+    #summed in block order, the same for any number of workers
+    means = np.zeros((avg.shape[0], data2d.shape[1]))
+    for part in sums:
+        means += part
+    return means, np.min(mins), np.max(maxs)
+
+
+def write_filtered(data2d, inmask, img, limits, newfile, max_memory=None):
+    '''
+    the filtered voxels scattered back into the run ( 0 outside inmask ),
+    rescaled with limits and written to newfile with the header of img, like
+    the output of step 6.  In memory data2d is rescaled in place
+    '''
+    if max_memory is None:
+        #the filtered voxels are not needed afterwards, rescaled in place
+        rsstages.rescale(data2d, img.get_data_dtype(), limits=limits)
+        return outofcore.scatter(data2d, inmask, img, limits, newfile)
+    shape = img.shape
+    nvox = int(np.prod(shape[:3]))
+    scratch = newfile + '.' + str(os.getpid()) + '.scratch'
+    result = np.memmap(scratch, dtype='<f8', mode='w+', shape=(nvox, shape[3]), order='F')
+    try:
+        step = outofcore.block_voxels(shape[3], max_memory)
+        for first in range(0, len(inmask), step):
+            result[inmask[first:first + step]] = data2d[first:first + step]
+        rsstages.rescale(result, img.get_data_dtype(), chunk=max(1, int(max_memory // (8*nvox))), limits=limits)
+        nibabel.save(nibabel.Nifti1Pair(result.reshape(shape, order='F'), None, img.header), newfile)
+        del result
+    finally:
+        if scratch is not None and os.path.isfile(scratch):
+            os.remove(scratch)
+    return newfile
+
+
+def fast_path(fname, wmmask, csfmask, labels, window, inmask=None, max_memory=None, workers=1, filtered=None):
+    '''
+    fname : normalized 4D run
+    wmmask, csfmask, labels : 3D WM and CSF masks and label image on its grid
+    window : rsstages.lowpass_window of the run
+    inmask : optional flat ( fortran order ) indices of the only voxels to
+             process, the others are 0 ( --maskedcompute )
+    max_memory : bytes, keeps the voxel time series in a scratch memory map
+                 next to fname and processes blocks within it
+    filtered : optional file name to also write the filtered run to
+
+    returns the ( T ) WM and CSF mean time series and the ( T x label ) label
+    mean time series, rescaled like step 6
+    '''
+    img = nibabel.load(fname)
+    nvox = int(np.prod(img.shape[:3]))
+    tdim = img.shape[3]
+    scratch = None
+    if max_memory is not None:
+        scratch = (filtered or fname) + '.' + str(os.getpid()) + '.fastpath.scratch'
+    try:
+        (wm_ts, csf_ts), data2d = mask_means(fname, [wmmask, csfmask], inmask, scratch)
+        if inmask is None:
+            inmask = np.arange(nvox)
+        avg = label_matrix(labels, inmask)
+        #workers blocks at once within the budget, and at least workers blocks
+        memory = max_memory if max_memory is not None else rsstages.BLOCK_MEMORY
+        step = min(rsstages.block_rows(tdim, memory, workers), max(1, -(-len(inmask) // max(1, workers))))
+        means, mn, mx = fused_blocks(data2d, rsstages.designs([wm_ts, csf_ts]), window, avg, step, workers)
+        if len(inmask) < nvox:
+            #the zeros outside the mask
+            mn, mx = min(mn, 0.), max(mx, 0.)
+        if filtered is not None:
+            write_filtered(data2d, inmask, img, (mn, mx), filtered, max_memory)
+        del data2d
+    finally:
+        if scratch is not None and os.path.isfile(scratch):
+            os.remove(scratch)
+    #( mean - min ) * scale, the scale cast to the output dtype like rsstages.rescale
+    mn = np.float64(mn)
+    mx = np.float64(mx)
+    scale = (30000.0 / (mx - mn)).astype(img.get_data_dtype())
+    timeseries = (means - mn)*scale
+    return wm_ts, csf_ts, timeseries.T
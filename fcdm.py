@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/bin/env python3
 # -*- coding: iso-8859-1 -*-
 
 import sys
@@ -18,7 +18,7 @@ Algorithm adapted from Dardo Tomasi, PNAS(2010), vol. 107, no. 21. 9885–9890
 
 def log(s,level=0):
     if level > 0:
-        print s
+        print(s)
 
 def fcdm(datafile,maskfile,thr):
     data = nb.load(datafile)
@@ -29,7 +29,7 @@ def fcdm(datafile,maskfile,thr):
     if data.shape[:-1] != mask.shape:
         raise IndexError("Data and Mask are not the same x,y,z shape!")
     #make a masked array and dilate the gm
-    mdata = np.ma.array(data.get_data(),mask=np.tile((nd.binary_dilation(mask.get_data()).astype(mask.get_data_dtype()) == 0)[:,:,:,np.newaxis], (1, 1, 1, data.shape[3])))
+    mdata = np.ma.array(data.get_fdata(),mask=np.tile((nd.binary_dilation(np.asanyarray(mask.dataobj)).astype(mask.get_data_dtype()) == 0)[:,:,:,np.newaxis], (1, 1, 1, data.shape[3])))
 
     #shape holder
     mshape = mdata.shape[:-1]
@@ -37,7 +37,7 @@ def fcdm(datafile,maskfile,thr):
     #hold results
     fc_dens = np.zeros(mshape, dtype=np.float32)
     
-    for x,y,z in itertools.product(xrange(mshape[0]),xrange(mshape[1]),xrange(mshape[2])):
+    for x,y,z in itertools.product(range(mshape[0]),range(mshape[1]),range(mshape[2])):
         if mdata[x,y,z].any(): #inmask
             nc = 0
             V = mdata[x,y,z].data
@@ -267,7 +267,7 @@ def fcdm(datafile,maskfile,thr):
             #/w8
 
             log("got to j14: %d,%d,%d %d,%d,%d nc = %d" % (x,y,z,l1,l2,l3,nc))
-            log("%d,%d,%d: r = %f, nc = %d" % (x,y,z,np.float(np.nan_to_num(c)),nc),1)
+            log("%d,%d,%d: r = %f, nc = %d" % (x,y,z,float(np.nan_to_num(c)),nc),1)
             fc_dens[x,y,z]=1.*nc
         else:
             #not in mask
@@ -275,8 +275,8 @@ def fcdm(datafile,maskfile,thr):
                         
     #save the results
     niftiname = str(os.path.join(basePath,'fcdm.nii.gz'))
-    newNii = nb.Nifti1Image(fc_dens,mask.get_affine())
-    print "saving %s" % niftiname
+    newNii = nb.Nifti1Image(fc_dens,mask.affine)
+    print("saving %s" % niftiname)
     nb.save(newNii,os.path.join(basePath,'fcdm.nii.gz'))
     return niftiname
     
@@ -288,7 +288,7 @@ if __name__ == "__main__":
     thr = 0.6
 
     if len(sys.argv) == 1:
-        print "Please provide (data, mask, threshold)"
+        print("Please provide (data, mask, threshold)")
     elif len(sys.argv) > 1:
         datafile = str(sys.argv[1])
         if not os.path.exists(datafile):
@@ -299,7 +299,7 @@ if __name__ == "__main__":
             if not os.path.exists(maskfile):
                 raise Exception("Input file does not exist!")
 
-        if len(sys.argv) == 3:
+        if len(sys.argv) > 3:
             thr = float(sys.argv[3])
 
         outname = fcdm(datafile,maskfile,thr)
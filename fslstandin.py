@@ -0,0 +1,525 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os, sys
+import re
+import struct
+import zlib
+import contextlib
+import threading
+import numpy as np
+import nibabel
+from io import StringIO
+from xml.etree import ElementTree
+from scipy import ndimage as nd
+import scipy.sparse
+
+'''
+
+Stand-ins for the FSL and BXH tools resting_pipeline.py runs
+With --backend standin the pipeline calls these instead of bxhreorient,
+bxhselect, bxh_slicetiming, dumpheader, fslwrapbxh, slicetimer, mcflirt, bet,
+flirt, convert_xfm, fslmaths, fslmeants and fsl_tsplot.  They take the same
+arguments and write correctly shaped outputs under the same names, from
+nibabel and numpy only, so the whole pipeline runs and can be timed on a
+machine without FSL or BXH:
+
+    bxhreorient, bxhselect : reorientation ( exact, by axis flips and swaps )
+                             and volume selection of the NIfTI the BXH points to
+    fslwrapbxh, dumpheader : minimal BXH XML wrappers and a dumpheader style
+                             listing of them
+    bxh_slicetiming : ascending slice timing ( the BXH has no acquisition timing )
+    slicetimer : linear interpolation of every slice to the middle of the TR
+    mcflirt : identity registration, the data is copied and the .par is zeros
+    bet : threshold at f of the robust intensity range, holes filled and only
+          the largest connected component kept
+    flirt : identity registration, the input is resampled to the reference
+            grid through the image affines ( matrices are taken as mm to mm )
+    convert_xfm : 4x4 matrix inverse and product
+    fslmaths : -Tmean -Tstd -mas -thr -bin -add -sub -mul -div -abs
+    fslmeants : mean time series of a mask or of every label
+    fsl_tsplot : a blank PNG of the requested size
+
+They are not substitutes for the real tools, only for timing and testing the
+pipeline around them.  Run as "fslstandin.py tool args ..." or through a
+symbolic link named after the tool.
+
+'''
+
+class StandinError(Exception):
+    pass
+
+
+def image_name(name):
+    #an existing image for an FSL style name given with or without extension
+    for fname in [name, name + '.nii.gz', name + '.nii']:
+        if os.path.isfile(fname):
+            return fname
+    raise StandinError("Image does not exist: " + name)
+
+
+def output_name(name):
+    #FSL writes .nii.gz when the name has no extension
+    if re.search(r'\.nii(\.gz)?$', name):
+        return name
+    return name + '.nii.gz'
+
+
+def strip_ext(name):
+    return re.split(r'(\.bxh$|\.nii$|\.nii\.gz$)', name)[0]
+
+
+def save(data, like, name, dtype=None):
+    #write data with the header ( affine, zooms, units ) of like
+    hdr = like.header.copy()
+    if dtype is None:
+        dtype = data.dtype
+    hdr.set_data_dtype(dtype)
+    hdr.set_data_shape(data.shape)
+    img = nibabel.Nifti1Image(np.asarray(data, dtype=dtype), like.affine, hdr)
+    img.header.set_zooms(like.header.get_zooms()[:3] + like.header.get_zooms()[3:len(data.shape)])
+    fname = output_name(name)
+    nibabel.save(img, fname)
+    return fname
+
+
+def parse(argv, valued):
+    '''
+    FSL style arguments, valued maps the flags taking values to how many
+    --flag=value, -flag value and bare -flag forms are accepted
+
+    returns the flags and the positional arguments
+    '''
+    opts = {}
+    args = []
+    idx = 0
+    while idx < len(argv):
+        arg = argv[idx]
+        if arg.startswith('-') and len(arg) > 1 and not re.match(r'^-[0-9.]', arg):
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+                opts[key] = value
+            elif arg in valued:
+                count = valued[arg]
+                if idx + count >= len(argv):
+                    raise StandinError("Missing value for " + arg)
+                opts[arg] = argv[idx + 1] if count == 1 else argv[idx + 1:idx + 1 + count]
+                idx += count
+            else:
+                opts[arg] = True
+        else:
+            args.append(arg)
+        idx += 1
+    return opts, args
+
+
+#BXH wrappers
+
+BXHNS = '{http://www.biac.duke.edu/bxh}'
+
+def read_bxh(bxhname):
+    '''
+    NIfTI file and slice order of a BXH file, the NIfTI name is relative to
+    the BXH file.  NIfTI files are taken as is, like the BXH tools do
+    '''
+    if re.search(r'\.nii(\.gz)?$', bxhname):
+        return image_name(bxhname), None
+    tree = ElementTree.parse(bxhname)
+    fname = None
+    sliceorder = None
+    for elem in tree.iter():
+        tag = elem.tag.replace(BXHNS, '')
+        if tag == 'filename' and fname is None:
+            fname = elem.text.strip()
+        elif tag == 'sliceorder':
+            sliceorder = elem.text.strip()
+    if fname is None:
+        raise StandinError("No image filename in " + bxhname)
+    fname = os.path.join(os.path.dirname(os.path.abspath(bxhname)), fname)
+    if not re.search(r'\.nii(\.gz)?$', fname):
+        raise StandinError("Only BXH files of NIfTI images are supported: " + bxhname)
+    return image_name(fname), sliceorder
+
+
+def write_bxh(bxhname, niiname, sliceorder=None):
+    root = ElementTree.Element('bxh', {'xmlns': BXHNS[1:-1], 'version': '1.0'})
+    datarec = ElementTree.SubElement(root, 'datarec', {'type': 'image'})
+    relname = os.path.relpath(os.path.abspath(niiname), os.path.dirname(os.path.abspath(bxhname)))
+    ElementTree.SubElement(datarec, 'filename').text = relname
+    if sliceorder is not None:
+        acq = ElementTree.SubElement(root, 'acquisitiondata')
+        ElementTree.SubElement(acq, 'sliceorder').text = sliceorder
+    #the image is written first, so a BXH never points to a missing file
+    tmpname = bxhname + '.' + str(os.getpid()) + '.tmp'
+    ElementTree.ElementTree(root).write(tmpname, encoding='utf-8', xml_declaration=True)
+    os.rename(tmpname, bxhname)
+    return bxhname
+
+
+def fslwrapbxh(argv):
+    for fname in argv:
+        write_bxh(strip_ext(fname) + '.bxh', image_name(fname))
+    return 0
+
+
+def bxhselect(argv):
+    opts, args = parse(argv, {'--timeselect': 1})
+    if len(args) != 2:
+        raise StandinError("usage: bxhselect [--overwrite] [--timeselect first:last] in.bxh out.bxh")
+    niiname, sliceorder = read_bxh(args[0])
+    img = nibabel.load(niiname)
+    data = np.asanyarray(img.dataobj)
+    if os.path.abspath(output_name(strip_ext(args[1]))) == os.path.abspath(niiname):
+        #in place, do not read from the file being written
+        data = np.array(data)
+    if '--timeselect' in opts:
+        first, last = (opts['--timeselect'].split(':') + [''])[:2]
+        first = int(first) if first else 0
+        last = int(last) + 1 if last else data.shape[3]
+        data = data[..., first:last]
+    outnii = save(data, img, strip_ext(args[1]))
+    write_bxh(args[1], outnii, sliceorder)
+    return 0
+
+
+def bxhreorient(argv):
+    opts, args = parse(argv, {})
+    if len(args) != 2:
+        raise StandinError("usage: bxhreorient --orientation=LAS in.bxh out.bxh")
+    orientation = opts.get('--orientation', 'LAS').upper()
+    niiname, sliceorder = read_bxh(args[0])
+    img = nibabel.load(niiname)
+    current = nibabel.orientations.io_orientation(img.affine)
+    target = nibabel.orientations.axcodes2ornt(tuple(orientation))
+    transform = nibabel.orientations.ornt_transform(current, target)
+    out = img.as_reoriented(transform)
+    outnii = output_name(strip_ext(args[1]))
+    nibabel.save(out, outnii)
+    write_bxh(args[1], outnii, sliceorder)
+    return 0
+
+
+def dumpheader(argv):
+    if len(argv) != 1:
+        raise StandinError("usage: dumpheader in.bxh")
+    niiname, sliceorder = read_bxh(argv[0])
+    img = nibabel.load(niiname)
+    aff = img.affine
+    print(" Filename: " + os.path.relpath(niiname, os.path.dirname(os.path.abspath(argv[0]))))
+    for axis, dimname in enumerate('xyz'):
+        last = np.zeros(4)
+        last[axis] = img.shape[axis] - 1
+        last[3] = 1
+        first = aff[:3,3]
+        lastpos = aff.dot(last)[:3]
+        direction = aff[:3,axis] / np.sqrt((aff[:3,axis]**2).sum())
+        print("Dimension %d (%s): (%g, %g, %g)mm to (%g, %g, %g)mm, %d steps, direction (%g, %g, %g)" %
+              ((axis + 1, dimname) + tuple(first) + tuple(lastpos) + (img.shape[axis],) + tuple(direction)))
+    if len(img.shape) > 3:
+        tr = float(img.header.get_zooms()[3])
+        units = {'sec': 1000., 'msec': 1., 'usec': 0.001}.get(img.header.get_xyzt_units()[1], 1000.)
+        print("Dimension 4 (t): 0ms to %gms, %d steps, direction" % (tr*units*img.shape[3], img.shape[3]))
+    if sliceorder is not None:
+        print("acqdata: sliceorder = " + sliceorder)
+    return 0
+
+
+def bxh_slicetiming(argv):
+    opts, args = parse(argv, {})
+    if len(args) != 2:
+        raise StandinError("usage: bxh_slicetiming --fsl in.bxh out.txt")
+    niiname, sliceorder = read_bxh(args[0])
+    nslices = nibabel.load(niiname).shape[2]
+    order = list(range(1, nslices + 1))
+    if sliceorder is not None:
+        order = [int(x) for x in sliceorder.split(',')]
+    #fraction of the TR every slice is acquired at
+    timing = np.zeros(nslices)
+    timing[np.array(order) - 1] = np.arange(nslices) / float(nslices)
+    np.savetxt(args[1], timing, fmt='%f')
+    return 0
+
+
+#FSL
+
+def slicetimer(argv):
+    opts, args = parse(argv, {'-i': 1, '-o': 1, '-r': 1, '-d': 1})
+    if '-i' not in opts or '-o' not in opts:
+        raise StandinError("usage: slicetimer -i in -o out [-r tr] [--tcustom=file | --ocustom=file]")
+    img = nibabel.load(image_name(opts['-i']))
+    data = img.get_fdata(dtype=np.float32)
+    nslices, tdim = data.shape[2], data.shape[3]
+    timing = np.arange(nslices) / float(nslices)
+    if '--tcustom' in opts:
+        timing = np.loadtxt(opts['--tcustom']).reshape(-1)
+    elif '--ocustom' in opts:
+        order = np.loadtxt(opts['--ocustom']).astype(int).reshape(-1)
+        timing = np.zeros(nslices)
+        timing[order - 1] = np.arange(nslices) / float(nslices)
+    elif '--odd' in opts:
+        order = np.concatenate([np.arange(0, nslices, 2), np.arange(1, nslices, 2)])
+        timing[order] = np.arange(nslices) / float(nslices)
+    elif '--down' in opts:
+        timing = timing[::-1]
+
+    out = np.empty_like(data)
+    for cntz in range(nslices):
+        #value at the middle of the TR from the neighbouring volumes
+        shift = 0.5 - timing[cntz]
+        pos = np.clip(np.arange(tdim) + shift, 0, tdim - 1)
+        lo = np.floor(pos).astype(int)
+        hi = np.minimum(lo + 1, tdim - 1)
+        frac = (pos - lo).astype(np.float32)
+        out[:,:,cntz,:] = data[:,:,cntz,lo]*(1 - frac) + data[:,:,cntz,hi]*frac
+    save(out, img, opts['-o'], np.float32)
+    return 0
+
+
+def mcflirt(argv):
+    opts, args = parse(argv, {'-in': 1, '-o': 1, '-out': 1, '-r': 1, '-refvol': 1, '-cost': 1, '-dof': 1})
+    if '-in' not in opts:
+        raise StandinError("usage: mcflirt -in in [-o out] [-plots]")
+    inname = image_name(opts['-in'])
+    out = opts.get('-o', opts.get('-out', strip_ext(inname) + '_mcf'))
+    img = nibabel.load(inname)
+    save(np.asanyarray(img.dataobj), img, out)
+    if '-plots' in opts:
+        np.savetxt(strip_ext(out) + '.par', np.zeros((img.shape[3], 6)), fmt='%f')
+    return 0
+
+
+def bet(argv):
+    opts, args = parse(argv, {'-f': 1, '-g': 1, '-r': 1, '-c': 3})
+    if len(args) != 2:
+        raise StandinError("usage: bet in out [-f f] [-m]")
+    img = nibabel.load(image_name(args[0]))
+    data = img.get_fdata(dtype=np.float32)
+    frac = float(opts.get('-f', 0.5))
+    lo, hi = np.percentile(data, [2, 98])
+    mask = data > lo + frac*(hi - lo)/4.
+    labels, count = nd.label(mask)
+    if count > 1:
+        mask = labels == (np.argmax(np.bincount(labels.reshape(-1))[1:]) + 1)
+    mask = nd.binary_fill_holes(mask)
+    if '-n' not in opts:
+        save(data*mask, img, args[1], img.get_data_dtype())
+    if '-m' in opts:
+        save(mask.astype(np.uint8), img, strip_ext(args[1]) + '_mask', np.uint8)
+    return 0
+
+
+def read_matrix(fname):
+    return np.loadtxt(fname).reshape((4, 4))
+
+
+def write_matrix(fname, mat):
+    np.savetxt(fname, mat, fmt='%.10f', delimiter='  ')
+
+
+def resample(img, ref, mat):
+    '''
+    img in the grid of ref, mat maps the mm coordinates of img to those of
+    ref.  Identical grids and an identity mat are a copy
+    '''
+    vox2vox = np.linalg.inv(img.affine).dot(np.linalg.inv(mat)).dot(ref.affine)
+    data = np.asanyarray(img.dataobj)
+    if img.shape[:3] == ref.shape[:3] and np.allclose(vox2vox, np.eye(4)):
+        return data
+    data = np.asarray(data, dtype=np.float32)
+    out = np.zeros(ref.shape[:3] + data.shape[3:], dtype=np.float32)
+    flat = data.reshape(data.shape[:3] + (-1,))
+    outflat = out.reshape(ref.shape[:3] + (-1,))
+    for vol in range(flat.shape[3]):
+        outflat[...,vol] = nd.affine_transform(flat[...,vol], vox2vox[:3,:3], vox2vox[:3,3],
+                                               output_shape=ref.shape[:3], order=1)
+    return out
+
+
+def flirt(argv):
+    opts, args = parse(argv, {'-in': 1, '-ref': 1, '-out': 1, '-o': 1, '-omat': 1, '-init': 1, '-cost': 1,
+                              '-dof': 1, '-bins': 1, '-interp': 1, '-searchrx': 2, '-searchry': 2, '-searchrz': 2})
+    if '-in' not in opts or '-ref' not in opts:
+        raise StandinError("usage: flirt -in in -ref ref [-out out] [-omat mat] [-applyxfm -init mat]")
+    img = nibabel.load(image_name(opts['-in']))
+    ref = nibabel.load(image_name(opts['-ref']))
+    mat = np.eye(4)
+    if '-applyxfm' in opts:
+        if '-init' not in opts:
+            raise StandinError("-applyxfm needs -init")
+        mat = read_matrix(opts['-init'])
+    elif len(img.shape) > 3:
+        #estimation writes the registered first volume, like flirt
+        img = img.slicer[..., 0]
+    if '-omat' in opts:
+        write_matrix(opts['-omat'], mat)
+    out = opts.get('-out', opts.get('-o'))
+    if out is not None:
+        data = resample(img, ref, mat)
+        hdr = img.header.copy()
+        outimg = nibabel.Nifti1Image(data, ref.affine, hdr)
+        outimg.header.set_zooms(ref.header.get_zooms()[:3] + img.header.get_zooms()[3:len(data.shape)])
+        nibabel.save(outimg, output_name(out))
+    return 0
+
+
+def convert_xfm(argv):
+    opts, args = parse(argv, {'-omat': 1, '-concat': 1})
+    if '-omat' not in opts or len(args) != 1:
+        raise StandinError("usage: convert_xfm -omat out [-inverse | -concat second] in")
+    mat = read_matrix(args[0])
+    if '-inverse' in opts:
+        mat = np.linalg.inv(mat)
+    elif '-concat' in opts:
+        mat = read_matrix(opts['-concat']).dot(mat)
+    write_matrix(opts['-omat'], mat)
+    return 0
+
+
+def fslmaths(argv):
+    if len(argv) < 2:
+        raise StandinError("usage: fslmaths in [-op [value] ...] out")
+    img = nibabel.load(image_name(argv[0]))
+    data = img.get_fdata(dtype=np.float32)
+    idx = 1
+    while idx < len(argv) - 1:
+        op = argv[idx]
+        if op == '-Tmean':
+            data = data.mean(axis=3)
+        elif op == '-Tstd':
+            data = data.std(axis=3)
+        elif op == '-abs':
+            data = np.abs(data)
+        elif op == '-bin':
+            data = (data != 0).astype(np.float32)
+        elif op in ['-mas', '-thr', '-add', '-sub', '-mul', '-div']:
+            idx += 1
+            value = argv[idx]
+            if op == '-mas':
+                mask = np.asanyarray(nibabel.load(image_name(value)).dataobj) != 0
+                data = data*(mask if data.ndim == mask.ndim else mask[...,np.newaxis])
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = nibabel.load(image_name(value)).get_fdata(dtype=np.float32)
+                if op == '-thr':
+                    data = np.where(data < value, 0, data)
+                elif op == '-add':
+                    data = data + value
+                elif op == '-sub':
+                    data = data - value
+                elif op == '-mul':
+                    data = data*value
+                else:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        data = np.nan_to_num(data / value)
+        else:
+            raise StandinError("Unsupported fslmaths operation: " + op)
+        idx += 1
+    save(data.astype(np.float32), img, argv[-1], np.float32)
+    return 0
+
+
+def fslmeants(argv):
+    opts, args = parse(argv, {'-i': 1, '-o': 1, '-m': 1})
+    if '-i' not in opts or ('-m' not in opts and '--label' not in opts):
+        raise StandinError("usage: fslmeants -i in ( -m mask | --label=labels ) [-o out]")
+    img = nibabel.load(image_name(opts['-i']))
+    nvox = int(np.prod(img.shape[:3]))
+    data2d = np.asanyarray(img.dataobj).reshape((nvox, -1), order='F')
+    if '--label' in opts:
+        labels = np.rint(np.asanyarray(nibabel.load(image_name(opts['--label'])).dataobj)).astype(np.int64).reshape(nvox, order='F')
+    else:
+        labels = (np.asanyarray(nibabel.load(image_name(opts['-m'])).dataobj) > 0).astype(np.int64).reshape(nvox, order='F')
+    if labels.shape[0] != data2d.shape[0]:
+        raise StandinError("Data and mask are not the same x,y,z shape")
+    voxels = np.flatnonzero(labels > 0)
+    nlabels = int(labels.max())
+    #( label x voxel ) averaging matrix, a column per label 1..max like fslmeants
+    counts = np.bincount(labels[voxels], minlength=nlabels + 1)[1:].astype(np.float64)
+    counts[counts == 0] = 1
+    avg = scipy.sparse.csr_matrix((1.0/counts[labels[voxels] - 1], (labels[voxels] - 1, np.arange(len(voxels)))),
+                                  shape=(nlabels, len(voxels)))
+    means = avg.dot(np.asarray(data2d[voxels], dtype=np.float64)).T
+    if '-o' in opts:
+        np.savetxt(opts['-o'], means, fmt='%f')
+    else:
+        np.savetxt(sys.stdout, means, fmt='%f')
+    return 0
+
+
+def png(fname, width, height):
+    #blank white 8 bit grayscale PNG
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff)
+    raw = b''.join(b'\x00' + b'\xff'*width for row in range(height))
+    with open(fname, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def fsl_tsplot(argv):
+    opts, args = parse(argv, {'-i': 1, '-o': 1, '-t': 1, '-u': 1, '-a': 1, '-w': 1, '-h': 1, '-x': 1, '-y': 1})
+    if '-i' not in opts or '-o' not in opts:
+        raise StandinError("usage: fsl_tsplot -i in -o out.png [-w width] [-h height]")
+    np.loadtxt(opts['-i'])
+    png(opts['-o'], int(opts.get('-w', 600)), int(opts.get('-h', 120)))
+    return 0
+
+
+TOOLS = {
+    'bxhreorient': bxhreorient,
+    'bxhselect': bxhselect,
+    'bxh_slicetiming': bxh_slicetiming,
+    'dumpheader': dumpheader,
+    'fslwrapbxh': fslwrapbxh,
+    'slicetimer': slicetimer,
+    'mcflirt': mcflirt,
+    'bet': bet,
+    'flirt': flirt,
+    'convert_xfm': convert_xfm,
+    'fslmaths': fslmaths,
+    'fslmeants': fslmeants,
+    'fsl_tsplot': fsl_tsplot,
+}
+
+
+def run(argv):
+    '''
+    run a tool in this process, argv is the command line split like a shell
+    ( ie: shlex.split ) with the tool name first
+
+    returns the exit status, 127 for unknown tools like a shell
+    '''
+    if len(argv) == 0 or os.path.basename(argv[0]) not in TOOLS:
+        sys.stderr.write("fslstandin: no stand-in for %s\n" % (argv[0] if argv else ''))
+        return 127
+    tool = os.path.basename(argv[0])
+    try:
+        return TOOLS[tool](list(argv[1:]))
+    except (StandinError, IOError, OSError, ValueError, IndexError, ElementTree.ParseError,
+            nibabel.filebasedimages.ImageFileError) as err:
+        sys.stderr.write("%s: %s\n" % (tool, err))
+        return 1
+
+
+_output_lock = threading.Lock()
+
+def execute(argv, timeout=None):
+    '''
+    cmdrunner executor of the stand-ins: returns the exit status, stdout,
+    stderr and False ( there is no timeout ).  The stand-ins run in this
+    process one at a time, sys.stdout and sys.stderr are redirected for them
+    '''
+    out, err = StringIO(), StringIO()
+    with _output_lock:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            status = run(argv)
+    return status, out.getvalue().encode('utf-8'), err.getvalue().encode('utf-8'), False
+
+
+if __name__ == "__main__":
+    #fslstandin.py tool args, or a link named after the tool
+    if os.path.basename(sys.argv[0]) in TOOLS:
+        raise SystemExit(run(sys.argv))
+    raise SystemExit(run(sys.argv[1:]))
@@ -0,0 +1,208 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import numpy as np
+import nibabel
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
+import rsstages
+
+'''
+
+Out-of-core mode of the numpy steps of resting_pipeline.py ( --max-memory )
+The 4D input is copied once, a volume at a time, to an uncompressed float64
+NIfTI scratch file next to the output, and memory-mapped as a ( n_vox x T )
+array.  The step kernel is then run on blocks of voxels small enough for the
+memory budget: each block is read from the map, processed and written back,
+keeping its min and max.  The result is then rescaled in chunks of volumes
+( rsstages.rescale with those limits ) and written out a volume at a time,
+so a 2mm MNI x 1200 volume run needs a few volumes plus one block of memory
+instead of 2-3 full float64 copies.  Blocks are processed with the same math
+as the slices of the in memory steps, results agree with them to rounding.
+
+'''
+
+#float64 block copies alive at once while a block is regressed or filtered
+COPIES = rsstages.BLOCK_COPIES
+
+UNITS = {'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+
+def parse_memory(spec):
+    #bytes of a size like 512M, 4G or 4000000000
+    spec = str(spec).strip().lower().rstrip('b')
+    if spec and spec[-1] in UNITS:
+        return int(float(spec[:-1])*UNITS[spec[-1]])
+    return int(spec)
+
+
+def block_voxels(tdim, max_memory):
+    #voxels per block so the copies of a block stay within max_memory bytes
+    return rsstages.block_rows(tdim, max_memory)
+
+
+def volumes(fname):
+    '''
+    every volume of a 4D NIfTI, in order, as a flat ( fortran ordered )
+    float64 array scaled like get_fdata.  The file is read once, front to
+    back, so .nii.gz files are not decompressed again for every volume
+    '''
+    img = nibabel.load(fname)
+    proxy = img.dataobj
+    dtype = img.header.get_data_dtype()
+    nvox = int(np.prod(img.shape[:3]))
+    slope = np.asanyarray(proxy.slope).astype(np.float64)
+    inter = np.asanyarray(proxy.inter).astype(np.float64)
+    with ImageOpener(fname) as f:
+        f.seek(proxy.offset)
+        for idx in range(img.shape[3]):
+            raw = np.frombuffer(f.read(nvox*dtype.itemsize), dtype=dtype)
+            yield apply_read_scaling(raw, slope, inter).astype(np.float64)
+
+
+def gather(fname, inmask):
+    '''
+    ( n_mask x T ) float64 time series of the inmask voxels ( flat, fortran
+    order indices ) of a 4D NIfTI, read a volume at a time
+    '''
+    img = nibabel.load(fname)
+    data2d = np.empty((len(inmask), img.shape[3]), dtype=np.float64, order='F')
+    for idx, vol in enumerate(volumes(fname)):
+        data2d[:,idx] = vol[inmask]
+    return data2d
+
+
+def scatter(data2d, inmask, img, limits, newfile):
+    '''
+    write the ( n_mask x T ) rescaled inmask voxels into a run shaped and
+    headed like img, the other voxels at the rescaled 0, and save it to
+    newfile.  The run is built in the output dtype when it is a float type,
+    which is what nibabel would cast the float64 run to anyway
+    '''
+    dtype = img.get_data_dtype()
+    outtype = dtype if np.issubdtype(dtype, np.floating) else np.float64
+    #0 rescaled exactly like the voxels were
+    fill = rsstages.rescale(np.zeros((1, 1)), dtype, limits=limits)[0, 0]
+    result = np.full((int(np.prod(img.shape[:3])), img.shape[3]), fill, dtype=outtype, order='F')
+    step = rsstages.block_rows(img.shape[3])
+    for first in range(0, len(inmask), step):
+        result[inmask[first:first + step]] = data2d[first:first + step]
+    nibabel.save(nibabel.Nifti1Pair(result.reshape(img.shape, order='F'), None, img.header), newfile)
+    return newfile
+
+
+def float_copy(fname, scratch, keep=None, inmask=None):
+    '''
+    copy a 4D NIfTI to an uncompressed float64 .nii, a volume at a time
+    keep : optional boolean ( T ) array of the volumes to copy
+    inmask : optional flat ( fortran order ) voxel indices to copy, the other
+             voxels are 0
+
+    returns the ( n_vox x T ) read/write memory map of the copy
+    '''
+    img = nibabel.load(fname)
+    if keep is None:
+        keep = np.ones(img.shape[3], dtype=bool)
+    keep = np.asarray(keep, dtype=bool)
+    shape = img.shape[:3] + (int(keep.sum()),)
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(np.float64)
+    hdr.set_zooms(img.header.get_zooms())
+    hdr.set_qform(img.affine, code=1)
+    hdr.set_sform(img.affine, code=1)
+    hdr['vox_offset'] = 352
+    with open(scratch, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00'*(352 - f.tell()))
+        if inmask is not None:
+            outside = np.ones(int(np.prod(shape[:3])), dtype=bool)
+            outside[inmask] = False
+        for vol, kept in zip(volumes(fname), keep):
+            if kept:
+                if inmask is not None:
+                    vol[outside] = 0
+                f.write(vol.astype('<f8').tobytes())
+    return np.memmap(scratch, dtype='<f8', mode='r+', offset=352,
+                     shape=(int(np.prod(shape[:3])), shape[3]), order='F')
+
+
+def process(fname, newfile, kernel, max_memory, inmask=None):
+    '''
+    kernel : function( block ) processing a ( n_vox x T ) float64 block in place
+    max_memory : bytes the blocks may use
+    inmask : optional flat ( fortran order ) indices of the only voxels to
+             process, the others are written as 0
+
+    runs kernel over fname a block at a time, rescales the result to 0..30000
+    and writes it to newfile with the header of fname, returns newfile
+    '''
+    img = nibabel.load(fname)
+    scratch = newfile + '.' + str(os.getpid()) + '.scratch.nii'
+    try:
+        data2d = float_copy(fname, scratch, inmask=inmask)
+        step = block_voxels(img.shape[3], max_memory)
+        mins = []
+        maxs = []
+        if inmask is None:
+            rows = [slice(first, first + step) for first in range(0, data2d.shape[0], step)]
+        else:
+            rows = [inmask[first:first + step] for first in range(0, len(inmask), step)]
+            if len(inmask) < data2d.shape[0]:
+                #the zeros outside the mask
+                mins.append(0.)
+                maxs.append(0.)
+        for these in rows:
+            block = np.array(data2d[these])
+            kernel(block)
+            #range of the result kept for the rescale, no extra pass over the map
+            mins.append(np.min(block))
+            maxs.append(np.max(block))
+            data2d[these] = block
+            del block
+        #scaled in chunks of volumes that fit the budget
+        rsstages.rescale(data2d, img.get_data_dtype(), chunk=max(1, int(max_memory // (8*data2d.shape[0]))),
+                         limits=(np.min(mins), np.max(maxs)))
+        #nibabel writes the map a volume at a time
+        nibabel.save(nibabel.Nifti1Pair(data2d.reshape(img.shape, order='F'), None, img.header), newfile)
+        del data2d
+    finally:
+        if os.path.isfile(scratch):
+            os.remove(scratch)
+    return newfile
+
+
+def select_volumes(fname, keep, newfile):
+    #write the keep ( boolean ) volumes of fname to newfile, with its header
+    img = nibabel.load(fname)
+    scratch = newfile + '.' + str(os.getpid()) + '.scratch.nii'
+    try:
+        data2d = float_copy(fname, scratch, keep)
+        shape = img.shape[:3] + (data2d.shape[1],)
+        nibabel.save(nibabel.Nifti1Pair(data2d.reshape(shape, order='F'), None, img.header), newfile)
+        del data2d
+    finally:
+        if os.path.isfile(scratch):
+            os.remove(scratch)
+    return newfile
+
+
+def dvars(fname, maskdata):
+    '''
+    DVARS of a 4D NIfTI within a 3D mask, reading 2 volumes at a time
+
+    returns the DVARS of every volume ( 0 for the first ) and the mean BOLD
+    signal within the mask
+    '''
+    inmask = np.flatnonzero(np.asarray(maskdata).reshape(-1, order='F') != 0)
+    dvars = [0.]
+    total = 0.
+    prev = None
+    for vol in volumes(fname):
+        vol = vol[inmask]
+        total += vol.sum()
+        if prev is not None:
+            dvars.append(np.sqrt(np.mean((vol - prev)**2)))
+        prev = vol
+    return np.array(dvars), total / (len(inmask)*len(dvars))
@@ -0,0 +1,198 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import numpy as np
+import multiprocessing
+
+'''
+
+Permutation engine for edgewise group statistics on stacked subject matrices
+Permutations are run in batches as matrix products: a ( batch x subject ) sign
+flip ( one-sample ) or group label ( two-sample ) matrix times the
+( subject x edge ) data gives the per edge sums of a whole batch at once.
+Batches are spread over a process pool, each batch drawing from its own child
+of a single numpy SeedSequence, so results only depend on the seed and batch
+size and not on the number of workers.  The maximum statistic of every permutation is kept
+for family-wise error correction in the same pass.
+
+'''
+
+def onesample_t(sums, sumsq, nsubj):
+    #t of the mean against 0 from per edge sums, works on stacks of permutations
+    mean = sums / nsubj
+    var = (sumsq - sums*mean) / (nsubj - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = mean / np.sqrt(var / nsubj)
+    return np.nan_to_num(t, posinf=0, neginf=0)
+
+
+def twosample_t(sums1, sumsq1, sums, sumsq, n1, n2):
+    #pooled variance t of group1 - group2, group2 sums are the totals minus group1
+    sums2 = sums - sums1
+    sumsq2 = sumsq - sumsq1
+    mean1 = sums1 / n1
+    mean2 = sums2 / n2
+    pooled = (sumsq1 - sums1*mean1 + sumsq2 - sums2*mean2) / (n1 + n2 - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (mean1 - mean2) / np.sqrt(pooled * (1.0/n1 + 1.0/n2))
+    return np.nan_to_num(t, posinf=0, neginf=0)
+
+
+def edge_tstats(edges, groups=None):
+    '''
+    edges : ( subject x edge ) array
+    groups : None for a one-sample test, or a boolean ( subject ) array marking group1
+
+    returns the t statistic of each edge and its degrees of freedom
+    '''
+    nsubj = edges.shape[0]
+    if groups is None:
+        return onesample_t(edges.sum(axis=0), (edges*edges).sum(axis=0), nsubj), nsubj - 1
+    groups = np.asarray(groups, dtype=bool)
+    g1 = edges[groups]
+    return twosample_t(g1.sum(axis=0), (g1*g1).sum(axis=0), edges.sum(axis=0), (edges*edges).sum(axis=0),
+                       groups.sum(), nsubj - groups.sum()), nsubj - 2
+
+
+def tail_stat(t, tail):
+    #orient the statistic so larger is always more significant
+    if tail == 'pos':
+        return t
+    elif tail == 'neg':
+        return -t
+    return np.abs(t)
+
+
+def sign_flips(rng, nperm, nsubj):
+    #( nperm x subject ) matrix of random +-1
+    return rng.choice([-1.0, 1.0], size=(nperm, nsubj))
+
+
+def relabellings(rng, nperm, nsubj, n1):
+    #( nperm x subject ) 0/1 matrix, each row a random choice of n1 subjects for group1
+    order = np.argsort(rng.random((nperm, nsubj)), axis=1)
+    labels = np.zeros((nperm, nsubj))
+    labels[np.arange(nperm)[:,np.newaxis], order[:,:n1]] = 1
+    return labels
+
+
+def _ratio(num, den):
+    #num / sqrt(den) in place on num, 0 where there is no variance
+    np.maximum(den, 0, out=den)
+    np.sqrt(den, out=den)
+    np.divide(num, den, out=num, where=den > 0)
+    num[den <= 0] = 0
+    return num
+
+
+class PermData:
+    """
+    The per edge sums that stay fixed across permutations, kept once per worker
+
+    The total sum of squares of every edge does not change under sign flips,
+    and once the edges are centered it does not change under relabelling
+    either ( the group2 sum is minus the group1 sum ), so the t statistics of
+    a batch only need the one ( batch x subject ) . ( subject x edge ) product.
+    """
+    def __init__(self, edges, groups=None):
+        self.nsubj = edges.shape[0]
+        self.groups = groups
+        if groups is None:
+            self.data = np.asarray(edges, dtype=np.float64)
+        else:
+            self.groups = np.asarray(groups, dtype=bool)
+            self.n1 = int(self.groups.sum())
+            #center each edge, group differences are unchanged
+            self.data = edges - np.mean(edges, axis=0)
+        self.sumsq = (self.data*self.data).sum(axis=0)
+
+    def tstats(self, rng, nperm):
+        #( nperm x edge ) permuted t statistics
+        nsubj = self.nsubj
+        if self.groups is None:
+            #t = ( s/n ) / sqrt( ( sumsq - s^2/n ) / ( n(n-1) ) )
+            sums = np.dot(sign_flips(rng, nperm, nsubj), self.data)
+            den = sums*sums
+            den *= -1.0/nsubj
+            den += self.sumsq
+            den *= 1.0/(nsubj*(nsubj - 1))
+            sums *= 1.0/nsubj
+            return _ratio(sums, den)
+        #t = c*s1 / sqrt( c*( sumsq - c*s1^2 ) / ( n-2 ) ), c = 1/n1 + 1/n2
+        c = 1.0/self.n1 + 1.0/(nsubj - self.n1)
+        sums1 = np.dot(relabellings(rng, nperm, nsubj, self.n1), self.data)
+        den = sums1*sums1
+        den *= -c
+        den += self.sumsq
+        den *= c/(nsubj - 2)
+        sums1 *= c
+        return _ratio(sums1, den)
+
+
+_worker = {}
+
+def _init_worker(edges, groups, observed, tail, reducer):
+    #edges can be the path of a .npy stack, which is memory-mapped instead of copied
+    if isinstance(edges, str):
+        edges = np.load(edges, mmap_mode='r')
+    _worker['data'] = PermData(edges, groups)
+    _worker['observed'] = observed
+    _worker['tail'] = tail
+    _worker['reducer'] = reducer
+
+
+def _run_batch(task):
+    nperm, seedseq = task
+    stat = tail_stat(_worker['data'].tstats(np.random.default_rng(seedseq), nperm), _worker['tail'])
+    exceed = (stat >= _worker['observed']).sum(axis=0)
+    extra = None
+    if _worker['reducer'] is not None:
+        extra = np.array([_worker['reducer'](row) for row in stat])
+    return stat.max(axis=1), exceed, extra
+
+
+def permutation_test(edges, groups=None, nperm=10000, tail='both', seed=0, batch=500, jobs=1, reducer=None):
+    '''
+    edges : ( subject x edge ) array, or the path of one saved with np.save
+    groups : None for a one-sample ( sign flip ) test, or a boolean ( subject )
+             array marking group1 for a two-sample ( relabelling ) test
+    tail : pos, neg or both
+    jobs : number of worker processes, None for all cores
+    reducer : optional function mapping one permutation's oriented statistics
+              to a number ( ie: largest NBS component ), must be picklable
+
+    returns t, uncorrected p, max-statistic FWE p, the null distribution of
+    the maximum statistic and of the reducer ( or None )
+    '''
+    if isinstance(edges, str):
+        t, df = edge_tstats(np.load(edges, mmap_mode='r'), groups)
+    else:
+        t, df = edge_tstats(edges, groups)
+    observed = tail_stat(t, tail)
+
+    sizes = [min(batch, nperm - first) for first in range(0, nperm, batch)]
+    tasks = list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+    initargs = (edges, groups, observed, tail, reducer)
+
+    if jobs == 1:
+        _init_worker(*initargs)
+        results = [_run_batch(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(jobs, _init_worker, initargs)
+        try:
+            results = pool.map(_run_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    nullmax = np.concatenate([res[0] for res in results])
+    exceed = np.sum([res[1] for res in results], axis=0)
+    nullextra = None
+    if reducer is not None:
+        nullextra = np.concatenate([res[2] for res in results])
+
+    punc = (exceed + 1.0) / (nperm + 1.0)
+    #number of permutations whose maximum reached each edge's statistic
+    sortedmax = np.sort(nullmax)
+    pfwe = (nperm - np.searchsorted(sortedmax, observed, side='left') + 1.0) / (nperm + 1.0)
+    return t, punc, pfwe, nullmax, nullextra
@@ -0,0 +1,164 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os, sys
+import json
+import time
+import resource
+import socket
+from contextlib import contextmanager
+from optparse import OptionParser
+
+'''
+
+Per step and per external command resource profile of resting_pipeline.py
+Every section records wall time, CPU time of the pipeline itself and of the
+commands it waited for ( resource.getrusage RUSAGE_SELF / RUSAGE_CHILDREN
+deltas ), the peak RSS so far, and the bytes read and written by the
+pipeline ( /proc/self/io ) and by its commands ( RUSAGE_CHILDREN block
+counts ).  RestPipe writes them to pipeline_profile.json in every subject's
+output directory; run this file on several of them to aggregate a batch.
+
+'''
+
+usage ="""
+pipeprofile.py [-o summary.json] subject1/pipeline_profile.json subject2/pipeline_profile.json ...
+
+Aggregates the pipeline_profile.json files of resting_pipeline.py runs: for every step and
+external command, the number of runs and the total, mean and maximum wall time, CPU time,
+peak RSS and bytes read/written.  A table is printed, and written as JSON with -o.
+"""
+
+parser = OptionParser(usage=usage)
+parser.add_option("-o", "--output",  action="store", type="string", dest="output",help="json file to write the aggregated profile to", metavar="FILE")
+
+#bytes per block of ru_inblock/ru_oublock
+BLOCKSIZE = 512
+
+
+def proc_io():
+    #bytes read and written by this process, 0 where /proc is not available
+    counts = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counts:
+                    counts[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counts
+
+
+def snapshot():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = proc_io()
+    return {'wall': time.time(),
+            'cpu': me.ru_utime + me.ru_stime,
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'peak_rss_kb': me.ru_maxrss,
+            'children_peak_rss_kb': children.ru_maxrss,
+            'read_bytes': io['read_bytes'],
+            'write_bytes': io['write_bytes'],
+            'children_read_bytes': children.ru_inblock * BLOCKSIZE,
+            'children_write_bytes': children.ru_oublock * BLOCKSIZE}
+
+
+def delta(before, after):
+    record = {}
+    for key in ['wall', 'cpu', 'children_cpu', 'read_bytes', 'write_bytes', 'children_read_bytes', 'children_write_bytes']:
+        record[key] = after[key] - before[key]
+    #peaks can only be reported as the peak so far
+    record['peak_rss_kb'] = after['peak_rss_kb']
+    record['peak_rss_growth_kb'] = after['peak_rss_kb'] - before['peak_rss_kb']
+    record['children_peak_rss_kb'] = after['children_peak_rss_kb']
+    return record
+
+
+class Profiler:
+    """
+    Collects one record per section, sections can nest ( ie: the commands
+    of a step are sections within the step's section )
+    """
+    def __init__(self):
+        self.records = []
+        self.started = snapshot()
+
+    @contextmanager
+    def section(self, kind, name, **info):
+        #yields the record, so the section can add to it
+        record = dict(info)
+        before = snapshot()
+        status = 'ok'
+        try:
+            yield record
+        except BaseException as err:
+            status = 'failed: ' + type(err).__name__
+            raise
+        finally:
+            record.update(delta(before, snapshot()))
+            record['kind'] = kind
+            record['name'] = name
+            record['status'] = status
+            self.records.append(record)
+
+    def write(self, fname, **info):
+        total = delta(self.started, snapshot())
+        profile = {'host': socket.gethostname(), 'pid': os.getpid(), 'argv': sys.argv,
+                   'total': total, 'records': self.records}
+        profile.update(info)
+        with open(fname, 'w') as f:
+            json.dump(profile, f, indent=1, sort_keys=True)
+        return fname
+
+
+def aggregate(fnames):
+    '''
+    combine pipeline_profile.json files, returns
+    { kind: { name: { 'runs': n, metric: { 'total', 'mean', 'max' } } } }
+    '''
+    metrics = ['wall', 'cpu', 'children_cpu', 'peak_rss_kb', 'children_peak_rss_kb',
+               'read_bytes', 'write_bytes', 'children_read_bytes', 'children_write_bytes']
+    summary = {}
+    for fname in fnames:
+        with open(fname, 'r') as f:
+            profile = json.load(f)
+        records = profile['records'] + [dict(profile['total'], kind='total', name='pipeline')]
+        for record in records:
+            entry = summary.setdefault(record['kind'], {}).setdefault(record['name'], {'runs': 0})
+            entry['runs'] += 1
+            for metric in metrics:
+                value = record.get(metric, 0)
+                stats = entry.setdefault(metric, {'total': 0, 'max': value})
+                stats['total'] += value
+                stats['max'] = max(stats['max'], value)
+    for kind in summary:
+        for entry in summary[kind].values():
+            for metric in metrics:
+                entry[metric]['mean'] = entry[metric]['total'] / float(entry['runs'])
+    return summary
+
+
+if __name__ == "__main__":
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        print("No profiles given. Try --help ")
+        raise SystemExit()
+    for fname in args:
+        if not os.path.isfile(fname):
+            print("File does not exist: " + fname)
+            raise SystemExit()
+
+    summary = aggregate(args)
+    print("%-8s %-20s %5s %10s %10s %10s %10s %12s %12s" % ('kind', 'name', 'runs', 'wall', 'max wall', 'cpu', 'child cpu', 'peak MB', 'written MB'))
+    for kind in ['total', 'step', 'command']:
+        for name in sorted(summary.get(kind, {})):
+            entry = summary[kind][name]
+            print("%-8s %-20s %5d %10.1f %10.1f %10.1f %10.1f %12.1f %12.1f" % (kind, name[:20], entry['runs'],
+                  entry['wall']['total'], entry['wall']['max'], entry['cpu']['total'], entry['children_cpu']['total'],
+                  entry['peak_rss_kb']['max'] / 1024., (entry['write_bytes']['total'] + entry['children_write_bytes']['total']) / 1048576.))
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
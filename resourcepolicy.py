@@ -0,0 +1,127 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import logging
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+'''
+
+Thread and CPU budget of a resting_pipeline.py run
+BLAS ( lstsq of steps 2 and 5, np.corrcoef of step 7b ) and OpenMP grab every
+core by default, so 16 subjects on a 16 core node run 256 threads.  A policy
+sets the BLAS/OpenMP thread count of this process ( threadpoolctl, when it is
+installed ) and, through the usual environment variables, of the FSL children,
+and pins the process to a set of CPUs, which the children inherit.
+
+    throughput - 1 thread per subject, run as many subjects as there are cores
+                 ( with --cpus, each subject on its own core )
+    latency - 1 subject on every allowed core ( or the --cpus )
+
+The slice workers of steps 2, 5 and 6 ( --sliceworkers, default the threads )
+each call BLAS, so the threads are shared among them: every worker gets
+threads // workers BLAS threads, at least 1, and ncpu workers never run ncpu
+BLAS threads each.
+
+'''
+
+PRESETS = ['throughput', 'latency']
+
+#read by OpenBLAS, MKL, Accelerate, OpenMP and numexpr when they load
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def allowed_cpus():
+    #cpus this process may run on
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpus(spec):
+    #taskset style list, ie: 0-3,8
+    cpus = set()
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    if not cpus:
+        raise ValueError("No CPUs in: " + spec)
+    return sorted(cpus)
+
+
+class ResourcePolicy(object):
+    """
+    preset : throughput, latency or None ( leave threads and affinity alone )
+    threads : BLAS/OpenMP threads, default is 1 for throughput and the number
+              of cpus for latency
+    cpus : cpus to pin to, default is no pinning
+    workers : python level workers sharing the threads, default is the threads
+    """
+    def __init__(self, preset=None, threads=None, cpus=None, workers=None):
+        if preset is not None and preset not in PRESETS:
+            raise ValueError("Unknown resource preset: " + preset)
+        self.preset = preset
+        if isinstance(cpus, str):
+            cpus = parse_cpus(cpus)
+        self.cpus = list(cpus) if cpus is not None else None
+        if threads is None and preset == 'throughput':
+            threads = 1
+        elif threads is None and preset == 'latency':
+            threads = len(self.cpus if self.cpus is not None else allowed_cpus())
+        self.threads = threads
+        self.slices = workers
+        self.limiter = None
+
+    def workers(self):
+        #python level workers, ie: slices processed at once
+        if self.slices is not None:
+            return self.slices
+        return self.threads if self.threads is not None else 1
+
+    def blas_threads(self):
+        #BLAS/OpenMP threads of every worker, None when threads are left alone
+        if self.threads is None:
+            return None
+        return max(1, self.threads // self.workers())
+
+    def env(self):
+        #thread variables for children, empty when threads are left alone
+        if self.threads is None:
+            return {}
+        return dict((var, str(self.blas_threads())) for var in THREAD_VARIABLES)
+
+    def apply(self):
+        '''
+        pin this process and set the thread counts of its thread pools and
+        children, returns self
+        '''
+        if self.cpus is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, self.cpus)
+            else:
+                logging.warning('cpu affinity is not supported here, --cpus ignored')
+        os.environ.update(self.env())
+        if self.threads is not None:
+            if threadpoolctl is not None:
+                self.limiter = threadpoolctl.threadpool_limits(limits=self.blas_threads())
+            else:
+                #BLAS read the variables when numpy loaded it, only the children get them
+                logging.warning('threadpoolctl is not installed: the BLAS threads of this process are only limited by '
+                                + ', '.join(THREAD_VARIABLES[:3]) + ' set before it started')
+        return self
+
+    def as_dict(self):
+        info = {'preset': self.preset, 'threads': self.threads, 'cpus': self.cpus,
+                'workers': self.workers(), 'blas_threads': self.blas_threads(),
+                'threadpoolctl': threadpoolctl is not None}
+        if threadpoolctl is not None:
+            info['threadpools'] = [dict((key, pool.get(key)) for key in ('user_api', 'internal_api', 'num_threads'))
+                                   for pool in threadpoolctl.threadpool_info()]
+        return info
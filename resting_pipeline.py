@@ -4,8 +4,7 @@
 import numpy as np
 import numpy.ma
 import nibabel
-from scipy import signal
-import os, sys, subprocess
+import os, sys
 import string, random
 import re
 import networkx as nx
@@ -14,6 +13,10 @@ import logging
 import math
 from scipy import ndimage as nd
 from shutil import copyfile
+import atlasregistry
+import pipeprofile
+import cmdrunner
+import resourcepolicy
 
 logging.basicConfig(format='%(asctime)s %(message)s ', datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 
@@ -31,13 +34,29 @@ Program to run through Nan-kuei Chen's resting state analysis pipeline:
     5 - regress out WM/CSF
     6 - lowpass filter
     7 - do parcellation and produce correlation matrix from label file
+      * with --fastpath, 5, 6 and 7a run fused as step 5-7a, reading the normalized run once
       * or split it up:
          7a - do parcellation from label file
          7b - produce correlation matrix [--func option is ignored if step 7b
               is run by itself unless --dvarsthreshold is specified, and
               --corrts overrides default location for input parcellation
               results (outputpath/corrlabel_ts.txt)]
+          * with --dynwindow, 7b also produces sliding-window correlation
+            matrices (dyn_r_matrix.npy, dyn_zr_matrix.npy)
     8 - functional connectivity density mapping
+    9 - seed-to-voxel correlation maps for ROIs of the correlation label file
+        ( --seeds, default is every ROI listed in --corrtext )
+    10 - voxel-level graph of the gray matter voxels, keeping edges above --voxthresh
+         and/or the --voxtopk strongest of each voxel ( voxelgraph_graph.bin/.weights
+         for community.py, voxelgraph_nodes.nii.gz maps nodes to voxels )
+    * 9 and 10 leave out the volumes scrubbed by --dvarsthreshold, --fdthreshold or
+      --motionthreshold, computed by whichever of 7b, 9 and 10 runs first
+
+Every run writes pipeline_profile.json to the output path: wall time, CPU time, peak memory
+and bytes read/written of each step and external command ( pipeprofile.py aggregates them )
+and pipeline_commands.json: argv, exit status, duration and output of every external command.
+External commands run without a shell; --cmdjobs runs the independent ones at the same time.
+A command that exits nonzero or times out stops the run at its step ( failed_step in the profile )
 
 """
 
@@ -61,7 +80,7 @@ parser.add_option("--refacpoint",  action="store", type="string", dest="refac",h
 parser.add_option("--betfval",  action="store", type="float", dest="betfval",help="f value to use while skull stripping. default is 0.4", metavar="0.4", default='0.4')
 parser.add_option("--anatbetfval",  action="store", type="float", dest="anatbetfval",help="f value to use while skull stripping ANAT. default is 0.5", metavar="0.5", default='0.5')
 parser.add_option("--lpfreq",  action="store", type="float", dest="lpfreq",help="frequency cutoff for lowpass filtering in HZ.  default is .08hz", metavar="0.08", default='0.08')
-parser.add_option("--corrlabel",  action="store", type="string", dest="corrlabel",help="pointer to 3D label containing ROIs for the correlation search. default is the 116 region AAL label file", metavar="FILE")
+parser.add_option("--corrlabel",  action="store", type="string", dest="corrlabel",help="pointer to 3D label containing ROIs for the correlation search, or an atlas name ( aal116, raichle36, aal_no_cerebelum ). default is the 116 region AAL label file", metavar="FILE")
 parser.add_option("--corrtext",  action="store", type="string", dest="corrtext",help="pointer to text file containing names/indices for ROIs for the correlation search. default is the 116 region AAL label txt file", metavar="FILE")
 parser.add_option("--corrts",  action="store", type="string", dest="corrts",help="If using step 7b by itself, this is the path to parcellation output (default is to use OUTPATH/corrlabel_ts.txt), which will be used as input to the correlation.", metavar="FILE")
 parser.add_option("--dvarsthreshold",  action="store", type="string", dest="dvarsthreshold",help="If specified, this reprsents a DVARS threshold either in BOLD units, or if ending in a '%' character, as a percentage of mean global signal intensity (over the brain mask).  Any volume contributing to a DVARS value greater than this threshold will be excluded (\"scrubbed\") from the (final) correlation step.  DVARS calculation is performed on the results of the last pre-processing step, and is calculated as described by Power, J.D., et al., \"Spurious but systematic correlations in functional connectivity MRI networks arise from subject motion\", NeuroImage(2011).  Note: data is only excluded during the final correlation, and so will never affect any operations that require the full signal, like regression, etc.", metavar="THRESH")
@@ -74,7 +93,26 @@ parser.add_option("--motionpar",  action="store", type="string", dest="motionpar
 parser.add_option("--scrubop",  action="store", choices=('and', 'or'), dest="scrubop", help="If --motionthreshold, --dvarsthreshold, or --fdthreshold are specified, then --scrubop specifies the aggregation operator used to determine the final list of excluded volumes.  Default is 'or', which means a volume will be excluded if *any* of its thresholds are exceeded, whereas 'and' means all the thresholds must be exceeded to be excluded.")
 parser.add_option("--powerscrub", action="store_true", dest="powerscrub", help="Equivalent to specifying --fdthreshold=0.5 --fdnumneighbors=0 --dvarsthreshold=0.5% --dvarsnumneigbhors=0 --scrubop='and', to mimic the method used in the Power et al. article.  Any conflicting options specified before or after this will override these.", default=False)
 parser.add_option("--scrubkeepminvols",  action="store", type="int", dest="scrubkeepminvols",help="If --motionthreshold, --dvarsthreshold, or --fdthreshold are specified, then --scrubminvols specifies the minimum number of volumes that should pass the threshold before doing any correlation.  If the minimum is not met, then the script exits with an error.  Default is to have no minimum.", metavar="NUMVOLS")
+parser.add_option("--dynwindow",  action="store", type="int", dest="dynwindow",help="If specified, step 7b also computes sliding-window (dynamic) correlation matrices over windows of this many volumes.  Scrubbed volumes are left out of each window.  Results are stored as window x roi x roi arrays in dyn_r_matrix.npy and dyn_zr_matrix.npy, with window start/end/volume counts in dyn_windows.txt", metavar="NUMVOLS")
+parser.add_option("--dynstep",  action="store", type="int", dest="dynstep",help="If --dynwindow is specified, the number of volumes the window advances between matrices.  Default is 1.", metavar="NUMVOLS", default=1)
+parser.add_option("--seeds",  action="store", type="string", dest="seeds",help="comma seperated list of ROI indices ( from --corrlabel ) to use as seeds for the seed-to-voxel correlation maps in step 9.  Default is every ROI in --corrtext.", metavar="1,2,3")
+parser.add_option("--seedchunk",  action="store", type="int", dest="seedchunk",help="number of voxels correlated with the seeds at a time in step 9, lower this to save memory.  Default is all in-mask voxels at once.", metavar="NUMVOXELS")
+parser.add_option("--voxthresh",  action="store", type="float", dest="voxthresh",help="R-value threshold for the edges of the voxel-level graph in step 10, at least 0 ( only positive correlations are edges ).  Default is 0.6 unless --voxtopk is given.", metavar="THRESH")
+parser.add_option("--voxtopk",  action="store", type="int", dest="voxtopk",help="keep the this many strongest edges of every voxel in the voxel-level graph of step 10 ( an edge is kept when it is among the strongest of either voxel ).", metavar="NUMEDGES")
+parser.add_option("--voxblock",  action="store", type="int", dest="voxblock",help="number of voxels correlated at a time in step 10, lower this to save memory.  Default keeps each block of correlations around 256MB.", metavar="NUMVOXELS")
 parser.add_option("--fcdmthresh",  action="store", type="float", dest="fcdmthresh",help="R-value threshold to be used in functional connectivity density mapping ( step8 ). Default is set to 0.6. Algorithm from Tomasi et al, PNAS(2010), vol. 107, no. 21. Calculates the fcdm of functional data from last completed step, inside a dilated gray matter mask", metavar="THRESH", default=0.6)
+parser.add_option("--backend",  action="store", choices=('fsl', 'standin'), dest="backend",help="tools to run the FSL/BXH commands with: 'fsl' ( default ) runs the installed tools, 'standin' the nibabel/numpy stand-ins of fslstandin.py, for timing and testing the pipeline without FSL", default='fsl')
+parser.add_option("--cmdjobs",  action="store", type="int", dest="cmdjobs",help="number of independent external commands ( ie: the WM and CSF fslmeants ) run at once.  Default is 1.", metavar="1", default=1)
+parser.add_option("--cmdtimeout",  action="store", type="float", dest="cmdtimeout",help="seconds before an external command is killed.  Default is no timeout.", metavar="SECONDS")
+parser.add_option("--dryrun",  action="store", type="string", dest="dryrun",help="write the plan of every external command ( argv, step, and a group id shared by commands that can run at once ) to this json file without running FSL/BXH: the steps run with the fslstandin.py stand-ins ( --backend standin ), so point --outpath at a scratch directory", metavar="FILE")
+parser.add_option("--resources",  action="store", choices=tuple(resourcepolicy.PRESETS), dest="resources",help="thread budget of the run: 'throughput' gives BLAS/OpenMP and the FSL children 1 thread, for running as many subjects as cores, 'latency' gives them every allowed core ( or --cpus ).  Default leaves them alone.", metavar="throughput")
+parser.add_option("--threads",  action="store", type="int", dest="threads",help="BLAS/OpenMP threads, overrides the --resources preset.  The --sliceworkers share them, each gets threads // sliceworkers ( at least 1 )", metavar="1")
+parser.add_option("--cpus",  action="store", type="string", dest="cpus",help="pin the run and its FSL children to these cpus, taskset style ( ie: 0-3,8 )", metavar="0-3")
+parser.add_option("--sliceworkers",  action="store", type="int", dest="sliceworkers",help="slices steps 2, 5 and 6 process at once on threads, results are the same for any number.  Default is the --threads of --resources ( 1 for throughput, one per cpu for latency, each then running 1 BLAS thread ), 1 without them.", metavar="1")
+parser.add_option("--max-memory",  action="store", type="string", dest="maxmemory",help="run steps 2, 5 and 6 and the DVARS of scrubbing out-of-core: the data is copied to an uncompressed float64 scratch .nii in the output path ( 8 bytes per voxel and volume of disk ) and processed in blocks of voxels that fit in this much memory ( ie: 4G, 512M ).  Results agree with the default in-memory mode to rounding.  --sliceworkers does not apply.", metavar="4G")
+parser.add_option("--maskedcompute",  action="store_true", dest="maskedcompute",help="steps 5 and 6 only process the voxels inside the brain mask ( mean_func_brain_mask after step 3, --refbrainmask after step 4 or when resuming from step 5 ) and zero the voxels outside of it, like fslmaths -mas.  In the functional space step 3 already zeroed them, but after normalization the voxels outside --refbrainmask are not zero: masking changes them, and so the 0..30000 rescale range.", default=False)
+parser.add_option("--fastpath",  action="store_true", dest="fastpath",help="run steps 5, 6 and 7a as one step ( 5-7a, see fastpath.py ): the normalized run is read once and only the WM/CSF and label time series are written.  The label time series agree with the separate steps to rounding.  Memory peaks at the run in float64 ( the brain voxels only with --maskedcompute, a memory map with --max-memory ) plus the voxel blocks, like step 6.", default=False)
+parser.add_option("--fastpath-keep",  action="store_true", dest="fastpathkeep",help="with --fastpath, also write the filtered run ( filt_*_wmcsf.nii.gz and filt_mean ) like step 6.  Implied by --dvarsthreshold and steps 8, 9 and 10, which read it.", default=False)
 parser.add_option("--cleanup",  action="store_true", dest="cleanup",help="delete files from intermediate steps?")
 
 print(("Command-line: " + " ".join([repr(x) for x in sys.argv])))
@@ -96,34 +134,177 @@ if not (options.funcfile) or '-help' in sys.argv:
 
 class RestPipe:
     def __init__(self):
-        self.initialize()
-        for i in self.steps:
-            logging.info('starting step' + i)
-            if i == '0':
-                self.step0()
-            elif i == '1':
-                self.step1()
-            elif i == '2':
-                self.step2()
-            elif i == '3':
-                self.step3()
-            elif i == '4':
-                self.step4()
-            elif i == '5':
-                self.step5()
-            elif i == '6':
-                self.step6()
-            elif i == '7a':
-                self.step7a()
-            elif i == '7b':
-                self.step7b()
-            elif i == '7':
-                self.step7()
-            elif i == '8':
-                self.step8()
-
-        if options.cleanup is not None:
-            self.cleanup()
+        self.resources = resourcepolicy.ResourcePolicy(options.resources, options.threads, options.cpus,
+                                                       options.sliceworkers).apply()
+        options.sliceworkers = self.resources.workers()
+        self.profile = pipeprofile.Profiler()
+        self.backend = options.backend
+        if options.dryrun is not None:
+            self.backend = 'standin'
+        executor = None
+        if self.backend == 'standin':
+            import fslstandin
+            executor = fslstandin.execute
+        self.runner = cmdrunner.CommandRunner(options.cmdjobs, options.cmdtimeout, executor)
+        self.currentstep = 'init'
+        self.failedstep = None
+        self.outpath = None
+        try:
+            self.initialize()
+            for i in self.steps:
+                logging.info('starting step' + i)
+                self.currentstep = i
+                with self.profile.section('step', i):
+                    if i == '0':
+                        self.step0()
+                    elif i == '1':
+                        self.step1()
+                    elif i == '2':
+                        self.step2()
+                    elif i == '3':
+                        self.step3()
+                    elif i == '4':
+                        self.step4()
+                    elif i == '5':
+                        self.step5()
+                    elif i == '6':
+                        self.step6()
+                    elif i == '5-7a':
+                        self.step5_7a()
+                    elif i == '7a':
+                        self.step7a()
+                    elif i == '7b':
+                        self.step7b()
+                    elif i == '7':
+                        self.step7()
+                    elif i == '8':
+                        self.step8()
+                    elif i == '9':
+                        self.step9()
+                    elif i == '10':
+                        self.step10()
+
+            if options.cleanup is not None:
+                self.cleanup()
+        finally:
+            #written also when a step fails, the failed step is marked in it
+            if self.outpath is not None and os.path.isdir(self.outpath):
+                self.profile.write(os.path.join(self.outpath,'pipeline_profile.json'), steps=getattr(self, 'steps', []),
+                                   resources=self.resources.as_dict(), failed_step=self.failedstep)
+                self.runner.write(os.path.join(self.outpath,'pipeline_commands.json'), backend=self.backend)
+            if options.dryrun is not None:
+                self.runner.write(options.dryrun, backend=self.backend, dryrun=True)
+
+
+    def voxel_step(self, newfile, slices, voxels, masked=True):
+        '''
+        run a numpy step on self.thisnii, rescale the result to 0..30000 and
+        write it to newfile with the same header
+
+        slices : function( data1 ) of the whole 4D float64 data, returns the
+                 result ( ie: rsstages.regress_slices )
+        voxels : function( block ) of a ( n_vox x T ) block, in place, run
+                 out-of-core ( --max-memory ) or on the brain voxels only
+                 ( --maskedcompute, the other voxels are written as 0 )
+        masked : False computes every voxel even with --maskedcompute
+        '''
+        import rsstages
+        data = nibabel.nifti1.load(self.thisnii)
+        inmask = None
+        if masked:
+            inmask = self.compute_mask(data.shape[:3])
+        if self.maxmemory is not None:
+            import outofcore
+            outofcore.process(self.thisnii, newfile, voxels, self.maxmemory, inmask)
+            return newfile
+        if inmask is not None:
+            import outofcore
+            logging.info('computing %d of %d voxels' % (len(inmask), np.prod(data.shape[:3])))
+            data2d = rsstages.map_blocks(voxels, outofcore.gather(self.thisnii, inmask), options.sliceworkers)
+            #the range includes the zeros outside the mask
+            limits = rsstages.value_range(data2d, workers=options.sliceworkers)
+            if len(inmask) < np.prod(data.shape[:3]):
+                limits = (min(limits[0], 0.), max(limits[1], 0.))
+            rsstages.rescale(data2d, data.get_data_dtype(), limits=limits, workers=options.sliceworkers)
+            outofcore.scatter(data2d, inmask, data, limits, newfile)
+            return newfile
+        #load nifti data
+        data1 = data.get_fdata()
+        result = slices(data1)
+        del data1
+        # in-place (-=, *=) operations should save memory
+        rsstages.rescale(result, data.get_data_dtype(), workers=options.sliceworkers)
+        newNii = nibabel.Nifti1Pair(result,None,data.header)
+        nibabel.save(newNii,newfile)
+        return newfile
+
+
+    def compute_mask(self, shape):
+        '''
+        flat ( fortran order ) indices of the brain voxels of the current data
+        for --maskedcompute: the mean_func_brain_mask of step 3, then the
+        --refbrainmask once step 4 normalized the data.  None computes every
+        voxel
+        '''
+        if not options.maskedcompute or self.maskspace is None:
+            return None
+        if self.maskspace == 'ref':
+            maskfile = self.refbrainmask
+        else:
+            maskfile = os.path.join(self.outpath,'mean_func_brain_mask.nii.gz')
+        if not os.path.isfile(maskfile):
+            logging.info('no brain mask to restrict the computation to: ' + maskfile)
+            return None
+        if self.maskspace == 'ref':
+            maskdata = atlasregistry.data(maskfile)
+        else:
+            maskdata = np.asanyarray(nibabel.load(maskfile).dataobj)
+        if maskdata.shape != tuple(shape):
+            logging.info('brain mask and data are different shapes, computing every voxel: ' + maskfile)
+            return None
+        return np.flatnonzero(maskdata.reshape(-1, order='F') != 0)
+
+
+    def run_command(self, thisprocstr):
+        #run an external command, timed in the profile, returns its exit status
+        return self.run_commands([thisprocstr])[0].returncode
+
+
+    def run_commands(self, thisprocstrs):
+        '''
+        run independent external commands, --cmdjobs at a time, without a
+        shell.  Failures and output are logged, exit status, duration and
+        output are kept for pipeline_commands.json.  A nonzero exit status or
+        a timeout stops the step, like its missing outputs would
+
+        returns the cmdrunner.CommandResult of every command
+        '''
+        for thisprocstr in thisprocstrs:
+            logging.info('running: ' + thisprocstr)
+        name = '+'.join(sorted(set([thisprocstr.split()[0] for thisprocstr in thisprocstrs])))
+        with self.profile.section('command', name, command=' ; '.join(thisprocstrs)) as record:
+            results = self.runner.run_all(thisprocstrs, tag=self.currentstep)
+            record['returncodes'] = [result.returncode for result in results]
+            for result in results:
+                cmdrunner.log_result(result)
+            failed = [result for result in results if not result.ok()]
+            if failed:
+                self.failedstep = self.currentstep
+                logging.error('step ' + self.currentstep + ' failed: ' + failed[0].argv[0] +
+                              (' timed out' if failed[0].timed_out else ' exited with ' + str(failed[0].returncode)))
+                raise SystemExit()
+        return results
+
+
+    def command_output(self, argv):
+        #run an external command, returns what it printed
+        logging.info('running: ' + ' '.join(argv))
+        with self.profile.section('command', argv[0], command=' '.join(argv)) as record:
+            result = self.runner.run(argv, tag=self.currentstep)
+            record['returncodes'] = [result.returncode]
+        if not result.ok():
+            cmdrunner.log_result(result)
+        return result.stdout.encode('utf-8')
 
 
     def initialize(self):
@@ -136,6 +317,21 @@ class RestPipe:
             for i in range(len(self.steps)):
                 self.steps[i] = str(self.steps[i])
 
+        #fused 5, 6 and 7a
+        self.fastpathkeep = False
+        if options.fastpath:
+            if '5' not in self.steps or '6' not in self.steps or ('7' not in self.steps and '7a' not in self.steps):
+                logging.info("--fastpath replaces steps 5, 6 and 7a, they must all be run ( ie: --steps 5,6,7 ).")
+                raise SystemExit()
+            fused = self.steps.index('5')
+            self.steps = [step for step in self.steps if step not in ('5', '6', '7a')]
+            self.steps.insert(fused, '5-7a')
+            if '7' in self.steps:
+                self.steps[self.steps.index('7')] = '7b'
+            #scrubbing by DVARS and steps 8-10 read the filtered run
+            self.fastpathkeep = (options.fastpathkeep or options.dvarsthreshold is not None or options.powerscrub
+                                 or len([step for step in ['8', '9', '10'] if step in self.steps]) > 0)
+
         self.needfunc = True
         if len(self.steps) == 1 and '7b' in self.steps:
             self.needfunc = False
@@ -163,7 +359,7 @@ class RestPipe:
                     self.t1bxh = str(options.anatfile)
                 elif fileExt == '.gz' or fileExt == '.nii':
                     self.t1nii = str(options.anatfile)
-                    thisproc = subprocess.Popen(["fslwrapbxh " + self.t1nii],shell=True).wait()
+                    self.run_command("fslwrapbxh " + self.t1nii)
                     extInd = None
                     if self.t1nii[-4:] == '.nii':
                         extInd = -4
@@ -224,21 +420,21 @@ class RestPipe:
             self.refac = str(options.refac)
             self.refbrainmask = str(options.refbrainmask)
         else:
-            self.flirtref = os.path.join(os.environ['FSLDIR'],'data','standard','MNI152_T1_2mm_brain.nii.gz')
+            self.flirtref = atlasregistry.resolve('mni_brain')
             # self.refwm = os.path.join(os.environ['FSLDIR'],'data','standard','MNI152_T1_2mm_brain_pve_2.nii.gz')
             # self.refcsf = os.path.join(os.environ['FSLDIR'],'data','standard','MNI152_T1_2mm_brain_pve_0.nii.gz')
             # self.refgm = os.path.join(os.environ['FSLDIR'],'data','standard','MNI152_T1_2mm_brain_pve_1.nii.gz')
-            self.refwm = os.path.join(self.basedir,'data','MNI152_T1_2mm_brain_pve_2.nii.gz')
-            self.refcsf = os.path.join(self.basedir,'data','MNI152_T1_2mm_brain_pve_0.nii.gz')
-            self.refgm = os.path.join(self.basedir,'data','MNI152_T1_2mm_brain_pve_1.nii.gz')
+            self.refwm = atlasregistry.resolve('mni_wm')
+            self.refcsf = atlasregistry.resolve('mni_csf')
+            self.refgm = atlasregistry.resolve('mni_gm')
 
             self.refac = str(options.refac)
-            self.refbrainmask = os.path.join(os.environ['FSLDIR'],'data','standard','MNI152_T1_2mm_brain_mask.nii.gz')
+            self.refbrainmask = atlasregistry.resolve('mni_brain_mask')
 
         if ( '0' in self.steps ) and (self.origbxh is None) and ( self.thisnii is not None ):
             if self.tr_ms is not None:
                 logging.info('requesting step0, but no bxh provided.  Creating one from ' + self.thisnii )
-                thisproc = subprocess.Popen(["fslwrapbxh " + self.thisnii],shell=True).wait()
+                self.run_command("fslwrapbxh " + self.thisnii)
 
                 tmpfname = re.split('(\.nii$|\.nii\.gz$)',self.thisnii)[0] + ".bxh"
 
@@ -254,6 +450,11 @@ class RestPipe:
 
         #grab correlation label, or assign the AAL brain
         if options.corrlabel is not None:
+            #registry atlases ( ie: raichle36 ) come with their text file
+            if options.corrlabel in atlasregistry.REFERENCES:
+                if options.corrtext is None:
+                    options.corrtext = atlasregistry.label_text(options.corrlabel)
+                options.corrlabel = atlasregistry.resolve(options.corrlabel)
             if options.corrtext is None:
                 raise SystemExit("If --corrlabel is specified, --corrtext must also be specified.")
             if not ( os.path.isfile(options.corrlabel) ):
@@ -266,8 +467,8 @@ class RestPipe:
                 self.corrlabel = str(options.corrlabel)
                 self.corrtext  = str(options.corrtext)
         else:
-            self.corrlabel = os.path.join(self.basedir,'data','aal_MNI_V4.nii')
-            self.corrtext = os.path.join(self.basedir,'data','aal_MNI_V4.txt')
+            self.corrlabel = atlasregistry.resolve('aal116')
+            self.corrtext = atlasregistry.label_text('aal116')
             # self.corrlabel = os.path.join('/usr','local','packages','MATLAB','WFU_PickAtlas_3.0.1','wfu_pickatlas','MNI_atlas_templates','aal_MNI_V4.nii')
             # self.corrtext = os.path.join('/usr','local','packages','MATLAB','WFU_PickAtlas_3.0.1','wfu_pickatlas','MNI_atlas_templates','aal_MNI_V4.txt')
 
@@ -345,6 +546,54 @@ class RestPipe:
         if options.fcdmthresh is not None:
             self.fcdmthresh = float(options.fcdmthresh)
 
+        #sliding window correlation
+        self.dynwindow = options.dynwindow
+        self.dynstep = options.dynstep
+        if self.dynwindow is not None and (self.dynwindow < 3 or self.dynstep < 1):
+            logging.info("--dynwindow must be at least 3 volumes and --dynstep at least 1.")
+            raise SystemExit()
+        self.scrubmask = None
+        self.scrubbednii = None
+
+        #seed-to-voxel maps
+        self.seeds = None
+        if options.seeds is not None:
+            try:
+                self.seeds = [int(seed) for seed in options.seeds.split(',')]
+            except ValueError:
+                logging.error("--seeds must be a comma seperated list of ROI indices")
+                raise SystemExit()
+        self.seedchunk = options.seedchunk
+
+        #out-of-core numpy steps
+        self.maxmemory = None
+        if options.maxmemory is not None:
+            import outofcore
+            try:
+                self.maxmemory = outofcore.parse_memory(options.maxmemory)
+            except ValueError:
+                logging.error("--max-memory must be a size like 4G, 512M or a number of bytes")
+                raise SystemExit()
+
+        #space of the brain mask for --maskedcompute, set by steps 3 and 4
+        self.maskspace = None
+        if not [ step for step in ['0', '1', '2', '3', '4'] if step in self.steps ]:
+            #resuming on normalized data
+            self.maskspace = 'ref'
+
+        #voxel-level graph
+        self.voxthresh = options.voxthresh
+        self.voxtopk = options.voxtopk
+        if self.voxthresh is None and self.voxtopk is None:
+            self.voxthresh = 0.6
+        if self.voxtopk is not None and self.voxtopk < 1:
+            logging.info("--voxtopk must be at least 1.")
+            raise SystemExit()
+        if self.voxthresh is not None and self.voxthresh < 0:
+            logging.info("--voxthresh must be at least 0, negative correlations are not graph edges.")
+            raise SystemExit()
+        self.voxblock = options.voxblock
+
         #array for files to delete later
         self.toclean = []
         self.slicefile = None
@@ -364,6 +613,13 @@ class RestPipe:
                 print(("File does not exist: " + fname))
                 raise SystemExit()
 
+        #make the decompressed local copies of the references, shared by every subject
+        #the given paths are kept for the logs and subject.graphml, the copies are what
+        #gets read or handed to the tools
+        for fname in [self.flirtref, self.refwm, self.refcsf, self.corrlabel, self.refgm, self.refbrainmask]:
+            if os.path.isfile(fname):
+                atlasregistry.cached(fname)
+
         #place to put temp stuff
         if ( os.getenv('TMPDIR') ):
             self.tmpdir = os.getenv('TMPDIR')
@@ -376,8 +632,7 @@ class RestPipe:
             #first try to get slicetiming
             try:
                 tempst = os.path.join(self.tmpdir,'slicetiming.txt')
-                popenobj = subprocess.Popen(['bxh_slicetiming','--fsl',self.origbxh,tempst], stdout=subprocess.PIPE)
-                (stdoutdata, stderrdata) = popenobj.communicate()
+                stdoutdata = self.command_output(['bxh_slicetiming','--fsl',self.origbxh,tempst])
                 lines = stdoutdata.splitlines()
                 if os.path.isfile(tempst):
                     self.slicefile = os.path.abspath(tempst)
@@ -385,8 +640,7 @@ class RestPipe:
             except Exception as e:
                 logging.error("could not produce slicetiming, will try slice order")
 
-            popenobj = subprocess.Popen(['dumpheader', self.origbxh], stdout=subprocess.PIPE)
-            (stdoutdata, stderrdata) = popenobj.communicate()
+            stdoutdata = self.command_output(['dumpheader', self.origbxh])
             lines = stdoutdata.splitlines()
             for line in lines:
                 willrotate = False
@@ -467,7 +721,7 @@ class RestPipe:
                 else:
                     logging.info("Functional data has incorrect dimensions. Expected 4D, received : " + str(len(thisshape)) + " D")
                     raise SystemExit()
-            elif ( [ step for step in ['0', '1', '5', '6'] if step in self.steps ] ):
+            elif ( [ step for step in ['0', '1', '5', '6', '5-7a'] if step in self.steps ] ):
                 logging.info("Please provide --tr option when starting from nifti, we don't trust TR derrived from existing nifti files.")
                 raise SystemExit()
 
@@ -486,7 +740,7 @@ class RestPipe:
                 newfile = os.path.join(self.outpath,self.prefix)
                 #thisprocstr = str("bxh2analyze --overwrite --niigz -s " + self.origbxh + " " + newfile)
                 thisprocstr = str("bxhselect --overwrite " + self.origbxh + " " + newfile + ".bxh")
-                subprocess.Popen(thisprocstr,shell=True).wait()
+                self.run_command(thisprocstr)
                 if os.path.isfile(newfile + ".nii.gz"):
                     self.thisnii = newfile + ".nii.gz"
 
@@ -495,7 +749,7 @@ class RestPipe:
                 newfile = os.path.join(self.outpath,fileName)
                 #thisprocstr = str("bxh2analyze --overwrite --niigz -s " + self.t1bxh + " " + newfile)
                 thisprocstr = str("bxhselect --overwrite " + self.t1bxh + " " + newfile + ".bxh")
-                subprocess.Popen(thisprocstr,shell=True).wait()
+                self.run_command(thisprocstr)
                 if os.path.isfile(newfile + ".nii.gz"):
                     self.t1nii = newfile + ".nii.gz"
 
@@ -610,14 +864,12 @@ class RestPipe:
         logging.info('converting functional data')
         tempfile = os.path.join(self.tmpdir,''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(10)) + '.bxh')
         thisprocstr = str("bxhreorient --orientation=LAS " + self.origbxh + " " + tempfile)
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         if self.throwaway is not None:
             logging.info('disregarding acquisitions')
             thisprocstr = str("bxhselect --overwrite --timeselect " + str(self.throwaway) + ": " + tempfile + " " + tempfile)
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
             self.tdim = self.tdim - self.throwaway
 
         if os.path.isfile(tempfile):
@@ -625,8 +877,7 @@ class RestPipe:
             newfile = os.path.join(self.outpath,newprefix)
             #thisprocstr = str("bxh2analyze --overwrite --niigz -s " + tempfile + " " + newfile)
             thisprocstr = str("bxhselect --overwrite " + tempfile + " " + newfile + ".bxh")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
             if os.path.isfile(newfile + ".nii.gz"):
                 self.thisnii = newfile + ".nii.gz"
                 self.prevprefix = self.prefix
@@ -643,8 +894,7 @@ class RestPipe:
             newprefix = "t1_LAS"
             newfile = os.path.join(self.outpath,newprefix)
             thisprocstr = str("bxhreorient --orientation=LAS " + self.t1bxh + " " + newfile + ".bxh")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
 
             if os.path.isfile(newfile + ".nii.gz"):
                 self.t1nii = newfile + ".nii.gz"
@@ -670,8 +920,7 @@ class RestPipe:
             raise SystemExit()
 
         thisprocstr = str("slicetimer -i " + self.thisnii + " -o " + newfile + " -r " +  str(self.tr_ms/1000) + fslst_type + self.slicefile)
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         if os.path.isfile(newfile + ".nii.gz"):
             if self.prevprefix is not None:
@@ -686,13 +935,13 @@ class RestPipe:
 
     #run motion correction
     def step2(self):
+        import rsstages
         logging.info('motion correcting correcting data')
         newprefix = self.prefix + '_mcf'
         newfile = os.path.join(self.outpath,newprefix)
 
         thisprocstr = str("mcflirt -in " + self.thisnii + " -o " + newfile + " -plots")
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         if os.path.isfile(newfile + ".nii.gz") and os.path.isfile(newfile + ".par"):
             if self.prevprefix is not None:
@@ -703,52 +952,24 @@ class RestPipe:
             self.mcparams = newfile + ".par"
             logging.info('motion correction successful: ' + self.thisnii )
 
-            thisprocstr = str("fsl_tsplot -i " + self.mcparams +  " -t 'MCFLIRT estimated rotations (radians)' -u 1 --start=1 --finish=3 -a x,y,z -w 640 -h 144 -o " + newfile + "_rot.png")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
-            thisprocstr = str("fsl_tsplot -i " + self.mcparams +  " -t 'MCFLIRT estimated translations (mm)' -u 1 --start=4 --finish=6 -a x,y,z -w 640 -h 144 -o " + newfile + "_trans.png")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            rotplot = str("fsl_tsplot -i " + self.mcparams +  " -t 'MCFLIRT estimated rotations (radians)' -u 1 --start=1 --finish=3 -a x,y,z -w 640 -h 144 -o " + newfile + "_rot.png")
+            transplot = str("fsl_tsplot -i " + self.mcparams +  " -t 'MCFLIRT estimated translations (mm)' -u 1 --start=4 --finish=6 -a x,y,z -w 640 -h 144 -o " + newfile + "_trans.png")
+            self.run_commands([rotplot, transplot])
 
             logging.info('regressing out motion correction parameters')
 
             #load mcflirt params
             params = np.loadtxt(self.mcparams,unpack=True)
-            #load nifti data
-            data = nibabel.nifti1.load(self.thisnii)
-            data1 = data.get_fdata()
 
             #create regressors
-            X = []
-            for index in range(6):
-                X.append(np.vstack([np.ones(self.tdim), params[index]]).T)
-
-            logging.info('starting linear regression')
-            tmp_mean = np.mean(data1, axis=3, dtype=data1.dtype)
-            shape = data1.shape
-            data1v = data1.reshape((shape[0]*shape[1], shape[2], shape[3])).transpose((1, 2, 0))
-            # data1v is a view in z, t, x*y order
-            # go slice-by-slice
-            for cntz in range(self.zdim):
-                tmp_data = data1v[cntz]
-                for index in range(6):
-                    p0 = np.linalg.lstsq(X[index], tmp_data, rcond=-1)[0]
-                    p00 = np.dot(X[index], p0) #product
-                    tmp_data = tmp_data - p00
-                data1v[cntz] = tmp_data
-
-            data_mr = data1v.transpose((2, 0, 1)).reshape(shape)
-            del data1v
-            del data1
-            # in-place (-=, *=) operations should save memory
-            data_mr += tmp_mean.reshape(tmp_mean.shape + (1,))
-            data_mr -= np.min(data_mr)
-            data_mr *= (30000.0 / np.max(data_mr)).astype(data.get_data_dtype())
-            newNii = nibabel.Nifti1Pair(data_mr,None,data.header)
+            X = rsstages.designs(params[0:6])
 
             newprefix = self.prefix + 'r'
             newfile = os.path.join(self.outpath, (newprefix + ".nii.gz"))
-            nibabel.save(newNii,newfile)
+            logging.info('starting linear regression')
+            #there is no brain mask before step 3
+            self.voxel_step(newfile, lambda data1: rsstages.regress_slices(data1, X, options.sliceworkers),
+                            lambda block: rsstages.regress_voxels(block, X), masked=False)
             if os.path.isfile(newfile):
                 if self.prevprefix is not None:
                     self.toclean.append( self.thisnii )
@@ -771,18 +992,15 @@ class RestPipe:
 
         #first create mean_func
         thisprocstr = str("fslmaths " + self.thisnii + " -Tmean " + os.path.join(self.outpath,'mean_func') )
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         #now skull strip the mean
         thisprocstr = "bet " + os.path.join(self.outpath,'mean_func') + " " + os.path.join(self.outpath,'mean_func_brain') + " -f " + str(self.betfval) + " -m"
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         #now mask full run by results
         thisprocstr = str("fslmaths " + self.thisnii + " -mas " + os.path.join(self.outpath,'mean_func_brain_mask') + " " + newfile)
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        self.run_command(thisprocstr)
 
         if os.path.isfile( newfile + ".nii.gz" ):
             if self.prevprefix is not None:
@@ -791,6 +1009,7 @@ class RestPipe:
             self.thisnii = newfile + ".nii.gz"
             self.prevprefix = self.prefix
             self.prefix = newprefix
+            self.maskspace = 'func'
             logging.info('skull stripping completed: ' + self.thisnii )
         else:
             logging.info('skull stripping failed')
@@ -802,8 +1021,7 @@ class RestPipe:
             newprefix = self.t1nii.split('/')[-1].split('.')[0] + "_brain"
             newfile = os.path.join(self.outpath, newprefix)
             thisprocstr = str("bet " + self.t1nii + " " + newfile + " -f " + str(self.anatbetfval))
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
 
             if os.path.isfile( newfile + ".nii.gz" ):
                 self.t1nii = newfile + ".nii.gz"
@@ -822,29 +1040,25 @@ class RestPipe:
         if self.flirtmat is not None:
             #apply the flirt matrix
             logging.info('applying transformation matrix ' + self.flirtmat + ' to 4D data')
-            thisprocstr = str("flirt -in " + self.thisnii + " -ref " + self.flirtref + " -applyxfm -init " + self.flirtmat + " -out " + newfile )
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            thisprocstr = str("flirt -in " + self.thisnii + " -ref " + atlasregistry.cached(self.flirtref) + " -applyxfm -init " + self.flirtmat + " -out " + newfile )
+            self.run_command(thisprocstr)
         elif self.t1nii is not None:
             #use t1 to generate flirt paramters
             #first flirt the func to the t1
             logging.info('flirt func to t1')
             thisprocstr = str("flirt -ref " + self.t1nii + " -in " + self.thisnii + " -out " + os.path.join(self.outpath,'func2t1') + " -omat " + os.path.join(self.outpath,'func2t1.mat') + " -cost corratio -dof 6 -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -interp trilinear")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
             self.toclean.append( os.path.join(self.outpath,'func2t1.nii.gz') )
 
             #invert the mat
             logging.info('inverting func2t1.mat')
             thisprocstr = str("convert_xfm -inverse -omat " + os.path.join(self.outpath,'t12func.mat') + " " + os.path.join(self.outpath,'func2t1.mat') )
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
 
             #flirt the t1 to standard
             logging.info('flirt t1 to standard')
-            thisprocstr = str("flirt -ref " + self.flirtref + " -in " + self.t1nii + " -out " + os.path.join(self.outpath,'t12standard') + " -omat " + os.path.join(self.outpath,'t12standard.mat') + " -cost corratio -dof " + self.flirtdof + " -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -interp trilinear")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            thisprocstr = str("flirt -ref " + atlasregistry.cached(self.flirtref) + " -in " + self.t1nii + " -out " + os.path.join(self.outpath,'t12standard') + " -omat " + os.path.join(self.outpath,'t12standard.mat') + " -cost corratio -dof " + self.flirtdof + " -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -interp trilinear")
+            self.run_command(thisprocstr)
             if os.path.isfile(os.path.join(self.outpath,('t12standard' + '.nii.gz'))):
                 self.t1nii = os.path.join(self.outpath,('t12standard' + '.nii.gz'))
             else:
@@ -855,34 +1069,29 @@ class RestPipe:
             #invert the mat
             logging.info('inverting t12standard.mat')
             thisprocstr = str("convert_xfm -inverse -omat " + os.path.join(self.outpath,'standard2t1.mat') + " " + os.path.join(self.outpath,'t12standard.mat'))
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
 
             #compute the func2standard mat
             logging.info('computing func2standard.mat from t12standard.mat func2t1.mat')
             thisprocstr = str("convert_xfm -omat " + os.path.join(self.outpath,'func2standard.mat') + " -concat " + os.path.join(self.outpath,'t12standard.mat') + " " + os.path.join(self.outpath,'func2t1.mat'))
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
 
             #apply the transform
             logging.info('creating normalized func %s' % (newprefix))
-            thisprocstr = str("flirt -ref " + self.flirtref + " -in " + self.thisnii + " -out " + newfile + " -applyxfm -init " + os.path.join(self.outpath,'func2standard.mat') + " -interp trilinear")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            thisprocstr = str("flirt -ref " + atlasregistry.cached(self.flirtref) + " -in " + self.thisnii + " -out " + newfile + " -applyxfm -init " + os.path.join(self.outpath,'func2standard.mat') + " -interp trilinear")
+            self.run_command(thisprocstr)
 
 
         else:
             #use the functional to get the matrix
-            thisprocstr = str("flirt -in " +  self.thisnii + " -ref " + self.flirtref + " -out " + newfile + " -omat " + (newfile + '.mat') + " -bins 256 -cost corratio -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -dof 12 -interp trilinear")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            thisprocstr = str("flirt -in " +  self.thisnii + " -ref " + atlasregistry.cached(self.flirtref) + " -out " + newfile + " -omat " + (newfile + '.mat') + " -bins 256 -cost corratio -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -dof 12 -interp trilinear")
+            self.run_command(thisprocstr)
 
             if os.path.isfile( newfile + '.mat' ):
                 #then apply output matrix to the same data with the same output name. for some reason flirt doesn't output 4D data above
                 logging.info('applying transformation matrix to 4D data')
-                thisprocstr = str("flirt -in " + self.thisnii + " -ref " + self.flirtref + " -applyxfm -init " + (newfile + '.mat') + " -out " + newfile )
-                logging.info('running: ' + thisprocstr)
-                subprocess.Popen(thisprocstr,shell=True).wait()
+                thisprocstr = str("flirt -in " + self.thisnii + " -ref " + atlasregistry.cached(self.flirtref) + " -applyxfm -init " + (newfile + '.mat') + " -out " + newfile )
+                self.run_command(thisprocstr)
             else:
                 logging.info('creation if initial flirt matrix failed.')
                 raise SystemExit()
@@ -892,6 +1101,7 @@ class RestPipe:
                 self.toclean.append( self.thisnii )
             self.thisnii = newfile + '.nii.gz'
             logging.info('initial normalization successful: ' + self.thisnii )
+            self.maskspace = 'ref'
 
             self.prevprefix = self.prefix
             self.prefix = newprefix
@@ -911,25 +1121,19 @@ class RestPipe:
 
     #regress out WM/CSF
     def step5(self):
+        import rsstages
         logging.info('regressing out WM/CSF signal ')
         newprefix = self.prefix + '_wmcsf'
         newfile = os.path.join(self.outpath,(newprefix + ".nii.gz"))
 
-        #load nifti data
-        data = nibabel.nifti1.load(self.thisnii)
-        data1 = data.get_fdata()
-
         #mean time series for wm
         wmout = os.path.join(self.outpath,"wm_ts.txt")
-        thisprocstr = str("fslmeants -i " + self.thisnii + " -m " + self.refwm + " -o " + wmout )
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        wmproc = str("fslmeants -i " + self.thisnii + " -m " + atlasregistry.cached(self.refwm) + " -o " + wmout )
 
         #mean time series for csf
         csfout = os.path.join(self.outpath,"csf_ts.txt")
-        thisprocstr = str("fslmeants -i " + self.thisnii + " -m " + self.refcsf + " -o " + csfout )
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        csfproc = str("fslmeants -i " + self.thisnii + " -m " + atlasregistry.cached(self.refcsf) + " -o " + csfout )
+        self.run_commands([wmproc, csfproc])
 
         for fname in [wmout, csfout]:
             if not os.path.isfile(fname):
@@ -940,35 +1144,12 @@ class RestPipe:
         wm_ts = np.loadtxt(wmout,unpack=True)
         csf_ts = np.loadtxt(csfout,unpack=True)
 
-        X_wm = np.vstack([np.ones(self.tdim), wm_ts]).T
-        X_csf = np.vstack([np.ones(self.tdim), csf_ts]).T
+        #regress wm, then csf
+        X = rsstages.designs([wm_ts, csf_ts])
 
         logging.info('starting linear regression')
-        tmp_mean = np.mean(data1, axis=3, dtype=data1.dtype)
-        shape = data1.shape
-        data1v = data1.reshape((shape[0]*shape[1], shape[2], shape[3])).transpose((1, 2, 0))
-        # data1v is a view in z, t, x*y order
-        # go slice-by-slice
-        for cntz in range(self.zdim):
-            tmp_data = data1v[cntz]
-            # regress wm
-            p01 = np.linalg.lstsq(X_wm, tmp_data, rcond=-1)[0]
-            p001 = np.dot(X_wm, p01) #product
-            tmp02 = tmp_data - p001
-            # regress csf
-            p02 = np.linalg.lstsq(X_csf, tmp02, rcond=-1)[0]
-            p002 = np.dot(X_csf, p02) #product
-            tmp03 = tmp02 - p002
-            data1v[cntz] = tmp03
-
-        data_mr = data1v.transpose((2, 0, 1)).reshape(shape)
-        del data1v
-        del data1
-        data_mr += tmp_mean.reshape(tmp_mean.shape + (1,))
-        data_mr -= np.min(data_mr)
-        data_mr *= (30000.0 / np.max(data_mr)).astype(data.get_data_dtype())
-        newNii = nibabel.Nifti1Pair(data_mr,None,data.header)
-        nibabel.save(newNii,newfile)
+        self.voxel_step(newfile, lambda data1: rsstages.regress_slices(data1, X, options.sliceworkers),
+                        lambda block: rsstages.regress_voxels(block, X))
 
         if os.path.isfile(newfile):
             if self.prevprefix is not None:
@@ -983,54 +1164,18 @@ class RestPipe:
 
     #lowpass filter
     def step6(self):
+        import rsstages
         logging.info('lowpass filtering data')
         newprefix = "filt_" + self.prefix
         newfile = os.path.join(self.outpath,(newprefix + ".nii.gz"))
 
         freq_cutoff = self.lpfreq
 
-        #load nifti data
-        data = nibabel.nifti1.load(self.thisnii)
-        data1 = data.get_fdata()
-
         #build filter
-        time_all = np.arange(0,(self.tdim*(self.tr_ms/1000))-.001,.001)
-        time_subTR = time_all[0:-1:int(self.tr_ms)]
-        length = len(time_subTR)
-        ccc = 1.0/(self.tr_ms/1000)/length
-        cccc = freq_cutoff/ccc
-        len1 = round(length/2.0-(cccc-2))
-        len2 = round(length/2.0+(cccc+1))
-
-        tmp = np.zeros([self.tdim,1])
-        tmp[int(len1):int(len2)]=1
-        tmpMA = len1-4
-        tmpMA2 = round(tmpMA/2)
-        tmpAB = np.divide(np.add(1,np.cos(np.arange(np.pi, 2*np.pi+((np.pi/tmpMA)/2), np.pi/tmpMA))),2)
-        tmpAB = tmpAB.reshape(tmpAB.shape[0],1)
-        tmpBA = np.divide(np.add(1,np.cos(np.arange(2*np.pi,np.pi-((np.pi/tmpMA)/2), -np.pi/tmpMA))),2)
-        tmpBA = tmpBA.reshape(tmpBA.shape[0],1)
-
-        tmp[int((len1-tmpMA+tmpMA2)-1):int(len1+tmpMA2)]=tmpAB
-        tmp[int((len2-tmpMA2)-1):int(len2+tmpMA-tmpMA2)]=tmpBA
-
-        tmp_mean = np.mean(data1, axis=3, dtype=data1.dtype)
-        # go slice-by-slice
-        for cntz in range(self.zdim):
-            tmp_data = data1[:,:,cntz,:]
-            arr_f = np.fft.fftshift(np.fft.fft(np.fft.fftshift(signal.detrend(tmp_data), axes=[2]), axis=2), axes=[2])
-            arr_fc = np.multiply(arr_f, tmp.T)
-            yyy00 = np.real(np.fft.fftshift(np.fft.ifft(np.fft.fftshift(arr_fc, axes=[2]), axis=2), axes=[2]))
-            data1[:,:,cntz,:] = yyy00
-        data_lowpass = data1
-        del data1
-        # in-place (-=, *=) operations should save memory
-        data_lowpass += tmp_mean.reshape(tmp_mean.shape + (1,))
-        data_lowpass -=  np.min(data_lowpass)
-        data_lowpass *= (30000.0 / np.max(data_lowpass)).astype(data.get_data_dtype())
+        window = rsstages.lowpass_window(self.tdim, self.tr_ms, freq_cutoff)
 
-        newNii = nibabel.Nifti1Pair(data_lowpass,None,data.header)
-        nibabel.save(newNii,newfile)
+        self.voxel_step(newfile, lambda data1: rsstages.lowpass_slices(data1, window, options.sliceworkers),
+                        lambda block: rsstages.lowpass_voxels(block, window))
 
         if os.path.isfile(newfile):
             if self.prevprefix is not None:
@@ -1043,13 +1188,60 @@ class RestPipe:
 
             logging.info('creating mean image.')
             thisprocstr = str("fslmaths " + self.thisnii + " -Tmean filt_mean")
-            logging.info('running: ' + thisprocstr)
-            subprocess.Popen(thisprocstr,shell=True).wait()
+            self.run_command(thisprocstr)
         else:
             logging.info('lowpass filtering failed')
             raise SystemExit()
 
 
+    #regress out WM/CSF, lowpass filter and parcellate in one pass ( --fastpath )
+    def step5_7a(self):
+        import rsstages
+        import fastpath
+        logging.info('regressing out WM/CSF signal, lowpass filtering and parcellating in one pass')
+        wmout = os.path.join(self.outpath,"wm_ts.txt")
+        csfout = os.path.join(self.outpath,"csf_ts.txt")
+        corrtxt = os.path.join(self.outpath,'corrlabel_ts.txt')
+
+        data = nibabel.nifti1.load(self.thisnii)
+        refwm = atlasregistry.data(self.refwm)
+        refcsf = atlasregistry.data(self.refcsf)
+        labels = atlasregistry.data(self.corrlabel)
+        for name, ref in [(self.refwm, refwm), (self.refcsf, refcsf), (self.corrlabel, labels)]:
+            if ref.shape != data.shape[:3]:
+                logging.info('data and %s are different shapes!' % name)
+                raise SystemExit()
+
+        window = rsstages.lowpass_window(self.tdim, self.tr_ms, self.lpfreq)
+        newprefix = "filt_" + self.prefix + '_wmcsf'
+        newfile = None
+        if self.fastpathkeep:
+            newfile = os.path.join(self.outpath,(newprefix + ".nii.gz"))
+        wm_ts, csf_ts, timeseries = fastpath.fast_path(self.thisnii, refwm, refcsf, labels, window,
+                                                       self.compute_mask(data.shape[:3]), self.maxmemory,
+                                                       options.sliceworkers, newfile)
+        np.savetxt(wmout, wm_ts, fmt='%f')
+        np.savetxt(csfout, csf_ts, fmt='%f')
+        np.savetxt(corrtxt, timeseries, fmt='%f')
+        logging.info('label mean time series written: ' + corrtxt)
+
+        if newfile is not None:
+            if os.path.isfile(newfile):
+                if self.prevprefix is not None:
+                    self.toclean.append(self.thisnii)
+                self.prevprefix = self.prefix
+                self.prefix = newprefix
+                self.thisnii = newfile
+                logging.info('lowpass filtering successful: ' + self.thisnii )
+
+                logging.info('creating mean image.')
+                thisprocstr = str("fslmaths " + self.thisnii + " -Tmean filt_mean")
+                self.run_command(thisprocstr)
+            else:
+                logging.info('lowpass filtering failed')
+                raise SystemExit()
+
+
     #do the parcellation and correlation
     def step7(self):
         self.step7a()
@@ -1060,15 +1252,15 @@ class RestPipe:
         logging.info('starting parcellation')
         corrtxt = os.path.join(self.outpath,'corrlabel_ts.txt')
 
-        thisprocstr = str("fslmeants -i " + self.thisnii + " --label=" + self.corrlabel + " -o " + corrtxt )
-        logging.info('running: ' + thisprocstr)
-        subprocess.Popen(thisprocstr,shell=True).wait()
+        thisprocstr = str("fslmeants -i " + self.thisnii + " --label=" + atlasregistry.cached(self.corrlabel) + " -o " + corrtxt )
+        self.run_command(thisprocstr)
         if not os.path.isfile(corrtxt):
             logging.info('could not create mean timeseries matrix file')
             raise SystemExit()
 
     #do the correlation
     def step7b(self):
+        import rsstages
         logging.info('starting correlation')
         rmat = os.path.join(self.outpath,'r_matrix.nii.gz')
         rtxt = os.path.join(self.outpath,'r_matrix.csv')
@@ -1085,19 +1277,11 @@ class RestPipe:
             timeseries = np.loadtxt(corrtxt,unpack=True)
             if not self.needfunc:
                 self.tdim = timeseries.shape[1]
+            fulltimeseries = timeseries
             if self.motionthreshold is not None or self.dvarsthreshold is not None or self.fdthreshold is not None:
                 timeseries = self.scrub_motion_volumes(timeseries)
-            myres = np.corrcoef(timeseries)
-            myres = np.nan_to_num(myres)
-
-            #convert corcoef
-            zrmaps = 0.5*np.log((1+myres)/(1-myres))
-            #find the inf vals on diagonal
-            infs = (zrmaps == np.inf).nonzero()
-
-            #replace the infs with 0
-            for idx in range(len(infs[0])):
-                zrmaps[infs[0][idx]][infs[1][idx]] = 0
+            #convert corcoef, infs on the diagonal are 0
+            myres, zrmaps = rsstages.correlation_matrices(timeseries)
 
             nibabel.save(nibabel.Nifti1Image(myres,None) ,rmat)
             nibabel.save(nibabel.Nifti1Image(zrmaps,None) ,zmat)
@@ -1105,51 +1289,25 @@ class RestPipe:
             np.savetxt(rtxt,myres,fmt='%f',delimiter=',')
 
             #create a mask for higher level, include everything below diagonal
-            mask = np.zeros_like(myres)
-            maskx,masky = mask.shape
-
-            for idx in range(maskx):
-                for idy in range(masky):
-                    if idx > idy:
-                        mask[idx][idy] = 1
+            mask = rsstages.lower_mask(myres)
 
             nibabel.save(nibabel.Nifti1Image(mask,None) ,maskname)
 
+            import atlasgeom
             labels = self.grab_labels()
             aalcenter = np.array(self.refac.split(','),dtype=int)
 
-            labnii = nibabel.load(self.corrlabel)
-            niidata = labnii.get_fdata()
+            labnii = atlasregistry.load(self.corrlabel)
             niihdr = labnii.header
             zooms = np.array(niihdr.get_zooms())
+            geometry = atlasgeom.atlas_geometry(atlasregistry.cached(self.corrlabel))
 
-            G=nx.Graph(atlas=str(self.corrlabel))
-            for lab in labels:
-                #grab indices equal to label value
-                x,y,z = (niidata == lab[0]).nonzero()
-                centroid = np.array([int(x.mean()),int(y.mean()),int(z.mean())])
-                c_cent_str = str((centroid - aalcenter)*(zooms.astype('int')))[1:-1].strip()
-                lab.append( (centroid - aalcenter)*zooms.astype('int') )
-                lab.append( 0 )
-                G.add_node(lab[0],label=str(lab[1]),centroid=c_cent_str,intensityvalue=lab[0] )
-                timecourse = timeseries[int(lab[0] - 1)]
-                G.node[lab[0]]['timecourse'] = str(timecourse.tolist()).replace(',','').strip('\[\]')
-
-
-            sigx,sigy = (zrmaps != 0 ).nonzero()
-            for idx in range(len(sigx)):
-                if sigx[idx] < sigy[idx]:
-                    zrval = str(zrmaps[sigx[idx]][sigy[idx]])
-                    rval = str(myres[sigx[idx]][sigy[idx]])
-                    xidx = sigx[idx] + 1
-                    yidx = sigy[idx] + 1
-                    G.add_edge(xidx,yidx, zrvalue=zrval, rvalue=rval)
-                    #G.edge[xidx][yidx]['zrvalue'] = zrval
-                    #G.edge[xidx][yidx]['rvalue'] = rval
-
+            G = rsstages.correlation_graph(labels, timeseries, myres, zrmaps, geometry, aalcenter, zooms, self.corrlabel)
             B = nx.Graph.to_undirected(G)
             nx.write_graphml(B,graphml,encoding='utf-8', prettyprint=True)
 
+            if self.dynwindow is not None:
+                self.step7b_dynamic(fulltimeseries)
 
             #check for the resulting files
             for fname in [rmat, zmat, maskname, ztxt, rtxt, graphml]:
@@ -1163,6 +1321,35 @@ class RestPipe:
             raise SystemExit()
 
 
+    #sliding window correlation, scrubbed volumes are dropped from each window
+    def step7b_dynamic(self, timeseries):
+        import dynconn
+        dynprefix = os.path.join(self.outpath,'dyn')
+        dyntxt = os.path.join(self.outpath,'dyn_windows.txt')
+
+        if self.dynwindow > timeseries.shape[1]:
+            logging.info('--dynwindow (%d) is longer than the run (%d volumes)' % (self.dynwindow, timeseries.shape[1]))
+            raise SystemExit()
+
+        logging.info('starting sliding window correlation: window %d, step %d' % (self.dynwindow, self.dynstep))
+        starts, nvols, rstack, zstack = dynconn.sliding_corr(timeseries, self.dynwindow, self.dynstep, self.scrubmask, dynprefix)
+        del rstack, zstack
+
+        with open(dyntxt, 'w') as f:
+            f.write("# first volume, last volume (indexed starting at 0) and number of unscrubbed volumes in each window\n")
+            np.savetxt(f, np.vstack([starts, starts + self.dynwindow - 1, nvols]).T, fmt='%d')
+
+        if np.any(nvols < 3):
+            logging.info('%d windows had fewer than 3 unscrubbed volumes and were left empty' % np.sum(nvols < 3))
+
+        for fname in [dynprefix + '_r_matrix.npy', dynprefix + '_zr_matrix.npy', dyntxt]:
+            if os.path.isfile( fname ):
+                logging.info('sliding window correlation finished : ' + fname)
+            else:
+                logging.info('sliding window correlation failed')
+                raise SystemExit()
+
+
     #fcdm
     def step8(self):
         import fcdm
@@ -1171,19 +1358,86 @@ class RestPipe:
         #load nifti data
         data = nibabel.nifti1.load(self.thisnii)
         #data1 = data.get_fdata()
-        mask = nibabel.nifti1.load(self.refgm)
+        mask = atlasregistry.load(self.refgm)
 
         if mask.shape != data.shape[:-1]:
             logging.info('data and mask are different shapes!')
             raise SystemExit()
 
         logging.info("running %s, masked by %s, at pearsonr value of %f" % (self.thisnii, self.refgm, self.fcdmthresh))
-        outfile = fcdm.fcdm(self.thisnii, self.refgm, self.fcdmthresh)
+        outfile = fcdm.fcdm(self.thisnii, atlasregistry.cached(self.refgm), self.fcdmthresh)
 
         if os.path.isfile(outfile):
             logging.info("fcdm results %s" % outfile)
 
 
+    #seed-to-voxel correlation maps
+    def step9(self):
+        import seedmaps
+        logging.info('starting seed-to-voxel correlation maps')
+        outprefix = os.path.join(self.outpath,'seedcorr')
+        seedtxt = os.path.join(self.outpath,'seedcorr_seeds.txt')
+
+        labels = self.grab_labels()
+        names = dict([(lab[0], lab[1]) for lab in labels])
+        if self.seeds is not None:
+            seeds = self.seeds
+            for seed in seeds:
+                if seed not in names:
+                    logging.info('seed %d is not listed in %s' % (seed, self.corrtext))
+                    raise SystemExit()
+        else:
+            seeds = [lab[0] for lab in labels]
+
+        data = nibabel.nifti1.load(self.thisnii)
+        if atlasregistry.load(self.corrlabel).shape != data.shape[:-1]:
+            logging.info('data and correlation labels are different shapes!')
+            raise SystemExit()
+
+        #restrict to the brain when the reference mask matches the data
+        maskfile = None
+        if os.path.isfile(self.refbrainmask) and atlasregistry.load(self.refbrainmask).shape == data.shape[:-1]:
+            maskfile = atlasregistry.cached(self.refbrainmask)
+
+        logging.info("correlating %d seeds from %s with %s" % (len(seeds), self.corrlabel, self.thisnii))
+        rname, zname = seedmaps.seedmaps(self.thisnii, atlasregistry.cached(self.corrlabel), seeds, outprefix, maskfile, self.seedchunk, self.kept_volumes())
+
+        with open(seedtxt, 'w') as f:
+            for idx, seed in enumerate(seeds):
+                f.write("%d\t%d\t%s\n" % (idx, seed, names[seed]))
+
+        for fname in [rname, zname, seedtxt]:
+            if os.path.isfile( fname ):
+                logging.info('seed correlation maps finished : ' + fname)
+            else:
+                logging.info('seed correlation maps failed')
+                raise SystemExit()
+
+
+    #voxel-level graph
+    def step10(self):
+        import voxelgraph
+        logging.info('starting voxel-level graph')
+        outprefix = os.path.join(self.outpath,'voxelgraph')
+
+        data = nibabel.nifti1.load(self.thisnii)
+        mask = atlasregistry.load(self.refgm)
+        if mask.shape != data.shape[:-1]:
+            logging.info('data and mask are different shapes!')
+            raise SystemExit()
+
+        logging.info("correlating the voxels of %s in %s, keeping r > %s, top %s per voxel" % (self.thisnii, self.refgm, self.voxthresh, self.voxtopk))
+        graphname, weightname, nodename, nedges = voxelgraph.voxelgraph(self.thisnii, atlasregistry.cached(self.refgm), outprefix, self.voxthresh, self.voxtopk, self.voxblock, self.kept_volumes())
+        logging.info("voxel graph has %d edges" % nedges)
+
+        for fname in [graphname, weightname, nodename]:
+            if os.path.isfile( fname ):
+                logging.info('voxel graph finished : ' + fname)
+            else:
+                logging.info('voxel graph failed')
+                raise SystemExit()
+
+
     #make the cleanup step
     def cleanup(self):
         for fname in self.toclean:
@@ -1216,6 +1470,45 @@ class RestPipe:
 
     # scrub volumes that exceed the motion threshold
     def scrub_motion_volumes(self, timeseries):
+        newprefix = "scrubbed_" + self.prefix
+        newfile = os.path.join(self.outpath,(newprefix + ".nii.gz"))
+
+        selected = self.scrub_mask()
+        datanifti = nibabel.nifti1.load(self.thisnii)
+        timeseries = timeseries[:,selected]
+
+        # write out scrubbed image data (though we don't actually use it)
+        if self.maxmemory is not None:
+            import outofcore
+            outofcore.select_volumes(self.thisnii, selected, newfile)
+        else:
+            scrubbeddata = datanifti.get_fdata()[:,:,:,selected]
+            newNii = nibabel.Nifti1Pair(scrubbeddata,None,datanifti.header)
+            nibabel.save(newNii,newfile)
+
+        if os.path.isfile(newfile):
+            self.thisnii = newfile
+            self.scrubbednii = newfile
+
+        return timeseries
+
+
+    # volumes of the run to keep for steps 9 and 10, None without scrubbing
+    # thresholds or once step 7b replaced the run by its scrubbed volumes
+    def kept_volumes(self):
+        if self.motionthreshold is None and self.dvarsthreshold is None and self.fdthreshold is None:
+            return None
+        if self.thisnii == self.scrubbednii:
+            return None
+        return self.scrub_mask()
+
+
+    # volumes of self.thisnii below the scrubbing thresholds, computed once
+    # by the first step that needs them
+    def scrub_mask(self):
+        if self.scrubmask is not None:
+            return self.scrubmask
+
         motionmarkedvolstxt = os.path.join(self.outpath,'motiondisp_markedvols.txt')
         motiontxt = os.path.join(self.outpath,'motiondisp.txt')
         dvarsmarkedvolstxt = os.path.join(self.outpath,'dvars_markedvols.txt')
@@ -1225,36 +1518,40 @@ class RestPipe:
         fdtxt = os.path.join(self.outpath,'fd.txt')
         dvarsthreshtxt = os.path.join(self.outpath,'dvars_thresh.txt')
         excludedvolstxt = os.path.join(self.outpath,'total_excludedvols.txt')
-        newprefix = "scrubbed_" + self.prefix
-        newfile = os.path.join(self.outpath,(newprefix + ".nii.gz"))
+
+        datanifti = nibabel.nifti1.load(self.thisnii)
 
         #load mcflirt params
-        params = np.loadtxt(self.mcparams,unpack=True)
+        if self.fdthreshold is not None or self.motionthreshold is not None:
+            params = np.loadtxt(self.mcparams,unpack=True)
 
         # this stores how many metrics chose to exclude
-        numexcls = [ 0 ] * params.shape[1]
-
-        datanifti = nibabel.nifti1.load(self.thisnii)
+        numexcls = [ 0 ] * datanifti.shape[3]
 
         if self.dvarsthreshold != None:
             logging.info('calculating DVARS for: %s', self.thisnii)
-            # masked array
-            data = datanifti.get_fdata().astype(np.float64)
-            maskdata = nibabel.nifti1.load(self.refbrainmask).get_fdata().astype(np.float64)
+            maskdata = atlasregistry.data(self.refbrainmask).astype(np.float64)
             #maskdata = nd.binary_erosion(maskdata, iterations=5)
-            data = numpy.ma.array(data,
-                                  mask=numpy.tile((maskdata == 0)[:,:,:,np.newaxis], (1, 1, 1, data.shape[3])))
-            work = data.reshape([data.shape[0] * data.shape[1] * data.shape[2], data.shape[3]])
-            boldmean = np.ma.mean(work)
-            work = np.ma.diff(work, axis=1)
-            logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
-            #work = work / boldmean
-            #logging.info("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
-            work = work ** 2
-            logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
-            work = np.ma.mean(work, axis=0)
-            logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
-            dvars = np.hstack(([0], np.ma.sqrt(work)))
+            if self.maxmemory is not None:
+                #2 volumes at a time
+                import outofcore
+                dvars, boldmean = outofcore.dvars(self.thisnii, maskdata)
+            else:
+                # masked array
+                data = datanifti.get_fdata().astype(np.float64)
+                data = numpy.ma.array(data,
+                                      mask=numpy.tile((maskdata == 0)[:,:,:,np.newaxis], (1, 1, 1, data.shape[3])))
+                work = data.reshape([data.shape[0] * data.shape[1] * data.shape[2], data.shape[3]])
+                boldmean = np.ma.mean(work)
+                work = np.ma.diff(work, axis=1)
+                logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
+                #work = work / boldmean
+                #logging.info("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
+                work = work ** 2
+                logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
+                work = np.ma.mean(work, axis=0)
+                logging.debug("work.min=%s work.max=%s work.mean=%s", np.min(work), np.max(work), np.mean(work))
+                dvars = np.hstack(([0], np.ma.sqrt(work)))
             logging.debug(' DVARS: %s', dvars)
             logging.debug("dvars.min=%s dvars.max=%s", np.min(dvars), np.max(dvars))
             boldscaling = 1.0
@@ -1269,7 +1566,7 @@ class RestPipe:
                       for ind in excludethese
                       for contributor in (ind,)
                       for excludethis in range(contributor - self.dvarsnumneighbors, contributor + self.dvarsnumneighbors + 1)
-                      if excludethis < data.shape[3]
+                      if excludethis < datanifti.shape[3]
                      ]))
             logging.info(' marking these volumes due to DVARS > %g: %s', _dvarsthreshold * boldscaling, excludethese)
             for excludethis in excludethese:
@@ -1302,7 +1599,7 @@ class RestPipe:
                       for ind in excludethese
                       for contributor in (ind + 1,)
                       for excludethis in range(contributor - self.fdnumneighbors, contributor + self.fdnumneighbors + 1)
-                      if excludethis < data.shape[3]
+                      if excludethis < datanifti.shape[3]
                      ]))
             logging.info(' marking these volumes due to FD > %g mm: %s', self.fdthreshold, excludethese)
             for excludethis in excludethese:
@@ -1459,7 +1756,7 @@ class RestPipe:
             # selected metrics allowed the volume
             selected = (np.array(numexcls) == 0)
 
-        timeseries = timeseries[:,np.array(selected)]
+        self.scrubmask = np.array(selected)
         excludedinds = np.array(np.nonzero(np.array(selected) == False))
         if len(excludedinds[0]) > 0:
             scrubmethodstr = (' ' + self.scrubop.upper() + ' ').join(
@@ -1470,19 +1767,11 @@ class RestPipe:
             with open(excludedvolstxt, 'w') as f:
                 f.write("# these are the volumes (indexed starting at 0) excluded because they or their neighbors exceeded the %s threshold\n" % scrubmethodstr)
                 np.savetxt(f, np.transpose(excludedinds[0]), fmt='%d', newline=' ')
-        if self.scrubkeepminvols != None and timeseries.shape[1] < self.scrubkeepminvols:
-            logging.error('Too few volumes (%d) met the scrubbing threshold!  Exiting...' % (timeseries.shape[1],))
+        if self.scrubkeepminvols != None and np.sum(self.scrubmask) < self.scrubkeepminvols:
+            logging.error('Too few volumes (%d) met the scrubbing threshold!  Exiting...' % (np.sum(self.scrubmask),))
             raise SystemExit()
 
-        # write out scrubbed image data (though we don't actually use it)
-        scrubbeddata = datanifti.get_fdata()[:,:,:,np.array(selected)]
-        newNii = nibabel.Nifti1Pair(scrubbeddata,None,datanifti.header)
-        nibabel.save(newNii,newfile)
-
-        if os.path.isfile(newfile):
-            self.thisnii = newfile
-
-        return timeseries
+        return self.scrubmask
 
 
 if __name__ == "__main__":
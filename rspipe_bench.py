@@ -0,0 +1,272 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os, sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+import contextlib
+import numpy as np
+import nibabel
+import networkx as nx
+from optparse import OptionParser
+import community
+import atlasgeom
+import pipeprofile
+import resourcepolicy
+import rsstages
+import synthdata
+from seedmaps import seed_timeseries
+
+usage ="""
+rspipe_bench.py --size 64 --repeat 3 -o bench_64.json [--compare bench_before.json]
+
+Benchmarks the numerical stages of resting_pipeline.py on synthetic data, no FSL needed.
+    --size is one of %s or XxYxZxT ( ie: 64x64x64x200 ), the synthetic run is
+        generated once in --workdir ( default is a temporary directory, removed afterwards )
+    --stages is a comma seperated list of:
+        step2 - motion parameter regression and rescale
+        step5 - WM/CSF regression and rescale
+        step6 - lowpass filter and rescale
+        step7b - ROI correlation matrices, subject graph and graphml writer
+        fcdm - fcdm.fcdm on a --fcdmcrop^3 voxel crop of the run ( it is a per voxel python loop )
+        louvain - community.best_partition of a --nodes node planted partition graph
+        pipeline - resting_pipeline.py --steps --pipelinesteps end to end with --backend standin
+            ( fslstandin.py in place of FSL/BXH ), its per step and per command profile is kept
+      default is all of them
+    every stage is run --repeat times on fresh data, results ( wall, cpu, peak memory and
+        i/o of every run, see pipeprofile.py ) are written as JSON to --output, with the git
+        commit, so runs of different commits can be compared with --compare
+""" % ', '.join(sorted(synthdata.SIZES))
+
+STAGES = ['step2', 'step5', 'step6', 'step7b', 'fcdm', 'louvain', 'pipeline']
+
+parser = OptionParser(usage=usage)
+parser.add_option("-o", "--output",  action="store", type="string", dest="output",help="json file to write the results to", metavar="FILE")
+parser.add_option("--size",  action="store", type="string", dest="size",help="synthetic run size, default is small", metavar="64", default='small')
+parser.add_option("--stages",  action="store", type="string", dest="stages",help="comma seperated stages to run, default is all", metavar="step2,step6")
+parser.add_option("--repeat",  action="store", type="int", dest="repeat",help="runs of every stage, default is 3", metavar="3", default=3)
+parser.add_option("--seed",  action="store", type="int", dest="seed",help="random seed of the synthetic data, default is 0", metavar="0", default=0)
+parser.add_option("--parcels",  action="store", type="int", dest="parcels",help="number of atlas parcels, default is 116", metavar="116", default=116)
+parser.add_option("--fcdmcrop",  action="store", type="int", dest="fcdmcrop",help="edge of the voxel cube fcdm is run on, default is 12", metavar="12", default=12)
+parser.add_option("--nodes",  action="store", type="int", dest="nodes",help="nodes of the louvain graph, default is 5000", metavar="5000", default=5000)
+parser.add_option("--communities",  action="store", type="int", dest="communities",help="planted communities of the louvain graph, default is 20", metavar="20", default=20)
+parser.add_option("--pipelinesteps",  action="store", type="string", dest="pipelinesteps",help="--steps of the pipeline stage, default is all", metavar="0,1,2", default='all')
+parser.add_option("--resources",  action="store", choices=tuple(resourcepolicy.PRESETS), dest="resources",help="thread budget of the benchmark and the pipeline stage ( see resourcepolicy.py ), default leaves it alone", metavar="throughput")
+parser.add_option("--threads",  action="store", type="int", dest="threads",help="BLAS/OpenMP threads, overrides the --resources preset.  The --sliceworkers share them, each gets threads // sliceworkers ( at least 1 )", metavar="1")
+parser.add_option("--sliceworkers",  action="store", type="int", dest="sliceworkers",help="slices steps 2, 5 and 6 process at once, default is the --threads of --resources, 1 without them", metavar="1")
+parser.add_option("--max-memory",  action="store", type="string", dest="maxmemory",help="run the pipeline stage out-of-core within this much memory ( see outofcore.py ), ie: 4G", metavar="4G")
+parser.add_option("--maskedcompute",  action="store_true", dest="maskedcompute",help="run the pipeline stage with --maskedcompute", default=False)
+parser.add_option("--fastpath",  action="store_true", dest="fastpath",help="run the pipeline stage with --fastpath ( steps 5, 6 and 7a fused )", default=False)
+parser.add_option("--workdir",  action="store", type="string", dest="workdir",help="directory for the synthetic data, kept afterwards", metavar="PATH")
+parser.add_option("--compare",  action="store", type="string", dest="compare",help="earlier results to compare against", metavar="FILE")
+
+
+def git_commit():
+    #commit of the benchmarked code, None outside a git checkout
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.realpath(__file__))).communicate()[0]
+        return out.decode().strip() or None
+    except OSError:
+        return None
+
+
+def load_run(names):
+    #fresh float64 data, the way the steps load it
+    img = nibabel.load(names['bold'])
+    return img, img.get_fdata()
+
+
+def bench_step2(run, names, workdir):
+    img, data1 = load_run(names)
+    X = rsstages.designs(np.loadtxt(names['par'], unpack=True))
+    def stage():
+        data_mr = rsstages.regress_slices(data1, X, options.sliceworkers)
+        rsstages.rescale(data_mr, img.get_data_dtype())
+    return stage
+
+
+def bench_step5(run, names, workdir):
+    img, data1 = load_run(names)
+    X = rsstages.designs([np.loadtxt(names['wm']), np.loadtxt(names['csf'])])
+    def stage():
+        data_mr = rsstages.regress_slices(data1, X, options.sliceworkers)
+        rsstages.rescale(data_mr, img.get_data_dtype())
+    return stage
+
+
+def bench_step6(run, names, workdir):
+    img, data1 = load_run(names)
+    def stage():
+        window = rsstages.lowpass_window(run.tdim, run.tr_ms, 0.08)
+        rsstages.rescale(rsstages.lowpass_slices(data1, window, options.sliceworkers), img.get_data_dtype())
+    return stage
+
+
+def bench_step7b(run, names, workdir):
+    geometry = atlasgeom.AtlasGeometry.from_data(run.atlas)
+    labels = [[lab, 'parcel%03d' % lab] for lab in range(1, run.nparcels + 1)]
+    img = nibabel.load(names['bold'])
+    data2d = np.asarray(img.dataobj).reshape((-1, run.tdim), order='F')
+    timeseries = seed_timeseries(data2d, geometry, [lab[0] for lab in labels])
+    del data2d
+    graphml = os.path.join(workdir, 'subject.graphml')
+    def stage():
+        myres, zrmaps = rsstages.correlation_matrices(timeseries)
+        rsstages.lower_mask(myres)
+        G = rsstages.correlation_graph(labels, timeseries, myres, zrmaps, geometry,
+                                       np.array([45, 63, 36]), np.array([2., 2., 2.]), names['atlas'])
+        nx.write_graphml(G, graphml, encoding='utf-8', prettyprint=True)
+    return stage
+
+
+def bench_fcdm(run, names, workdir):
+    import fcdm
+    edge = options.fcdmcrop
+    crop = tuple(slice(max(0, dim//2 - edge//2), max(0, dim//2 - edge//2) + edge) for dim in run.shape)
+    img = nibabel.load(names['bold'])
+    cropdir = os.path.join(workdir, 'fcdm')
+    if not os.path.isdir(cropdir):
+        os.mkdir(cropdir)
+    datafile = os.path.join(cropdir, 'crop.nii.gz')
+    maskfile = os.path.join(cropdir, 'crop_mask.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(np.asarray(img.dataobj[crop]), img.affine), datafile)
+    nibabel.save(nibabel.Nifti1Image(run.mask[crop].astype(np.uint8), img.affine), maskfile)
+    def stage():
+        #fcdm prints every voxel
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            fcdm.fcdm(datafile, maskfile, 0.6)
+    return stage
+
+
+def bench_louvain(run, names, workdir):
+    graph, membership = synthdata.planted_graph(options.nodes, options.communities, seed=options.seed)
+    def stage():
+        community.best_partition(graph)
+    return stage
+
+
+def bench_pipeline(run, names, workdir):
+    outpath = tempfile.mkdtemp(prefix='pipeline', dir=workdir)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resting_pipeline.py'),
+           '-f', names['bold'], '--tr', str(run.tr_ms), '--steps', options.pipelinesteps, '-o', outpath,
+           '--backend', 'standin', '--sliceorder', 'up',
+           '--ref', names['ref'], '--refwm', names['refwm'], '--refcsf', names['refcsf'],
+           '--refgm', names['refgm'], '--refbrainmask', names['mask'], '--corrlabel', names['atlas'],
+           '--corrtext', names['labels'], '--refacpoint', ','.join(map(str, run.center()))]
+    if options.resources is not None:
+        cmd += ['--resources', options.resources]
+    if options.threads is not None:
+        cmd += ['--threads', str(options.threads)]
+    cmd += ['--sliceworkers', str(options.sliceworkers)]
+    if options.maxmemory is not None:
+        cmd += ['--max-memory', options.maxmemory]
+    if options.maskedcompute:
+        cmd += ['--maskedcompute']
+    if options.fastpath:
+        cmd += ['--fastpath']
+    #the pipeline's own temporary files stay in the run directory, the reference cache is shared
+    env = dict(os.environ, TMPDIR=os.path.join(outpath, 'tmp'), RSPIPE_REFCACHE=os.path.join(workdir, 'refcache'))
+    os.mkdir(env['TMPDIR'])
+    def stage():
+        with open(os.path.join(outpath, 'pipeline.log'), 'w') as log:
+            status = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=outpath, env=env).wait()
+        if status != 0:
+            raise RuntimeError("resting_pipeline.py failed, see " + os.path.join(outpath, 'pipeline.log'))
+        with open(os.path.join(outpath, 'pipeline_profile.json'), 'r') as f:
+            pipeline_profiles.append(json.load(f))
+    return stage
+
+
+def summarize(records):
+    #per stage lists of the runs and the best/median wall times
+    stages = {}
+    for record in records:
+        entry = stages.setdefault(record['name'], {'wall': [], 'cpu': [], 'peak_rss_kb': 0})
+        entry['wall'].append(record['wall'])
+        entry['cpu'].append(record['cpu'])
+        entry['peak_rss_kb'] = max(entry['peak_rss_kb'], record['peak_rss_kb'])
+    for entry in stages.values():
+        entry['best'] = min(entry['wall'])
+        entry['median'] = float(np.median(entry['wall']))
+    if 'pipeline' in stages:
+        stages['pipeline']['runs_per_hour'] = 3600. / stages['pipeline']['median']
+    return stages
+
+
+def compare(results, fname):
+    with open(fname, 'r') as f:
+        before = json.load(f)
+    if before['size'] != results['size']:
+        print("warning: %s is size %s, not %s" % (fname, 'x'.join(map(str, before['size'])), 'x'.join(map(str, results['size']))))
+    print("%-10s %12s %12s %8s" % ('stage', 'before', 'now', 'speedup'))
+    for stage in STAGES:
+        if stage in results['stages'] and stage in before['stages']:
+            old = before['stages'][stage]['best']
+            new = results['stages'][stage]['best']
+            print("%-10s %12.3f %12.3f %8.2f" % (stage, old, new, old / new if new > 0 else np.inf))
+
+
+if __name__ == "__main__":
+    options, args = parser.parse_args()
+
+    if options.output is None:
+        print("An output file ( --output ) is required. Try --help ")
+        raise SystemExit()
+    stages = STAGES
+    if options.stages is not None:
+        stages = options.stages.split(',')
+        for stage in stages:
+            if stage not in STAGES:
+                print("Unknown stage: " + stage)
+                raise SystemExit()
+    if options.compare is not None and not os.path.isfile(options.compare):
+        print("File does not exist: " + options.compare)
+        raise SystemExit()
+    size = synthdata.parse_size(options.size)
+    resources = resourcepolicy.ResourcePolicy(options.resources, options.threads, workers=options.sliceworkers).apply()
+    options.sliceworkers = resources.workers()
+
+    workdir = options.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='rspipe_bench')
+    elif not os.path.isdir(workdir):
+        os.mkdir(workdir)
+
+    try:
+        started = time.time()
+        run = synthdata.SynthRun(size[:3], size[3], nparcels=options.parcels, seed=options.seed)
+        names = run.write(os.path.join(workdir, 'synth'))
+        print("synthetic %s run written in %.1fs" % ('x'.join(map(str, size)), time.time() - started))
+
+        profile = pipeprofile.Profiler()
+        pipeline_profiles = []
+        for stage in stages:
+            setup = globals()['bench_' + stage]
+            for repeat in range(options.repeat):
+                #set up fresh, untimed, data for every run
+                func = setup(run, names, workdir)
+                with profile.section('bench', stage, repeat=repeat):
+                    func()
+                del func
+                print("%s run %d: %.3fs" % (stage, repeat + 1, profile.records[-1]['wall']))
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'size': list(size), 'seed': options.seed, 'parcels': run.nparcels, 'repeat': options.repeat,
+               'resources': resources.as_dict(), 'sliceworkers': options.sliceworkers, 'maxmemory': options.maxmemory,
+               'maskedcompute': options.maskedcompute, 'fastpath': options.fastpath, 'fcdmcrop': options.fcdmcrop, 'nodes': options.nodes, 'communities': options.communities,
+               'stages': summarize(profile.records), 'records': profile.records,
+               'pipeline_profiles': pipeline_profiles}
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    if options.compare is not None:
+        compare(results, options.compare)
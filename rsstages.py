@@ -0,0 +1,256 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import numpy as np
+import networkx as nx
+from scipy import signal
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+
+Numerical kernels of the resting_pipeline.py steps
+The array work of motion/WM/CSF regression ( steps 2 and 5 ), the lowpass
+filter ( step 6 ) and the correlation matrices and graph ( step 7b ), kept
+free of files, FSL and the pipeline options so the steps and rspipe_bench.py
+run exactly the same code.  The slice loops run --sliceworkers slices at a
+time on threads ( lstsq and the FFTs release the GIL ), every slice is
+computed exactly as it is on its own, so the results do not change.
+regress_voxels and lowpass_voxels do the same to a block of voxel time
+series, for the out-of-core mode of outofcore.py and the brain voxels of
+--maskedcompute.
+
+'''
+
+def designs(regressors):
+    #one ( T x 2 ) intercept + regressor design matrix per regressor
+    return [np.vstack([np.ones(len(reg)), reg]).T for reg in regressors]
+
+
+def map_slices(func, nslices, workers=1):
+    #func( cntz ) of every slice, workers slices at a time, each writes its own slice
+    if workers <= 1 or nslices < 2:
+        for cntz in range(nslices):
+            func(cntz)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, nslices)) as pool:
+        #list raises the first exception of a slice
+        list(pool.map(func, range(nslices)))
+
+
+#bytes the blocks of map_blocks use at once by default
+BLOCK_MEMORY = 2**26
+
+#float64 copies of a block alive while it is filtered: the block and the
+#temporaries of detrend and the complex FFTs ( regression needs fewer )
+BLOCK_COPIES = 9
+
+
+def block_rows(tdim, memory=BLOCK_MEMORY, workers=1):
+    #rows of ( n x T ) float64 blocks so workers blocks at once stay within memory bytes
+    return max(1, int(memory // (max(1, workers)*BLOCK_COPIES*8*tdim)))
+
+
+def map_blocks(kernel, data2d, workers=1, memory=BLOCK_MEMORY):
+    '''
+    kernel( block ) in place on blocks of rows of a ( n_vox x T ) array,
+    workers blocks at once.  Blocks are small enough for workers of them to
+    stay within memory bytes, and there are at least workers of them
+    '''
+    step = min(block_rows(data2d.shape[1], memory, workers), max(1, -(-data2d.shape[0] // max(1, workers))))
+    def block_kernel(idx):
+        block = data2d[idx*step:(idx + 1)*step]
+        block[:] = kernel(block)
+    map_slices(block_kernel, -(-data2d.shape[0] // step), workers)
+    return data2d
+
+
+def regress_slices(data1, designs, workers=1):
+    '''
+    data1 : 4D ( x, y, z, t ) data
+    designs : design matrices regressed out one after the other, each from
+              the residuals of the previous one
+    workers : slices regressed at once
+
+    returns the residuals with the voxel means added back, slice by slice
+    '''
+    tmp_mean = np.mean(data1, axis=3, dtype=data1.dtype)
+    shape = data1.shape
+    data1v = data1.reshape((shape[0]*shape[1], shape[2], shape[3])).transpose((1, 2, 0))
+    # data1v is a view in z, t, x*y order
+    # go slice-by-slice
+    def regress_slice(cntz):
+        tmp_data = data1v[cntz]
+        for X in designs:
+            p0 = np.linalg.lstsq(X, tmp_data, rcond=-1)[0]
+            p00 = np.dot(X, p0) #product
+            tmp_data = tmp_data - p00
+        data1v[cntz] = tmp_data
+    map_slices(regress_slice, shape[2], workers)
+
+    data_mr = data1v.transpose((2, 0, 1)).reshape(shape)
+    del data1v
+    # in-place (-=, *=) operations should save memory
+    data_mr += tmp_mean.reshape(tmp_mean.shape + (1,))
+    return data_mr
+
+
+def regress_voxels(block, designs):
+    '''
+    block : ( n_vox x T ) voxel time series, regressed in place like
+            regress_slices, with the voxel means added back
+
+    returns block
+    '''
+    tmp_mean = np.mean(block, axis=1)
+    tmp_data = block.T
+    for X in designs:
+        p0 = np.linalg.lstsq(X, tmp_data, rcond=-1)[0]
+        p00 = np.dot(X, p0) #product
+        tmp_data = tmp_data - p00
+    block[:] = tmp_data.T
+    block += tmp_mean[:,np.newaxis]
+    return block
+
+
+def chunk_starts(nvols, chunk=None, workers=1):
+    #first volume of every chunk, one chunk per worker by default
+    if chunk is None or chunk <= 0:
+        chunk = -(-nvols // max(1, workers))
+    return list(range(0, nvols, max(1, chunk))), max(1, chunk)
+
+
+def value_range(data, chunk=None, workers=1):
+    '''
+    min and max of data, from the min and max of every chunk of chunk volumes
+    ( the last axis ), workers chunks at once
+    '''
+    starts, chunk = chunk_starts(data.shape[-1], chunk, workers)
+    mins = [None]*len(starts)
+    maxs = [None]*len(starts)
+    def chunk_range(idx):
+        part = data[..., starts[idx]:starts[idx] + chunk]
+        mins[idx] = np.min(part)
+        maxs[idx] = np.max(part)
+    map_slices(chunk_range, len(starts), workers)
+    return data.dtype.type(np.min(mins)), data.dtype.type(np.max(maxs))
+
+
+def rescale(data, dtype, chunk=None, limits=None, workers=1):
+    '''
+    in place to 0..30000, the scale factor cast to the output dtype like the
+    steps always did.  Streams over chunks of chunk volumes: the min and max
+    of every chunk first ( or limits, a precomputed ( min, max ) ), then the
+    scaling.  Subtracting the min is monotonic, so the max of the shifted
+    data is the shifted max and every chunking gives the same bits as
+    rescaling the whole array at once
+    '''
+    if limits is None:
+        limits = value_range(data, chunk, workers)
+    mn = data.dtype.type(limits[0])
+    mx = data.dtype.type(limits[1])
+    scale = (30000.0 / (mx - mn)).astype(dtype)
+    starts, chunk = chunk_starts(data.shape[-1], chunk, workers)
+    def rescale_chunk(idx):
+        part = data[..., starts[idx]:starts[idx] + chunk]
+        part -= mn
+        part *= scale
+    map_slices(rescale_chunk, len(starts), workers)
+    return data
+
+
+def lowpass_window(tdim, tr_ms, freq_cutoff):
+    '''
+    ( T x 1 ) frequency window of the step 6 lowpass filter, in fftshift order,
+    with raised cosine edges
+    '''
+    time_all = np.arange(0,(tdim*(tr_ms/1000))-.001,.001)
+    time_subTR = time_all[0:-1:int(tr_ms)]
+    length = len(time_subTR)
+    ccc = 1.0/(tr_ms/1000)/length
+    cccc = freq_cutoff/ccc
+    len1 = round(length/2.0-(cccc-2))
+    len2 = round(length/2.0+(cccc+1))
+
+    tmp = np.zeros([tdim,1])
+    tmp[int(len1):int(len2)]=1
+    tmpMA = len1-4
+    tmpMA2 = round(tmpMA/2)
+    tmpAB = np.divide(np.add(1,np.cos(np.arange(np.pi, 2*np.pi+((np.pi/tmpMA)/2), np.pi/tmpMA))),2)
+    tmpAB = tmpAB.reshape(tmpAB.shape[0],1)
+    tmpBA = np.divide(np.add(1,np.cos(np.arange(2*np.pi,np.pi-((np.pi/tmpMA)/2), -np.pi/tmpMA))),2)
+    tmpBA = tmpBA.reshape(tmpBA.shape[0],1)
+
+    tmp[int((len1-tmpMA+tmpMA2)-1):int(len1+tmpMA2)]=tmpAB
+    tmp[int((len2-tmpMA2)-1):int(len2+tmpMA-tmpMA2)]=tmpBA
+    return tmp
+
+
+def lowpass_slices(data1, window, workers=1):
+    '''
+    detrend and filter every voxel time series of data1 in place, slice by
+    slice ( workers slices at once ), then add the voxel means back
+
+    returns data1
+    '''
+    tmp_mean = np.mean(data1, axis=3, dtype=data1.dtype)
+    # go slice-by-slice
+    def lowpass_slice(cntz):
+        tmp_data = data1[:,:,cntz,:]
+        arr_f = np.fft.fftshift(np.fft.fft(np.fft.fftshift(signal.detrend(tmp_data), axes=[2]), axis=2), axes=[2])
+        arr_fc = np.multiply(arr_f, window.T)
+        yyy00 = np.real(np.fft.fftshift(np.fft.ifft(np.fft.fftshift(arr_fc, axes=[2]), axis=2), axes=[2]))
+        data1[:,:,cntz,:] = yyy00
+    map_slices(lowpass_slice, data1.shape[2], workers)
+    data1 += tmp_mean.reshape(tmp_mean.shape + (1,))
+    return data1
+
+
+def lowpass_voxels(block, window):
+    #( n_vox x T ) voxel time series filtered in place like lowpass_slices
+    tmp_mean = np.mean(block, axis=1)
+    arr_f = np.fft.fftshift(np.fft.fft(np.fft.fftshift(signal.detrend(block), axes=[1]), axis=1), axes=[1])
+    arr_fc = np.multiply(arr_f, window.T)
+    block[:] = np.real(np.fft.fftshift(np.fft.ifft(np.fft.fftshift(arr_fc, axes=[1]), axis=1), axes=[1]))
+    block += tmp_mean[:,np.newaxis]
+    return block
+
+
+def correlation_matrices(timeseries):
+    #( roi x roi ) r and fisher z matrices, the infs of the diagonal set to 0
+    myres = np.nan_to_num(np.corrcoef(timeseries))
+    with np.errstate(divide='ignore'):
+        zrmaps = 0.5*np.log((1+myres)/(1-myres))
+    zrmaps[zrmaps == np.inf] = 0
+    return myres, zrmaps
+
+
+def lower_mask(myres):
+    #mask for higher level, everything below the diagonal
+    return np.tril(np.ones_like(myres), -1)
+
+
+def correlation_graph(labels, timeseries, myres, zrmaps, geometry, center, zooms, atlas):
+    '''
+    labels : [ value, name ] pairs of the correlation labels
+    geometry : atlasgeom.AtlasGeometry of the label image
+    center : AC voxel, centroids are written in mm relative to it
+
+    returns the subject graph, nodes are the label values and edges the
+    non-zero zr values
+    '''
+    G=nx.Graph(atlas=str(atlas))
+    for lab in labels:
+        #cached centroid of the label value
+        centroid = geometry.centroid(lab[0])
+        c_cent_str = str((centroid - center)*(zooms.astype('int')))[1:-1].strip()
+        G.add_node(lab[0],label=str(lab[1]),centroid=c_cent_str,intensityvalue=lab[0] )
+        timecourse = timeseries[int(lab[0] - 1)]
+        G.nodes[lab[0]]['timecourse'] = str(timecourse.tolist()).replace(',','').strip('[]')
+
+    #upper triangle, in the row order of the full matrix
+    sigx,sigy = np.triu(zrmaps != 0, 1).nonzero()
+    for idx in range(len(sigx)):
+        zrval = str(zrmaps[sigx[idx]][sigy[idx]])
+        rval = str(myres[sigx[idx]][sigy[idx]])
+        G.add_edge(sigx[idx] + 1,sigy[idx] + 1, zrvalue=zrval, rvalue=rval)
+    return G
@@ -0,0 +1,99 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import numpy as np
+import nibabel
+import atlasgeom
+
+'''
+
+Seed-to-voxel correlation maps
+All seeds are correlated with all in-mask voxels at once: the seed and voxel
+time series are standardized ( zero mean, unit norm ) so the correlation maps
+are a single ( n_seeds x T ) . ( T x n_vox ) matrix product, optionally done
+in chunks of voxels to bound memory.
+
+'''
+
+def standardize(ts, axis=0):
+    #zero mean, unit norm along axis, constant series become all zero
+    ts = ts - ts.mean(axis=axis, keepdims=True)
+    norm = np.sqrt((ts*ts).sum(axis=axis, keepdims=True))
+    norm[norm == 0] = np.inf
+    ts /= norm
+    return ts
+
+
+def seed_timeseries(data2d, geometry, seeds):
+    '''
+    data2d : ( n_vox x T ) data, voxels in fortran order
+    geometry : atlasgeom.AtlasGeometry of the label image
+    seeds : label values to average over
+
+    returns the ( n_seeds x T ) mean time series of each seed region
+    '''
+    seedts = np.zeros((len(seeds), data2d.shape[1]), dtype=np.float64)
+    for idx, seed in enumerate(seeds):
+        members = geometry.voxels(seed)
+        if len(members) > 0:
+            seedts[idx] = data2d[members].mean(axis=0)
+    return seedts
+
+
+def seedmaps(datafile, labelfile, seeds, outprefix, maskfile=None, chunk=None, keep=None):
+    '''
+    datafile : 4D functional data
+    labelfile : 3D label image on the same grid, seeds are label values in it
+    outprefix : maps are written to outprefix_r.nii.gz and outprefix_zr.nii.gz,
+                one volume per seed in the order given
+    maskfile : optional 3D mask, voxels outside of it are left at 0
+    chunk : number of voxels per matrix product, default is all in one
+    keep : optional boolean ( T ) array of volumes to use ( ie: the scrub mask )
+
+    returns the names of the r and zr maps
+    '''
+    data = nibabel.load(datafile)
+    labnii = nibabel.load(labelfile)
+    if data.shape[:-1] != labnii.shape:
+        raise IndexError("Data and label image are not the same x,y,z shape!")
+
+    shape = data.shape[:-1]
+    nvox = int(np.prod(shape))
+    #fortran order like the atlas geometry, a view of the nibabel array
+    data2d = data.get_fdata(dtype=np.float32).reshape((nvox, data.shape[-1]), order='F')
+    if keep is not None:
+        data2d = data2d[:,np.asarray(keep, dtype=bool)]
+
+    #skip constant ( ie: outside the brain ) voxels
+    inmask = data2d.max(axis=1) != data2d.min(axis=1)
+    if maskfile is not None:
+        mask = nibabel.load(maskfile)
+        if mask.shape != shape:
+            raise IndexError("Data and mask are not the same x,y,z shape!")
+        inmask &= np.asarray(mask.dataobj).reshape(nvox, order='F') != 0
+    inmask = np.flatnonzero(inmask)
+
+    #( n_seeds x T ), standardized along time
+    seedts = standardize(seed_timeseries(data2d, atlasgeom.atlas_geometry(labelfile), seeds), axis=1).astype(np.float32)
+
+    if chunk is None or chunk <= 0:
+        chunk = len(inmask)
+    chunk = max(int(chunk), 1)
+
+    rmaps = np.zeros((nvox, len(seeds)), dtype=np.float32)
+    for first in range(0, len(inmask), chunk):
+        these = inmask[first:first + chunk]
+        #( T x chunk ), standardized along time
+        vox = standardize(data2d[these].T, axis=0)
+        rmaps[these] = np.dot(seedts, vox).T
+
+    np.clip(rmaps, -1, 1, out=rmaps)
+    with np.errstate(divide='ignore'):
+        zrmaps = np.arctanh(rmaps)
+    zrmaps[np.isinf(zrmaps)] = 0
+
+    rname = outprefix + '_r.nii.gz'
+    zname = outprefix + '_zr.nii.gz'
+    nibabel.save(nibabel.Nifti1Image(rmaps.reshape(shape + (len(seeds),), order='F'), data.affine), rname)
+    nibabel.save(nibabel.Nifti1Image(zrmaps.reshape(shape + (len(seeds),), order='F'), data.affine), zname)
+    return rname, zname
@@ -0,0 +1,249 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import os
+import numpy as np
+import nibabel
+import scipy.sparse
+from scipy.spatial import cKDTree
+import community
+
+'''
+
+Synthetic resting state data with a known correlation structure
+An ellipsoid brain is split into Voronoi parcels ( the atlas ) and the parcels
+into networks.  Every in-brain voxel is
+
+    baseline + a*network signal + b*parcel signal + nuisance + c*noise
+
+with band limited ( 0.01-0.08Hz ) network and parcel signals, and nuisance the
+voxel's own mix of 6 motion parameters and WM/CSF signals, written out as the
+.par and _ts.txt files steps 2 and 5 regress.  Once the nuisance is regressed
+out, parcel mean time series of the same network correlate at a^2/(a^2+b^2)
+and of different networks at 0.  Large runs are written one volume at a time,
+so a 2mm MNI x 1200 volume run never has to fit in memory.
+
+'''
+
+#name : ( x, y, z, t )
+SIZES = {
+    'tiny': (16, 16, 12, 60),
+    'small': (32, 32, 24, 100),
+    '64': (64, 64, 64, 200),
+    'mni2mm': (91, 109, 91, 1200),
+}
+
+
+def parse_size(size):
+    #a SIZES name or XxYxZxT
+    if size in SIZES:
+        return SIZES[size]
+    dims = tuple(int(dim) for dim in size.lower().split('x'))
+    if len(dims) != 4:
+        raise ValueError("Size is a name ( %s ) or XxYxZxT: %s" % (', '.join(sorted(SIZES)), size))
+    return dims
+
+
+def bold_signals(nsig, tdim, tr_ms, rng, band=(0.01, 0.08)):
+    #( nsig x T ) zero mean, unit variance noise limited to band ( Hz )
+    spec = np.fft.rfft(rng.standard_normal((nsig, tdim)), axis=1)
+    freqs = np.fft.rfftfreq(tdim, tr_ms/1000.)
+    spec[:,(freqs < band[0]) | (freqs > band[1])] = 0
+    sig = np.fft.irfft(spec, n=tdim, axis=1)
+    sig -= sig.mean(axis=1, keepdims=True)
+    std = sig.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    return sig / std
+
+
+def ellipsoid_distance(shape):
+    #squared normalized distance from the center, 1 on the brain surface
+    grid = np.ogrid[tuple(slice(0, dim) for dim in shape)]
+    return sum(((axis - (dim - 1)/2.)/(0.45*dim))**2 for axis, dim in zip(grid, shape))
+
+
+def brain_mask(shape):
+    #ellipsoid filling most of the volume
+    return ellipsoid_distance(shape) <= 1
+
+
+def tissue_masks(shape):
+    #csf core, white matter shell and gray matter rind of the ellipsoid brain
+    dist = ellipsoid_distance(shape)
+    return {'csf': dist < 0.05, 'wm': (dist >= 0.05) & (dist < 0.4), 'gm': (dist >= 0.4) & (dist <= 1)}
+
+
+def parcellate(mask, nparcels, rng):
+    #labels 1..nparcels of the mask voxels, each voxel goes to its nearest random seed voxel
+    voxels = np.array(np.nonzero(mask)).T
+    seeds = voxels[rng.choice(len(voxels), size=min(nparcels, len(voxels)), replace=False)]
+    atlas = np.zeros(mask.shape, dtype=np.int16)
+    atlas[mask] = cKDTree(seeds).query(voxels)[1] + 1
+    return atlas
+
+
+def truth_matrix(networks, a=1., b=1.):
+    #expected parcel correlations, networks is the network of every parcel
+    same = networks[:,np.newaxis] == networks[np.newaxis,:]
+    truth = np.where(same, a*a/(a*a + b*b), 0.)
+    np.fill_diagonal(truth, 1.)
+    return truth
+
+
+class SynthRun(object):
+    """
+    shape : ( x, y, z ), tdim volumes every tr_ms
+    mask, atlas, networks : brain mask, parcel labels and network of every parcel
+    motion : ( 6 x T ) mcflirt style rotations ( radians ) and translations ( mm )
+    wm_ts, csf_ts : ( T ) nuisance signals
+    truth : expected ( parcel x parcel ) correlations after nuisance regression
+    """
+    def __init__(self, shape, tdim, nparcels=116, nnetworks=7, tr_ms=2000., seed=0,
+                 a=1., b=1., noise=2., nuisance=1., baseline=10000.):
+        self.shape = tuple(shape)
+        self.tdim = tdim
+        self.tr_ms = float(tr_ms)
+        self.seed = seed
+        self.baseline = baseline
+        self.noise = noise
+        rng = np.random.RandomState(seed)
+
+        self.mask = brain_mask(self.shape)
+        self.atlas = parcellate(self.mask, nparcels, rng)
+        self.nparcels = int(self.atlas.max())
+        self.networks = np.arange(self.nparcels) % nnetworks
+        self.truth = truth_matrix(self.networks, a, b)
+
+        self.voxels = np.flatnonzero(self.mask.reshape(-1, order='F'))
+        parcel = self.atlas.reshape(-1, order='F')[self.voxels].astype(np.int64) - 1
+
+        #signal of every in-brain voxel is its network and parcel signals
+        self.netsig = a*bold_signals(nnetworks, tdim, self.tr_ms, rng)
+        self.parsig = b*bold_signals(self.nparcels, tdim, self.tr_ms, rng)
+        self.network_of = self.networks[parcel]
+        self.parcel_of = parcel
+
+        #slow drifts and a few jumps, like mcflirt would estimate
+        drift = np.cumsum(rng.standard_normal((6, tdim)), axis=1)
+        drift /= np.abs(drift).max(axis=1, keepdims=True) + 1e-12
+        self.motion = drift*np.array([0.01, 0.01, 0.01, 0.5, 0.5, 0.5])[:,np.newaxis]
+        self.wm_ts = bold_signals(1, tdim, self.tr_ms, rng, band=(0., 0.25))[0]
+        self.csf_ts = bold_signals(1, tdim, self.tr_ms, rng, band=(0., 0.25))[0]
+        nuis = np.vstack([self.motion / self.motion.std(axis=1, keepdims=True).clip(1e-12), self.wm_ts, self.csf_ts])
+        self.nuisance = nuis
+        self.nuisance_weights = (nuisance*rng.standard_normal((len(self.voxels), nuis.shape[0]))).astype(np.float32)
+        self.noise_seed = rng.randint(2**31 - 1)
+
+    def volumes(self):
+        #every volume as a flat, fortran ordered, float32 array
+        nvox = int(np.prod(self.shape))
+        rng = np.random.RandomState(self.noise_seed)
+        for idx in range(self.tdim):
+            vol = np.zeros(nvox, dtype=np.float32)
+            vol[self.voxels] = (self.baseline + self.netsig[self.network_of, idx] + self.parsig[self.parcel_of, idx]
+                                + np.dot(self.nuisance_weights, self.nuisance[:,idx].astype(np.float32))
+                                + self.noise*rng.standard_normal(len(self.voxels)))
+            yield vol
+
+    def data(self):
+        #the whole run in memory, ( x, y, z, t ) float32
+        out = np.empty(self.shape + (self.tdim,), dtype=np.float32, order='F')
+        flat = out.reshape((-1, self.tdim), order='F')
+        for idx, vol in enumerate(self.volumes()):
+            flat[:,idx] = vol
+        return out
+
+    def center(self):
+        #middle voxel, the AC point ( --refacpoint ) of the synthetic brain
+        return [(dim - 1)//2 for dim in self.shape]
+
+    def affine(self):
+        #2mm voxels, centered
+        aff = np.diag([-2., 2., 2., 1.])
+        aff[:3,3] = [(self.shape[0] - 1), -(self.shape[1] - 1), -(self.shape[2] - 1)]
+        return aff
+
+    def write_bold(self, fname):
+        '''
+        write the run to an uncompressed .nii one volume at a time, the run
+        never has to fit in memory
+        '''
+        hdr = nibabel.Nifti1Header()
+        hdr.set_data_shape(self.shape + (self.tdim,))
+        hdr.set_data_dtype(np.float32)
+        hdr.set_zooms((2., 2., 2., self.tr_ms/1000.))
+        hdr.set_xyzt_units('mm', 'sec')
+        hdr.set_qform(self.affine(), code=1)
+        hdr.set_sform(self.affine(), code=1)
+        hdr['vox_offset'] = 352
+        tmpname = fname + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpname, 'wb') as f:
+            hdr.write_to(f)
+            #no extensions
+            f.write(b'\x00'*(352 - f.tell()))
+            for vol in self.volumes():
+                f.write(vol.astype('<f4').tobytes())
+        os.rename(tmpname, fname)
+        return fname
+
+    def write(self, outprefix):
+        '''
+        writes outprefix_bold.nii, _mask.nii.gz, _atlas.nii.gz, _atlas.txt ( label
+        text like data/aal_MNI_V4.txt ), _mcf.par, _wm_ts.txt, _csf_ts.txt,
+        _truth.txt and the reference brain ( _ref.nii.gz ) and tissue masks
+        ( _refwm, _refcsf, _refgm .nii.gz ) for --ref/--refwm/--refcsf/--refgm,
+        returns their names by kind
+        '''
+        names = {'bold': outprefix + '_bold.nii', 'mask': outprefix + '_mask.nii.gz',
+                 'atlas': outprefix + '_atlas.nii.gz', 'labels': outprefix + '_atlas.txt',
+                 'par': outprefix + '_mcf.par', 'wm': outprefix + '_wm_ts.txt',
+                 'csf': outprefix + '_csf_ts.txt', 'truth': outprefix + '_truth.txt',
+                 'ref': outprefix + '_ref.nii.gz', 'refwm': outprefix + '_refwm.nii.gz',
+                 'refcsf': outprefix + '_refcsf.nii.gz', 'refgm': outprefix + '_refgm.nii.gz'}
+        self.write_bold(names['bold'])
+        nibabel.save(nibabel.Nifti1Image(self.mask.astype(np.uint8), self.affine()), names['mask'])
+        nibabel.save(nibabel.Nifti1Image(self.atlas, self.affine()), names['atlas'])
+        with open(names['labels'], 'w') as f:
+            for lab in range(1, self.nparcels + 1):
+                f.write("%d\tparcel%03d_net%d\n" % (lab, lab, self.networks[lab - 1]))
+        #mcflirt writes rotations then translations, one volume per line
+        np.savetxt(names['par'], self.motion.T, fmt='%f')
+        np.savetxt(names['wm'], self.wm_ts, fmt='%f')
+        np.savetxt(names['csf'], self.csf_ts, fmt='%f')
+        np.savetxt(names['truth'], self.truth, fmt='%g')
+        tissues = tissue_masks(self.shape)
+        ref = np.zeros(self.shape, dtype=np.float32)
+        for tissue, contrast in [('csf', 0.3), ('wm', 1.), ('gm', 0.7)]:
+            ref[tissues[tissue]] = contrast*self.baseline
+            nibabel.save(nibabel.Nifti1Image(tissues[tissue].astype(np.float32), self.affine()), names['ref' + tissue])
+        nibabel.save(nibabel.Nifti1Image(ref, self.affine()), names['ref'])
+        return names
+
+
+def planted_graph(nnodes, ncomms, k_in=20, k_out=2, seed=0):
+    '''
+    weighted graph of ncomms equal communities, every node linked to about
+    k_in nodes of its own community and k_out of the others
+
+    returns the community.CSRGraph and the community of every node
+    '''
+    rng = np.random.RandomState(seed)
+    membership = np.arange(nnodes) % ncomms
+    order = np.argsort(membership, kind='mergesort')
+    size = np.bincount(membership, minlength=ncomms)
+    first = np.concatenate([[0], np.cumsum(size)])[membership]
+
+    src = np.repeat(np.arange(nnodes), k_in + k_out)
+    dst = np.empty(len(src), dtype=np.int64)
+    inside = np.tile(np.arange(k_in + k_out) < k_in, nnodes)
+    #inside picks are a random member of the node's own community, outside any node
+    dst[inside] = order[first[src[inside]] + rng.randint(0, 2**31 - 1, inside.sum()) % size[membership[src[inside]]]]
+    dst[~inside] = rng.randint(0, nnodes, (~inside).sum())
+    keep = src != dst
+    src, dst = src[keep], dst[keep]
+    weights = rng.uniform(0.5, 1., len(src))
+
+    adj = scipy.sparse.csr_matrix((weights, (src, dst)), shape=(nnodes, nnodes))
+    adj = adj.maximum(adj.T).tocsr()
+    adj.sort_indices()
+    return community.CSRGraph(range(nnodes), adj.indptr, adj.indices, adj.data), membership
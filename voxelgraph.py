@@ -0,0 +1,155 @@
+#!/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+import numpy as np
+import nibabel
+import scipy.sparse
+import community
+from seedmaps import standardize
+
+'''
+
+Voxel-level functional connectivity graphs
+The in-mask voxel time series are standardized once, then correlated with
+all in-mask voxels a block of rows at a time ( a ( block x T ) . ( T x n_vox )
+matrix product ).  Only the edges above the threshold and/or among the top k
+of each voxel are kept from every block, so memory grows with the number of
+retained edges and never with n_vox^2.  Only positive correlations are
+kept, the Louvain of community.py maximises the unsigned modularity.  Every
+edge is stored once, from the upper triangle ( or the union of the top k of
+both ends ), and mirrored, so the graph is exactly symmetric.  The graph is
+written in the binary format of community.load_binary, with the r values as
+weights.
+
+'''
+
+def block_size(nvox, budget=2**26):
+    #rows per block so a block of correlations stays within budget values
+    return max(1, int(budget // max(nvox, 1)))
+
+
+def block_edges(rmat, first, thresh=None, topk=None):
+    '''
+    rmat : ( block x n_vox ) correlations of voxels first.. with every voxel
+    thresh : keep r > thresh, r > 0 is always needed
+    topk : keep the k largest r of every row, without it only the columns
+           after each row ( the upper triangle ) are kept
+
+    returns row, column and r of the kept edges, self correlations excluded
+    '''
+    nrows = rmat.shape[0]
+    rows = np.arange(nrows)
+    rmat[rows, rows + first] = -np.inf
+    rmat[rmat <= max(thresh or 0, 0)] = -np.inf
+    if topk is None:
+        #r_ij and r_ji come from different blocks, each pair is taken once
+        rmat[np.arange(rmat.shape[1]) < (rows + first)[:,np.newaxis]] = -np.inf
+    elif topk < rmat.shape[1]:
+        #everything but the k largest of each row
+        rest = np.argpartition(-rmat, topk, axis=1)[:,topk:]
+        rmat[rows[:,np.newaxis], rest] = -np.inf
+    keep_rows, keep_cols = np.nonzero(np.isfinite(rmat))
+    return keep_rows + first, keep_cols, rmat[keep_rows, keep_cols]
+
+
+def voxelgraph(datafile, maskfile, outprefix, thresh=None, topk=None, block=None, keep=None):
+    '''
+    datafile : 4D functional data
+    maskfile : 3D mask, the graph nodes are its non-constant voxels
+    outprefix : writes outprefix_graph.bin, outprefix_graph.weights ( see
+                community.load_binary ) and outprefix_nodes.nii.gz, the node
+                index + 1 of every voxel ( 0 outside the graph )
+    thresh : keep edges with r > thresh, at least 0: negative correlations
+             are never kept
+    topk : keep the k strongest edges of every voxel, an edge is kept when it
+           is among the top k of either end
+    block : number of voxels correlated at a time, default keeps a block of
+            correlations around 256MB
+    keep : optional boolean ( T ) array of volumes to use ( ie: the scrub mask )
+
+    returns the graph, weights and node map file names and the number of edges
+    '''
+    if thresh is None and topk is None:
+        raise ValueError("A threshold or a number of edges per voxel is needed")
+    if thresh is not None and thresh < 0:
+        raise ValueError("Negative correlations can not be graph edges, the threshold must be at least 0")
+
+    data = nibabel.load(datafile)
+    mask = nibabel.load(maskfile)
+    shape = data.shape[:-1]
+    if mask.shape != shape:
+        raise IndexError("Data and mask are not the same x,y,z shape!")
+
+    nvox = int(np.prod(shape))
+    data2d = data.get_fdata(dtype=np.float32).reshape((nvox, data.shape[-1]))
+    if keep is not None:
+        data2d = data2d[:,np.asarray(keep, dtype=bool)]
+
+    #skip constant voxels like seedmaps
+    inmask = (data2d.max(axis=1) != data2d.min(axis=1)) & (np.asarray(mask.dataobj).reshape(nvox) != 0)
+    voxels = np.flatnonzero(inmask)
+    nnodes = len(voxels)
+
+    #( n_vox x T ), standardized along time
+    zdata = standardize(data2d[voxels], axis=1)
+    del data2d
+
+    if block is None or block <= 0:
+        block = block_size(nnodes)
+
+    rows, cols, vals = [], [], []
+    for first in range(0, nnodes, block):
+        rmat = np.dot(zdata[first:first + block], zdata.T)
+        brows, bcols, bvals = block_edges(rmat, first, thresh, topk)
+        rows.append(brows.astype(np.int32))
+        cols.append(bcols.astype(np.int32))
+        vals.append(bvals.astype(np.float32))
+        del rmat
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+    vals = np.concatenate(vals) if vals else np.zeros(0, dtype=np.float32)
+
+    if topk is not None:
+        #top k is not symmetric, an edge stays if either end kept it, with
+        #the r of its lower index end when both did
+        low = np.minimum(rows, cols)
+        high = np.maximum(rows, cols)
+        order = np.lexsort((rows != low, high, low))
+        low, high, vals = low[order], high[order], vals[order]
+        first = np.ones(len(low), dtype=bool)
+        first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+        rows, cols, vals = low[first], high[first], vals[first]
+        del low, high, order, first
+
+    #every edge once, mirrored
+    adj = scipy.sparse.csr_matrix((np.concatenate([vals, vals]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                                  shape=(nnodes, nnodes))
+    del rows, cols, vals
+    adj.eliminate_zeros()
+    adj.sort_indices()
+
+    graphname = outprefix + '_graph.bin'
+    weightname = outprefix + '_graph.weights'
+    nodename = outprefix + '_nodes.nii.gz'
+    community.save_binary(community.CSRGraph(range(nnodes), adj.indptr, adj.indices, adj.data),
+                          graphname, weightname)
+
+    nodemap = np.zeros(nvox, dtype=np.int32)
+    nodemap[voxels] = np.arange(1, nnodes + 1)
+    nibabel.save(nibabel.Nifti1Image(nodemap.reshape(shape), data.affine), nodename)
+    return graphname, weightname, nodename, adj.nnz // 2
+
+
+def node_image(values, nodefile, outfile):
+    '''
+    write one value per graph node ( ie: a community.best_partition dict or
+    array over the nodes ) back to the voxels of the node map from voxelgraph
+    '''
+    nodes = nibabel.load(nodefile)
+    nodemap = np.asarray(nodes.dataobj)
+    if isinstance(values, dict):
+        values = [values[node] for node in range(len(values))]
+    values = np.concatenate([[0], np.asarray(values, dtype=np.float32)])
+    nibabel.save(nibabel.Nifti1Image(values[nodemap], nodes.affine), outfile)
+    return outfile